@@ -1,18 +1,36 @@
 import json
+import mimetypes
 import os
 import asyncio
+import contextlib
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-import google.generativeai as genai
+from pydantic import BaseModel, Field, ValidationError
+from starlette.requests import HTTPConnection
 
 # Import the builder
 from test import ModuleBasedAppBuilder, _load_env_file
+from batches import FINISHED as BATCH_FINISHED, BatchManager
+from conversation import ConversationMemory, new_chat_id
+from farm import create_build_jobs
+from jobs import PUBLISHED, QueueFullError, build_message
+from artifacts import (
+    describe_file, etag_for, etag_matches, iter_file, iter_tar_gz, iter_zip, parse_range, resolve_path
+)
+from blobstore import create_output_retention, get_blob_store
+from cache import get_response_cache
+from llm import DEFAULT_MODEL, get_backend
+from registry import EncodedBody, current_content_hash, get_registry
+from retrieval import get_retriever
+from sessions import create_session_store
+import metrics
 
 app = FastAPI(title="Toshokan Code Builder", version="1.0.0")
 
@@ -33,169 +51,660 @@ class ChatMessage(BaseModel):
     role: str  # "user" or "assistant"
     content: str
     timestamp: Optional[str] = None
+    session_id: Optional[str] = None  # conversation to continue; a new one if not given
+
+class GenerationSettings(BaseModel):
+    temperature: Optional[float] = Field(None, ge=0, le=2)
+    top_p: Optional[float] = Field(None, gt=0, le=1)
+    top_k: Optional[int] = Field(None, ge=1)
+    max_output_tokens: Optional[int] = Field(None, ge=1)
 
-class BuildRequest(BaseModel):
+class BuildSettings(BaseModel):
+    use_cache: bool = True  # set False to bypass the LLM response cache
+    model: Optional[str] = None  # default model for every step
+    analysis_model: Optional[str] = None
+    glue_model: Optional[str] = None
+    generation_config: Optional[GenerationSettings] = None
+
+class BuildRequest(BuildSettings):
     prompt: str
     session_id: Optional[str] = None
+    base_session_id: Optional[str] = None  # completed build to refine incrementally
+    chat_session_id: Optional[str] = None  # conversation the prompt continues
+
+class BatchRequest(BuildSettings):
+    prompts: List[str]
+    concurrency: Optional[int] = Field(None, ge=1)  # builds of this batch in flight at once
 
 class BuildResponse(BaseModel):
     session_id: str
     output_dir: str
     status: str
     message: str
-    files: List[Dict[str, str]] = []
+    files: List[Dict[str, Any]] = []
+    failed_files: List[Dict[str, str]] = []
 
 class FileContent(BaseModel):
     path: str
     content: str
 
-# In-memory storage for chat sessions
-chat_sessions: Dict[str, List[ChatMessage]] = {}
-build_sessions: Dict[str, Dict] = {}
+# Session storage (SESSION_STORE=sqlite|memory)
+chat_sessions = create_session_store("chat")
+build_sessions = create_session_store("build")
+
+# Builds in a conversation see its earlier turns, condensed to CHAT_CONTEXT_TOKEN_BUDGET
+conversations = ConversationMemory(chat_sessions, build_sessions)
+
+# Per-build file manifests, looked up when serving files
+_manifests: "OrderedDict[tuple, Dict[str, Dict]]" = OrderedDict()
+
+# Builds run on a bounded worker pool (BUILD_MAX_WORKERS / BUILD_MAX_QUEUE), in this
+# process or in `python farm.py` worker processes (BUILD_EXECUTION=farm)
+# Identical builds in flight are coalesced (BUILD_COALESCE=0 disables)
+build_jobs = create_build_jobs(
+    build_sessions, ModuleBasedAppBuilder, catalog_hash=current_content_hash
+)
+
+# Bulk builds share that pool, each limited to its own concurrency
+batch_jobs = BatchManager(build_jobs, create_session_store("batch"))
+
+# Expires old outputs and reclaims unreferenced blobs (OUTPUT_MAX_AGE / OUTPUT_MAX_BYTES)
+output_retention = create_output_retention(build_sessions, Path("outputs"))
+
+# Readiness (GET /ready): heavy state is loaded after the server starts accepting
+# connections, so restarts and new workers come up quickly
+warmup: Dict[str, Any] = {"status": "starting", "steps": {}}
+_warmup_task: Optional[asyncio.Task] = None
+
+def _warm_up() -> None:
+    """Load the module registry, retrieval index, LLM client and caches."""
+    started = time.perf_counter()
+    steps = (
+        ("registry", get_registry),
+        ("retriever", lambda: get_retriever(get_registry())),
+        ("llm_backend", get_backend),
+        ("response_cache", get_response_cache),
+        ("builder", ModuleBasedAppBuilder),
+    )
+    warmup["status"] = "warming_up"
+    try:
+        for name, step in steps:
+            step_started = time.perf_counter()
+            step()
+            warmup["steps"][name] = round(time.perf_counter() - step_started, 4)
+    except Exception as e:
+        warmup.update(status="failed", error=f"{name}: {e}")
+        print(f"Warm-up failed at {name}: {e}")
+        return
+    warmup.update(status="ready", seconds=round(time.perf_counter() - started, 4))
+
+@app.on_event("startup")
+async def start_warm_up():
+    global _warmup_task
+    _warmup_task = asyncio.create_task(asyncio.to_thread(_warm_up))
+
+@app.on_event("startup")
+async def start_session_maintenance():
+    build_jobs.recover_interrupted()
+    batch_jobs.recover_interrupted()
+    chat_sessions.start_expiry()
+    build_sessions.start_expiry()
+    Path("outputs").mkdir(exist_ok=True)
+    output_retention.start(float(os.getenv("OUTPUT_GC_INTERVAL", "3600")))
+
+@app.on_event("shutdown")
+async def shutdown_build_jobs():
+    build_jobs.shutdown()
 
 @app.get("/")
 async def root():
     return {"message": "Toshokan Code Builder API", "version": "1.0.0"}
 
-@app.get("/api/modules")
-async def get_modules():
-    """Get all available modules."""
+def _catalog_registry():
     try:
-        with open("modules.json", "r") as f:
-            modules = json.load(f)
-        return {"modules": modules, "count": len(modules)}
+        return get_registry()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _encoded_response(request: Request, encoded: EncodedBody) -> Response:
+    """Serve a pre-serialized body: 304 on a matching ETag, gzipped if accepted."""
+    gzip_etag = f'{encoded.etag[:-1]}-gzip"'
+    accepts_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {
+        "ETag": gzip_etag if accepts_gzip else encoded.etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, encoded.etag) or etag_matches(if_none_match, gzip_etag):
+        return Response(status_code=304, headers=headers)
+    if accepts_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=encoded.gzipped, media_type="application/json", headers=headers)
+    return Response(content=encoded.body, media_type="application/json", headers=headers)
+
+@app.get("/api/modules")
+async def get_modules(request: Request, include_code: bool = True):
+    """Get all available modules (`include_code=false` for a listing without code)."""
+    # Checking for a reload and rendering a new body (which reads module files) block
+    encoded = await asyncio.to_thread(lambda: _catalog_registry().catalog_body(include_code))
+    return _encoded_response(request, encoded)
+
+@app.get("/api/modules/{module_id}")
+async def get_module(module_id: str, request: Request):
+    """Get one module, including its code."""
+    encoded = await asyncio.to_thread(lambda: _catalog_registry().module_body(module_id))
+    if encoded is None:
+        raise HTTPException(status_code=404, detail="Module not found")
+    return _encoded_response(request, encoded)
+
 @app.post("/api/chat")
 async def chat(message: ChatMessage):
-    """Handle chat messages (for conversation history)."""
-    session_id = message.timestamp or datetime.utcnow().isoformat()
-    
-    if session_id not in chat_sessions:
-        chat_sessions[session_id] = []
-    
-    chat_sessions[session_id].append(message)
+    """Add a message to a conversation (a new one without `session_id`)."""
+    session_id = message.session_id or new_chat_id()
+    session = conversations.add_message(session_id, message.role, message.content,
+                                        message.timestamp)
     
     return {
         "session_id": session_id,
         "message": "Message received",
-        "history_length": len(chat_sessions[session_id])
+        "history_length": len(session["messages"])
     }
 
 @app.get("/api/chat/{session_id}")
 async def get_chat_history(session_id: str):
     """Get chat history for a session."""
-    if session_id not in chat_sessions:
+    session = chat_sessions.get(session_id)
+    if session is None:
         return {"session_id": session_id, "messages": []}
     
     return {
         "session_id": session_id,
-        "messages": chat_sessions[session_id]
+        "messages": session["messages"],
+        "summary": session.get("summary", []),
+        "builds": session.get("builds", [])
     }
 
-@app.post("/api/build")
-async def build_app(request: BuildRequest):
-    """Build an app from a user prompt."""
+def _build_response(session_id: str, session: Dict) -> BuildResponse:
+    """Turn a finished build session into an API response."""
+    if session["status"] == "failed":
+        raise HTTPException(status_code=500, detail=session.get("error", "Build failed"))
+    if session["status"] == "timed_out":
+        raise HTTPException(status_code=504, detail=session["error"])
+    if session["status"] == "cancelled":
+        raise HTTPException(status_code=409, detail=session["error"])
+
+    files = session.get("files", [])
+    failed_files = session.get("failed_files", [])
+    return BuildResponse(
+        session_id=session_id,
+        output_dir=session["output_dir"],
+        status=session["status"],
+        message=build_message(files, failed_files),
+        files=files,
+        failed_files=failed_files
+    )
+
+def _base_build(base_session_id: Optional[str]) -> Optional[Dict]:
+    """The published build a rebuild refines, or None for a fresh build."""
+    if not base_session_id:
+        return None
+    base = build_sessions.get(base_session_id)
+    if base is None:
+        raise HTTPException(status_code=404, detail="Base session not found")
+    if base.get("status") not in PUBLISHED or not base.get("analysis"):
+        raise HTTPException(status_code=409, detail="Base build has not completed")
+    return base
+
+def _llm_options(request: BuildSettings, base: Optional[Dict] = None) -> Dict[str, Any]:
+    """Builder keyword arguments for the request's model choices.
+
+    Only models in LLM_ALLOWED_MODELS may be chosen ("*" allows any); by
+    default those are the configured ones (LLM_MODEL, LLM_ANALYSIS_MODEL,
+    LLM_GLUE_MODEL). A rebuild without model choices keeps those of its base build.
+    """
+    allowed = {m.strip() for m in os.getenv("LLM_ALLOWED_MODELS", "").split(",") if m.strip()}
+    if not allowed:
+        allowed = {os.getenv("LLM_MODEL") or DEFAULT_MODEL}
+        allowed.update(m for m in (os.getenv("LLM_ANALYSIS_MODEL"), os.getenv("LLM_GLUE_MODEL")) if m)
+    for name in (request.model, request.analysis_model, request.glue_model):
+        if name and "*" not in allowed and name not in allowed:
+            raise HTTPException(status_code=400, detail=f"Model not allowed: {name}")
+    
+    options: Dict[str, Any] = {}
+    if request.model:
+        options["model_name"] = request.model
+    step_models = {
+        step: name for step, name in (("analysis", request.analysis_model),
+                                      ("glue", request.glue_model)) if name
+    }
+    if step_models:
+        options["step_models"] = step_models
+    if request.generation_config:
+        config = request.generation_config.model_dump(exclude_none=True)
+        if config:
+            options["generation_config"] = config
+    if not options and base:
+        return dict(base.get("options") or {})
+    return options
+
+def _client_id(connection: HTTPConnection) -> str:
+    """Who a request is from, for per-client build limits: the peer address.
+
+    The X-Client-Id header is used only with TRUST_CLIENT_ID_HEADER=1 (behind
+    a proxy or gateway that authenticates clients and sets it); otherwise any
+    caller could rotate it to get around the limits.
+    """
+    if os.getenv("TRUST_CLIENT_ID_HEADER", "0") == "1":
+        client_id = connection.headers.get("x-client-id")
+        if client_id:
+            return client_id[:128]
+    return connection.client.host if connection.client else "unknown"
+
+def _conversation(request: BuildRequest) -> Tuple[Optional[str], Optional[str]]:
+    """The base build and conversation context of a build request.
+
+    A build in a conversation refines the conversation's last completed
+    build, unless the request names another base.
+    """
+    if not request.chat_session_id:
+        return request.base_session_id, None
+    base_session_id = request.base_session_id
+    if base_session_id is None:
+        last = conversations.last_build(request.chat_session_id)
+        base_session_id = last[0] if last else None
+    return base_session_id, conversations.context(request.chat_session_id, base_session_id)
+
+def _submit_build(request: BuildRequest, client_id: str) -> str:
+    """Queue a build job, mapping queue errors to HTTP errors."""
+    base_session_id, conversation = _conversation(request)
+    base = _base_build(base_session_id)
+    options = _llm_options(request, base)
     try:
-        session_id = request.session_id or datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-        
-        # Initialize builder
-        builder = ModuleBasedAppBuilder()
-        
-        # Store session info
-        build_sessions[session_id] = {
-            "prompt": request.prompt,
-            "status": "building",
-            "started_at": datetime.utcnow().isoformat()
-        }
-        
-        # Build the app
-        builder.build_app(request.prompt)
-        
-        # Get the output directory
-        output_dir = str(builder.output_dir)
-        
-        # Collect generated files
-        files = []
-        for file_path in Path(output_dir).rglob("*"):
-            if file_path.is_file():
-                rel_path = str(file_path.relative_to(output_dir))
-                files.append({
-                    "path": rel_path,
-                    "name": file_path.name,
-                    "size": file_path.stat().st_size
-                })
-        
-        # Update session
-        build_sessions[session_id].update({
-            "status": "completed",
-            "output_dir": output_dir,
-            "files": files,
-            "completed_at": datetime.utcnow().isoformat()
-        })
-        
-        return BuildResponse(
-            session_id=session_id,
-            output_dir=output_dir,
-            status="completed",
-            message=f"Successfully generated {len(files)} files",
-            files=files
+        session_id = build_jobs.submit(
+            request.prompt, request.session_id, use_cache=request.use_cache, options=options,
+            base_session_id=base_session_id, client_id=client_id, conversation=conversation
         )
-        
-    except Exception as e:
-        if session_id in build_sessions:
-            build_sessions[session_id]["status"] = "failed"
-            build_sessions[session_id]["error"] = str(e)
-        
-        raise HTTPException(status_code=500, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if request.chat_session_id:
+        conversations.add_message(request.chat_session_id, "user", request.prompt,
+                                  build_session_id=session_id)
+    return session_id
+
+@app.post("/api/build")
+async def build_app(request: BuildRequest, http_request: Request):
+    """Build an app from a user prompt and wait for the result.
+
+    The build is cancelled if the client disconnects before it finishes.
+    """
+    session_id = _submit_build(request, _client_id(http_request))
+    future = build_jobs.get_future(session_id)
+    if future:
+        waiter = asyncio.wrap_future(future)
+        while not waiter.done():
+            await asyncio.wait({waiter}, timeout=1.0)
+            if not waiter.done() and await http_request.is_disconnected():
+                build_jobs.cancel(session_id)
+                # A coalesced request is detached at once; the shared build goes on
+                if build_jobs.get_future(session_id) is not None:
+                    await waiter
+                break
+
+    return _build_response(session_id, build_sessions.get(session_id))
+
+@app.post("/api/build/jobs", status_code=202)
+async def submit_build(request: BuildRequest, http_request: Request):
+    """Queue a build and return its session id immediately."""
+    session_id = _submit_build(request, _client_id(http_request))
+    return {"session_id": session_id, "status": build_sessions.get(session_id)["status"]}
+
+@app.get("/api/builds")
+async def list_builds(status: Optional[str] = None, limit: int = 50, offset: int = 0,
+                      since: Optional[float] = None, until: Optional[float] = None):
+    """List builds newest first, optionally by status and creation time (epoch seconds)."""
+    limit = max(1, min(limit, 200))
+    builds = build_sessions.list(status=status, limit=limit, offset=offset, since=since, until=until)
+    return {"builds": builds, "limit": limit, "offset": offset}
 
 @app.get("/api/build/{session_id}")
 async def get_build_status(session_id: str):
     """Get build status for a session."""
+    session = build_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    return session
+
+@app.post("/api/build/{session_id}/cancel")
+async def cancel_build(session_id: str):
+    """Cancel a queued or running build; its partial output is removed."""
+    if session_id not in build_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not build_jobs.cancel(session_id):
+        raise HTTPException(status_code=409, detail="Build already finished")
+
+    return {"session_id": session_id, "status": "cancelling"}
+
+@app.get("/api/build/{session_id}/wait")
+async def wait_for_build(session_id: str, timeout: float = 30.0):
+    """Wait up to `timeout` seconds for a build to finish, then return its status."""
     if session_id not in build_sessions:
         raise HTTPException(status_code=404, detail="Session not found")
+
+    future = build_jobs.get_future(session_id)
+    if future:
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    return build_sessions.get(session_id)
+
+async def _read_batch_request(request: Request) -> BatchRequest:
+    """A batch from a JSON body, or from a JSONL upload (one prompt per line,
+    as {"prompt": "..."} or a JSON string) with settings in the query string."""
+    content_type = request.headers.get("content-type", "")
+    try:
+        if "ndjson" in content_type or "jsonl" in content_type:
+            prompts = []
+            for line in (await request.body()).decode("utf-8").splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    prompts.append(entry["prompt"] if isinstance(entry, dict) else entry)
+            return BatchRequest(prompts=prompts, **dict(request.query_params))
+        return BatchRequest(**await request.json())
+    except (ValueError, KeyError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid batch: {e}")
+
+async def _stream_batch(batch_id: str, after: int = 0):
+    """NDJSON lines for a batch's results from position `after` until it ends."""
+    sent = after
+    while True:
+        batch = batch_jobs.get(batch_id)
+        results = batch["results"]
+        for position in range(sent, len(results)):
+            line = await asyncio.to_thread(batch_jobs.result, batch, results[position])
+            yield json.dumps({**line, "position": position}) + "\n"
+        sent = max(sent, len(results))
+        if batch["status"] in BATCH_FINISHED:
+            yield json.dumps({
+                "type": "done", "batch_id": batch_id, "status": batch["status"],
+                "results": len(results)
+            }) + "\n"
+            return
+        await asyncio.to_thread(batch_jobs.wait, batch_id, sent, 1.0)
+
+@app.post("/api/batch")
+async def create_batch(request: Request, stream: bool = True):
+    """Build many prompts, streaming each result as NDJSON as soon as it finishes.
+
+    Identical prompts are built once. The batch keeps running if the client
+    disconnects; resume with GET /api/batch/{batch_id}/results?after=N.
+    """
+    batch_request = await _read_batch_request(request)
+    options = _llm_options(batch_request)
+    try:
+        batch_id = batch_jobs.create(
+            batch_request.prompts, batch_request.concurrency,
+            use_cache=batch_request.use_cache, options=options, client_id=_client_id(request)
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    batch = batch_jobs.get(batch_id)
+    summary = {
+        "type": "batch", "batch_id": batch_id, "prompts": batch["prompts"],
+        "unique_prompts": len(batch["items"]), "concurrency": batch["concurrency"]
+    }
+    if not stream:
+        return JSONResponse(summary, status_code=202)
+    
+    async def body():
+        yield json.dumps(summary) + "\n"
+        async for line in _stream_batch(batch_id):
+            yield line
     
-    return build_sessions[session_id]
+    return StreamingResponse(body(), media_type="application/x-ndjson",
+                             headers={"X-Batch-Id": batch_id})
+
+def _get_batch(batch_id: str) -> Dict:
+    batch = batch_jobs.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+@app.get("/api/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    """Batch progress: per-status item counts and the items themselves."""
+    batch = _get_batch(batch_id)
+    counts: Dict[str, int] = {}
+    for item in batch["items"]:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    return {
+        "batch_id": batch_id,
+        "status": batch["status"],
+        "prompts": batch["prompts"],
+        "unique_prompts": len(batch["items"]),
+        "finished": len(batch["results"]),
+        "counts": counts,
+        "items": batch["items"],
+    }
+
+@app.get("/api/batch/{batch_id}/results")
+async def stream_batch_results(batch_id: str, after: int = 0):
+    """Stream a batch's results as NDJSON, skipping the first `after` (to resume)."""
+    _get_batch(batch_id)
+    return StreamingResponse(_stream_batch(batch_id, max(0, after)),
+                             media_type="application/x-ndjson")
+
+@app.post("/api/batch/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    """Stop scheduling a batch's remaining prompts and cancel its running builds."""
+    _get_batch(batch_id)
+    if not batch_jobs.cancel(batch_id):
+        raise HTTPException(status_code=409, detail="Batch is not running")
+    return {"batch_id": batch_id, "status": "cancelling"}
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Get LLM response cache hit/miss counters."""
+    cache = get_response_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.post("/api/build/{session_id}/pin")
+async def pin_build(session_id: str):
+    """Keep a build's output regardless of the retention policy."""
+    if build_sessions.get(session_id) is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    session = build_sessions.update(session_id, {"pinned": True})
+    output_retention.pin(session_id, session.get("output_dir"))
+    return {"session_id": session_id, "pinned": True}
+
+@app.delete("/api/build/{session_id}/pin")
+async def unpin_build(session_id: str):
+    """Let the retention policy expire a build's output again."""
+    if build_sessions.get(session_id) is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    build_sessions.update(session_id, {"pinned": False})
+    output_retention.unpin(session_id)
+    return {"session_id": session_id, "pinned": False}
+
+@app.get("/api/storage/stats")
+async def get_storage_stats():
+    """Blob store usage and the result of the last retention run."""
+    store = get_blob_store()
+    return {
+        "blob_store": await asyncio.to_thread(store.stats) if store else {"enabled": False},
+        "retention": {
+            "max_age_seconds": output_retention.max_age_seconds,
+            "max_bytes": output_retention.max_bytes,
+            "last_run": output_retention.last_run,
+        },
+    }
 
 @app.get("/api/files/{session_id}")
 async def list_files(session_id: str):
     """List all files in a build session."""
-    if session_id not in build_sessions:
+    session = _completed_session(session_id)
+    return {"files": session.get("files", [])}
+
+def _completed_session(session_id: str) -> Dict:
+    session = build_sessions.get(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    session = build_sessions[session_id]
+    if session.get("status") == "expired":
+        raise HTTPException(status_code=410, detail="Build output has expired")
     if "output_dir" not in session:
         raise HTTPException(status_code=400, detail="Build not completed")
+    return session
+
+def _file_manifest(session_id: str, session: Dict) -> Dict[str, Dict]:
+    """Manifest entries of a completed build keyed by path (cached per session)."""
+    # A session id can be reused for a later build, so key on its completion time too
+    key = (session_id, session.get("completed_at"))
+    manifest = _manifests.get(key)
+    if manifest is None:
+        manifest = {entry["path"]: entry for entry in session.get("files", [])}
+        _manifests[key] = manifest
+        while len(_manifests) > 256:
+            _manifests.popitem(last=False)
+    return manifest
+
+def _resolve_file(session_id: str, file_path: str):
+    """Find a generated file and its manifest entry, rejecting paths outside the build."""
+    session = _completed_session(session_id)
+    full_path = resolve_path(session["output_dir"], file_path)
+    if full_path is None:
+        raise HTTPException(status_code=400, detail="Invalid file path")
     
-    return {"files": session.get("files", [])}
+    entry = _file_manifest(session_id, session).get(file_path)
+    if entry is None:
+        if not full_path.is_file():
+            raise HTTPException(status_code=404, detail="File not found")
+        entry = describe_file(full_path, file_path)
+    return full_path, entry
 
 @app.get("/api/file/{session_id}/{file_path:path}")
-async def get_file_content(session_id: str, file_path: str):
-    """Get content of a specific file."""
-    if session_id not in build_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def get_file_content(session_id: str, file_path: str, request: Request):
+    """Get content of a specific file (honours If-None-Match)."""
+    full_path, entry = _resolve_file(session_id, file_path)
+    etag = etag_for(entry)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
     
-    session = build_sessions[session_id]
-    if "output_dir" not in session:
-        raise HTTPException(status_code=400, detail="Build not completed")
-    
-    full_path = Path(session["output_dir"]) / file_path
+    try:
+        content = await asyncio.to_thread(full_path.read_text, encoding="utf-8")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
     
-    if not full_path.exists():
+    return JSONResponse({
+        "path": file_path,
+        "content": content,
+        "size": entry["size"]
+    }, headers=headers)
+
+@app.get("/api/raw/{session_id}/{file_path:path}")
+async def get_raw_file(session_id: str, file_path: str, request: Request):
+    """Stream a generated file with ETag and single-range Range support."""
+    full_path, entry = _resolve_file(session_id, file_path)
+    if not full_path.is_file():
         raise HTTPException(status_code=404, detail="File not found")
     
+    etag = etag_for(entry)
+    size = entry["size"]
+    media_type = mimetypes.guess_type(full_path.name)[0] or "text/plain"
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Accept-Ranges": "bytes"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_file(full_path), media_type=media_type, headers=headers)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file(full_path, start, end), status_code=206, media_type=media_type, headers=headers
+    )
+
+@app.get("/api/download/{session_id}")
+async def download_build(session_id: str, format: str = "zip"):
+    """Download the whole generated app as a streamed zip or tar.gz archive."""
+    session = _completed_session(session_id)
+    if format not in ("zip", "tar.gz"):
+        raise HTTPException(status_code=400, detail="format must be 'zip' or 'tar.gz'")
+    
+    root_name = Path(session["output_dir"]).name
+    paths = sorted(_file_manifest(session_id, session))
+    if format == "zip":
+        body = iter_zip(session["output_dir"], paths, root_name)
+        media_type = "application/zip"
+    else:
+        body = iter_tar_gz(session["output_dir"], paths, root_name)
+        media_type = "application/gzip"
+    
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{root_name}.{format}"'
+    })
+
+async def _relay_build_events(websocket: WebSocket, session_id: str, events: asyncio.Queue):
+    """Send build events to the client until the build ends.
+
+    The client can send {"type": "cancel"} to stop the build; disconnecting
+    cancels it too.
+    """
+    incoming = asyncio.ensure_future(websocket.receive_json())
     try:
-        with open(full_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        return {
-            "path": file_path,
-            "content": content,
-            "size": full_path.stat().st_size
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
+        while True:
+            next_event = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({next_event, incoming}, return_when=asyncio.FIRST_COMPLETED)
+            
+            if incoming in done:
+                try:
+                    message = incoming.result()
+                except WebSocketDisconnect:
+                    next_event.cancel()
+                    build_jobs.cancel(session_id)
+                    raise
+                if isinstance(message, dict) and message.get("type") == "cancel":
+                    build_jobs.cancel(session_id)
+                incoming = asyncio.ensure_future(websocket.receive_json())
+            
+            if next_event not in done:
+                next_event.cancel()
+                continue
+            event = next_event.result()
+            await websocket.send_json(event)
+            if event["type"] in ("complete", "error", "cancelled"):
+                break
+    finally:
+        # Let the pending receive unwind before the caller reads the socket again
+        incoming.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await incoming
 
 @app.websocket("/ws/build")
 async def websocket_build(websocket: WebSocket):
@@ -212,7 +721,38 @@ async def websocket_build(websocket: WebSocket):
                 await websocket.send_json({"error": "No prompt provided"})
                 continue
             
-            session_id = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+            try:
+                request = BuildRequest(**{**data, "session_id": None})
+                base_session_id, conversation = _conversation(request)
+                options = _llm_options(request, _base_build(base_session_id))
+            except ValidationError as e:
+                await websocket.send_json({"type": "error", "message": str(e)})
+                continue
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "message": e.detail})
+                continue
+            
+            # Forward progress events from the build thread to this connection
+            loop = asyncio.get_running_loop()
+            events: asyncio.Queue = asyncio.Queue()
+            forward = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+            
+            try:
+                session_id = build_jobs.submit(
+                    prompt, use_cache=data.get("use_cache", True), listener=forward,
+                    options=options, base_session_id=base_session_id,
+                    client_id=_client_id(websocket), conversation=conversation
+                )
+            except QueueFullError as e:
+                await websocket.send_json({"type": "error", "message": str(e),
+                                           "retry_after": e.retry_after})
+                continue
+            except ValueError as e:
+                await websocket.send_json({"type": "error", "message": str(e)})
+                continue
+            if request.chat_session_id:
+                conversations.add_message(request.chat_session_id, "user", prompt,
+                                          build_session_id=session_id)
             
             # Send status update
             await websocket.send_json({
@@ -222,53 +762,34 @@ async def websocket_build(websocket: WebSocket):
             })
             
             try:
-                # Initialize builder
-                builder = ModuleBasedAppBuilder()
-                
-                await websocket.send_json({
-                    "type": "status",
-                    "message": "Analyzing prompt..."
-                })
-                
-                # Build the app
-                builder.build_app(prompt)
-                
-                # Get output directory
-                output_dir = str(builder.output_dir)
-                
-                # Collect files
-                files = []
-                for file_path in Path(output_dir).rglob("*"):
-                    if file_path.is_file():
-                        rel_path = str(file_path.relative_to(output_dir))
-                        files.append({
-                            "path": rel_path,
-                            "name": file_path.name
-                        })
-                
-                # Send completion
-                await websocket.send_json({
-                    "type": "complete",
-                    "session_id": session_id,
-                    "output_dir": output_dir,
-                    "files": files,
-                    "message": f"Successfully generated {len(files)} files"
-                })
-                
-            except Exception as e:
-                await websocket.send_json({
-                    "type": "error",
-                    "message": str(e)
-                })
+                await _relay_build_events(websocket, session_id, events)
+            finally:
+                build_jobs.remove_listener(session_id, forward)
     
     except WebSocketDisconnect:
         print("WebSocket disconnected")
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: stage latencies, LLM usage and build queue gauges.
+
+    With BUILD_EXECUTION=farm, worker processes' series are included with a
+    `worker` label.
+    """
+    text = metrics.REGISTRY.render(build_jobs.worker_metrics())
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
 # Serve static files for the frontend
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
+@app.get("/ready")
+async def readiness_check():
+    """200 once warm-up has loaded the registry and LLM client, 503 until then."""
+    status_code = 200 if warmup["status"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content=warmup)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,251 @@
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import uuid
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from blobstore import BlobStore
+
+CHUNK_SIZE = 64 * 1024
+STAGING_PREFIX = ".partial-"
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def describe_file(path: Path, rel_path: str, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """Manifest entry for a generated file."""
+    if sha256 is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+    stat = path.stat()
+    return {
+        "path": rel_path,
+        "name": path.name,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": sha256,
+    }
+
+
+def etag_for(entry: Dict[str, Any]) -> str:
+    if entry.get("sha256"):
+        return f'"{entry["sha256"][:32]}"'
+    return f'"{entry["size"]:x}-{int(entry.get("mtime", 0) * 1000):x}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def resolve_path(output_dir: str, rel_path: str) -> Optional[Path]:
+    """Resolve `rel_path` inside `output_dir`, or None if it escapes it."""
+    root = Path(output_dir).resolve()
+    full_path = (root / rel_path).resolve()
+    if full_path != root and root not in full_path.parents:
+        return None
+    return full_path
+
+
+class ArtifactWriter:
+    """Writes a build's files and publishes them all at once.
+
+    Files go to a hidden staging directory next to `output_dir`, written on
+    a background thread so generation threads don't wait on the disk. Each
+    file is written to a temp name and renamed into place (or hard-linked
+    from the blob store), and its manifest entry (size and hash) is
+    recorded as it is written. `publish` renames the staging directory to
+    `output_dir` once every file is committed, so readers never see a
+    partial build; `discard` throws the staged files away.
+    """
+
+    def __init__(self, output_dir: Path, blob_store: Optional["BlobStore"] = None):
+        self.output_dir = Path(output_dir)
+        self.staging_dir = self.output_dir.with_name(STAGING_PREFIX + self.output_dir.name)
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        self.blob_store = blob_store
+        self._dirs: Set[Path] = {self.staging_dir.resolve()}  # only touched by the writer thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artifact-writer")
+        self._pending: List[Future] = []
+
+    def _target(self, rel_path: str) -> Path:
+        target = resolve_path(str(self.staging_dir), rel_path)
+        if target is None or target == self.staging_dir.resolve():
+            raise ValueError(f"Invalid file path: {rel_path}")
+        if target.parent not in self._dirs:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            self._dirs.update(target.parents)
+        return target
+
+    def _submit(self, fn: Callable[..., Dict[str, Any]], *args: Any,
+                on_written: Optional[Callable[[Dict[str, Any]], None]] = None) -> Future:
+        future = self._executor.submit(fn, *args)
+        if on_written is not None:
+            def _done(f: Future) -> None:
+                if not f.cancelled() and f.exception() is None:
+                    on_written(f.result())
+            future.add_done_callback(_done)
+        self._pending.append(future)
+        return future
+
+    def write(self, rel_path: str, data: bytes, sha256: Optional[str] = None,
+              on_written: Optional[Callable[[Dict[str, Any]], None]] = None) -> Future:
+        """Queue a file; the future (and `on_written`) get its manifest entry."""
+        return self._submit(self._write, rel_path, data, sha256, on_written=on_written)
+
+    def link(self, rel_path: str, source: Path, sha256: Optional[str] = None,
+             on_written: Optional[Callable[[Dict[str, Any]], None]] = None) -> Future:
+        """Queue a hard link (or copy) of an existing file."""
+        return self._submit(self._link, rel_path, source, sha256, on_written=on_written)
+
+    def _write(self, rel_path: str, data: bytes, sha256: Optional[str]) -> Dict[str, Any]:
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        target = self._target(rel_path)
+        if self.blob_store is not None:
+            self.blob_store.materialize(data, target, sha256)
+        else:
+            tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, target)
+        return describe_file(target, rel_path, sha256=sha256)
+
+    def _link(self, rel_path: str, source: Path, sha256: Optional[str]) -> Dict[str, Any]:
+        target = self._target(rel_path)
+        tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copy2(source, tmp)
+        os.replace(tmp, target)
+        return describe_file(target, rel_path, sha256=sha256)
+
+    def flush(self) -> None:
+        """Wait for queued files; raises the first write error."""
+        pending, self._pending = self._pending, []
+        wait(pending)
+        for future in pending:
+            future.result()
+
+    def publish(self) -> None:
+        """Commit every queued file, then make the build visible at `output_dir`."""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+        # Replaces the empty directory that reserved the name
+        os.replace(self.staging_dir, self.output_dir)
+
+    def discard(self) -> None:
+        """Drop queued and staged files."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending = []
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range `Range` header into an inclusive (start, end).
+
+    Returns None for headers we don't support (serve the whole file) and
+    raises ValueError for unsatisfiable ranges.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+def iter_file(path: Path, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """Yield a file's bytes (inclusive range) in fixed-size chunks."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._offset = 0
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+            self._offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        chunks, self._chunks = self._chunks, []
+        return iter(chunks)
+
+
+def iter_zip(output_dir: str, paths: Iterable[str], root_name: str) -> Iterator[bytes]:
+    """Stream a zip of the given files without building it in memory."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for rel_path in paths:
+            full_path = resolve_path(output_dir, rel_path)
+            if full_path is None or not full_path.is_file():
+                continue
+            with archive.open(f"{root_name}/{rel_path}", mode="w") as dest:
+                for chunk in iter_file(full_path):
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def iter_tar_gz(output_dir: str, paths: Iterable[str], root_name: str) -> Iterator[bytes]:
+    """Stream a .tar.gz of the given files without building it in memory.
+
+    tarfile copies each member in one call, so at most one (compressed)
+    file is held before it is yielded.
+    """
+    sink = _ChunkSink()
+    with tarfile.open(fileobj=sink, mode="w|gz") as archive:
+        for rel_path in paths:
+            full_path = resolve_path(output_dir, rel_path)
+            if full_path is None or not full_path.is_file():
+                continue
+            info = archive.gettarinfo(str(full_path), arcname=f"{root_name}/{rel_path}")
+            with open(full_path, "rb") as f:
+                archive.addfile(info, f)
+            yield from sink.drain()
+    yield from sink.drain()
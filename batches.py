@@ -0,0 +1,284 @@
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from cache import normalize_prompt
+from jobs import INTERRUPTED_ERROR, PUBLISHED, BuildJobManager, QueueFullError, _instance_alive, instance_id
+from sessions import SessionStore
+
+FINISHED = ("completed", "cancelled")
+
+
+def new_batch_id() -> str:
+    timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    return f"batch-{timestamp}-{uuid.uuid4().hex[:6]}"
+
+
+class BatchManager:
+    """Run many prompts as one batch on the shared build worker pool.
+
+    Identical prompts (ignoring case and whitespace) are built once. At most
+    `concurrency` builds of a batch are queued or running at a time, so one
+    batch can't starve interactive builds. Batch state, including the order
+    in which prompts finished, lives in `store`, so results can be streamed
+    again (or resumed) after a client disconnects.
+
+    A batch's builds count against the requesting client's share of the
+    build queue, and each client may have at most `max_per_client` batches
+    running, so opening more batches doesn't buy more builds in flight.
+
+    Each batch is scheduled by a thread in the process that created it;
+    batches left behind by a dead process are resumed by `recover_interrupted`.
+    """
+
+    def __init__(self, jobs: BuildJobManager, store: SessionStore,
+                 max_prompts: Optional[int] = None, default_concurrency: Optional[int] = None,
+                 max_per_client: Optional[int] = None):
+        self.jobs = jobs
+        self.store = store
+        self.max_prompts = max_prompts or int(os.getenv("BATCH_MAX_PROMPTS", "1000"))
+        self.default_concurrency = default_concurrency or int(os.getenv("BATCH_CONCURRENCY", "4"))
+        self.max_per_client = (
+            max_per_client if max_per_client is not None
+            else int(os.getenv("BATCH_MAX_PER_CLIENT", "2"))
+        )
+        self._batches: Dict[str, Dict[str, Any]] = {}  # batches scheduled by this process
+        self._changed = threading.Condition()
+
+    def create(self, prompts: List[str], concurrency: Optional[int] = None,
+               use_cache: bool = True, options: Optional[Dict[str, Any]] = None,
+               client_id: Optional[str] = None) -> str:
+        """Start a batch for `client_id` and return its id.
+
+        Raises ValueError for bad input, and QueueFullError when the client
+        already has `max_per_client` batches running.
+        """
+        prompts = [p for p in prompts if p and p.strip()]
+        if not prompts:
+            raise ValueError("No prompts provided")
+        if len(prompts) > self.max_prompts:
+            raise ValueError(f"A batch may contain at most {self.max_prompts} prompts")
+
+        items: Dict[str, Dict[str, Any]] = {}
+        for index, prompt in enumerate(prompts):
+            key = normalize_prompt(prompt)
+            if key not in items:
+                items[key] = {"prompt": prompt, "indices": [], "session_id": None, "status": "pending"}
+            items[key]["indices"].append(index)
+
+        concurrency = max(1, min(concurrency or self.default_concurrency, self.jobs.max_workers,
+                                 self.jobs.max_per_client or self.jobs.max_workers))
+        batch_id = new_batch_id()
+        batch = {
+            "status": "running",
+            "created_at": datetime.utcnow().isoformat(),
+            "worker_instance": instance_id(),
+            "client_id": client_id,
+            "prompts": len(prompts),
+            "concurrency": concurrency,
+            "use_cache": use_cache,
+            "options": options or {},
+            "items": list(items.values()),
+            "results": [],  # item indexes, in the order they finished
+        }
+        with self._changed:
+            if client_id and self.max_per_client \
+                    and self._client_batches(client_id) >= self.max_per_client:
+                raise QueueFullError(
+                    f"Too many batches in progress for this client (limit {self.max_per_client})",
+                    max(1, math.ceil(self.jobs._avg_build_seconds)), reason="client_limit"
+                )
+            self._start(batch_id, batch)
+        return batch_id
+
+    def _client_batches(self, client_id: str) -> int:
+        """Batches of `client_id` still running, in any process."""
+        return sum(
+            1 for status in ("running", "cancelling")
+            for batch in self.store.list(status=status, limit=1000)
+            if batch.get("client_id") == client_id
+        )
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._changed:
+            batch = self._batches.get(batch_id)
+            if batch is not None:
+                return {**batch, "items": [dict(i) for i in batch["items"]],
+                        "results": list(batch["results"])}
+        return self.store.get(batch_id)
+
+    def wait(self, batch_id: str, seen: int, timeout: float) -> None:
+        """Block until the batch has more than `seen` results, ends, or `timeout` passes."""
+        with self._changed:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                # Scheduled by another process; the caller polls the store
+                self._changed.wait(timeout)
+                return
+            self._changed.wait_for(
+                lambda: len(batch["results"]) > seen or batch["status"] in FINISHED, timeout
+            )
+
+    def cancel(self, batch_id: str) -> bool:
+        """Stop scheduling a batch and cancel its running builds."""
+        with self._changed:
+            batch = self._batches.get(batch_id)
+            if batch is None or batch["status"] in FINISHED:
+                return False
+            batch["status"] = "cancelling"
+            running = [i["session_id"] for i in batch["items"] if i["status"] == "building"]
+            self._persist(batch_id, batch)
+            self._changed.notify_all()
+        for session_id in running:
+            self.jobs.cancel(session_id)
+        return True
+
+    def result(self, batch: Dict[str, Any], item_index: int) -> Dict[str, Any]:
+        """NDJSON result line for one finished item."""
+        item = batch["items"][item_index]
+        line = {
+            "type": "result",
+            "item": item_index,
+            "indices": item["indices"],
+            "prompt": item["prompt"],
+            "session_id": item["session_id"],
+            "status": item["status"],
+        }
+        session = self.jobs.sessions.get(item["session_id"]) if item["session_id"] else None
+        if session and item["status"] in PUBLISHED:
+            line["output_dir"] = session.get("output_dir")
+            line["files"] = [f["path"] for f in session.get("files", [])]
+            line["failed_files"] = session.get("failed_files", [])
+        elif session and session.get("error"):
+            line["error"] = session["error"]
+        return line
+
+    def recover_interrupted(self) -> int:
+        """Resume running batches whose scheduling process has died.
+
+        Every process runs this at startup; a batch is claimed by
+        compare-and-set on its owner, so only one of them resumes it.
+        """
+        recovered = 0
+        for status in ("running", "cancelling"):
+            for listed in self.store.list(status=status, limit=1000):
+                if _instance_alive(listed):
+                    continue
+                batch_id = listed["session_id"]
+                owner = (listed.get("worker_instance"), listed.get("worker_pid"))
+                batch = self.store.update_if(
+                    batch_id, {"worker_instance": instance_id(), "worker_pid": None},
+                    lambda data: data.get("status") == status
+                    and (data.get("worker_instance"), data.get("worker_pid")) == owner
+                )
+                if batch is None:
+                    continue  # claimed by another process first
+                batch.pop("worker_pid", None)
+                if status == "cancelling":
+                    batch["status"] = "cancelled"
+                    self.store.put(batch_id, batch)
+                    continue
+                for index, item in enumerate(batch["items"]):
+                    if item["status"] != "building":
+                        continue
+                    session = self.jobs.sessions.get(item["session_id"]) or {}
+                    if session.get("status") in (None, "queued", "building") \
+                            or session.get("error") == INTERRUPTED_ERROR:
+                        item.update(status="pending", session_id=None)
+                    else:
+                        item["status"] = session["status"]
+                        batch["results"].append(index)
+                self._start(batch_id, batch)
+                recovered += 1
+        return recovered
+
+    def _start(self, batch_id: str, batch: Dict[str, Any]) -> None:
+        with self._changed:
+            self._batches[batch_id] = batch
+            self._persist(batch_id, batch)
+        threading.Thread(
+            target=self._schedule, args=(batch_id,), name=f"batch-{batch_id[-6:]}", daemon=True
+        ).start()
+
+    def _persist(self, batch_id: str, batch: Dict[str, Any]) -> None:
+        # Called with self._changed held
+        self.store.put(batch_id, batch)
+
+    def _schedule(self, batch_id: str) -> None:
+        batch = self._batches[batch_id]
+        slots = threading.Semaphore(batch["concurrency"])
+        try:
+            for index, item in enumerate(batch["items"]):
+                if item["status"] != "pending":
+                    continue
+                slots.acquire()
+                if batch["status"] != "running":
+                    slots.release()
+                    break
+                session_id = self._submit(batch_id, batch, item)
+                if session_id is None:
+                    slots.release()
+                    break
+                future = self.jobs.get_future(session_id)
+                if future is None:
+                    self._item_done(batch_id, batch, index, slots)
+                else:
+                    future.add_done_callback(
+                        lambda future, index=index: self._item_done(
+                            batch_id, batch, index, slots, future
+                        )
+                    )
+
+            # Wait for the builds still in flight
+            for _ in range(batch["concurrency"]):
+                slots.acquire()
+        except Exception as e:
+            print(f"Batch {batch_id} failed: {e}")
+        finally:
+            with self._changed:
+                for index, item in enumerate(batch["items"]):
+                    if item["status"] == "pending":
+                        item["status"] = "cancelled"
+                        batch["results"].append(index)
+                batch["status"] = "cancelled" if batch["status"] == "cancelling" else "completed"
+                batch["completed_at"] = datetime.utcnow().isoformat()
+                self._persist(batch_id, batch)
+                self._changed.notify_all()
+                self._batches.pop(batch_id, None)
+
+    def _submit(self, batch_id: str, batch: Dict[str, Any], item: Dict[str, Any]) -> Optional[str]:
+        """Queue one item's build, waiting while the build queue is full."""
+        while batch["status"] == "running":
+            try:
+                session_id = self.jobs.submit(
+                    item["prompt"], use_cache=batch["use_cache"], options=batch["options"],
+                    client_id=batch.get("client_id") or batch_id
+                )
+            except QueueFullError:
+                time.sleep(0.5)
+                continue
+            with self._changed:
+                item.update(session_id=session_id, status="building")
+                self._persist(batch_id, batch)
+            return session_id
+        return None
+
+    def _item_done(self, batch_id: str, batch: Dict[str, Any], index: int,
+                   slots: threading.Semaphore, future: Optional[Future] = None) -> None:
+        item = batch["items"][index]
+        if future is not None and future.cancelled():
+            # Called from cancel() itself, before the session is updated
+            status = "cancelled"
+        else:
+            status = (self.jobs.sessions.get(item["session_id"]) or {}).get("status", "failed")
+        with self._changed:
+            item["status"] = status
+            batch["results"].append(index)
+            self._persist(batch_id, batch)
+            self._changed.notify_all()
+        slots.release()
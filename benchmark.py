@@ -0,0 +1,464 @@
+"""Offline load/latency benchmarks for the build pipeline.
+
+Builds run against fake_gemini.FakeGenerativeModel (via llm.LocalBackend), so no API key or
+network access is needed and results reflect the Python side only.
+
+    python benchmark.py --quick --output bench_report.json
+    python benchmark.py --latency 0.8 --jitter 0.3 --distribution lognormal --clients 16
+
+Scenarios:
+  overhead  build_app with an instant model; per-stage time is pure overhead
+  build     end-to-end build_app latency with the simulated model latency
+  http      POST /api/build throughput with N concurrent clients
+  ws        /ws/build throughput with N concurrent connections
+  startup   cold starts of the API in fresh processes: import time, time until
+            /health answers and time until /ready reports the warm-up done
+
+The HTTP and WebSocket scenarios also sample event-loop lag in the server.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from fake_gemini import FakeGenerativeModel
+from llm import LocalBackend
+
+ROOT = Path(__file__).resolve().parent
+MODULES_PATH = str(ROOT / "modules.json")
+
+PROMPTS = [
+    "build a basic user account management app: register/login users, persist profiles, edit profile details, and sync to Firebase.",
+    "landing page with hero section and image gallery",
+    "photo sharing app where users upload pictures to cloud storage and browse them in a gallery",
+    "marketing site with a headline, feature highlights and a call to action",
+    "sign up and sign in screens backed by email/password auth",
+    "drag and drop image upload with progress bar",
+]
+
+LAG_INTERVAL = 0.01
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Count, mean and percentiles (seconds) of a sample."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))
+        return ordered[index]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+
+def _prompt(index: int) -> str:
+    # Distinct prompts per run so the fake model's outputs vary
+    return f"{PROMPTS[index % len(PROMPTS)]} (run {index})"
+
+
+def _merge_timings(total: Dict[str, Dict[str, float]], timings: Dict[str, Dict[str, float]]) -> None:
+    for stage, timing in timings.items():
+        merged = total.setdefault(stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        merged["count"] += timing["count"]
+        merged["total_seconds"] += timing["total_seconds"]
+        merged["max_seconds"] = max(merged["max_seconds"], timing["max_seconds"])
+
+
+def bench_build(model_options: Dict[str, Any], runs: int) -> Dict[str, Any]:
+    """Sequential build_app runs; latency plus the per-stage breakdown."""
+    from test import ModuleBasedAppBuilder
+
+    model = FakeGenerativeModel(**model_options)
+    backend = LocalBackend(model)
+    latencies: List[float] = []
+    stages: Dict[str, Dict[str, float]] = {}
+    failures = 0
+    for i in range(runs):
+        builder = ModuleBasedAppBuilder(modules_path=MODULES_PATH, backend=backend)
+        started = time.perf_counter()
+        try:
+            builder.build_app(_prompt(i), use_cache=False)
+        except Exception:
+            failures += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        failures += len(builder.failed_files)
+        _merge_timings(stages, builder.timings)
+
+    for timing in stages.values():
+        timing["mean_seconds"] = timing["total_seconds"] / max(1, timing["count"])
+    return {
+        "runs": runs,
+        "failures": failures,
+        "latency": summarize(latencies),
+        "stages": stages,
+        "llm_calls": model.calls,
+        "llm_simulated_seconds": model.total_latency,
+    }
+
+
+class _Server:
+    """The FastAPI app served by uvicorn on a background thread."""
+
+    def __init__(self, model: FakeGenerativeModel):
+        import uvicorn
+
+        import app as app_module
+        from test import ModuleBasedAppBuilder
+
+        self.lag_samples: List[float] = []
+        self._sampling = False
+        backend = LocalBackend(model)
+        app_module.build_jobs.builder_factory = (
+            lambda **options: ModuleBasedAppBuilder(modules_path=MODULES_PATH, backend=backend,
+                                                    **options)
+        )
+        app_module.app.router.on_startup.append(self._start_lag_probe)
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        config = uvicorn.Config(app_module.app, host="127.0.0.1", port=self.port,
+                                log_level="warning", lifespan="on")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, name="bench-server", daemon=True)
+
+    async def _start_lag_probe(self) -> None:
+        async def probe():
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(LAG_INTERVAL)
+                if self._sampling:
+                    self.lag_samples.append(max(0.0, time.perf_counter() - started - LAG_INTERVAL))
+
+        asyncio.get_running_loop().create_task(probe())
+
+    @contextlib.contextmanager
+    def measure_lag(self):
+        """Collect lag samples only while the block runs; yields the sample list."""
+        self.lag_samples = []
+        self._sampling = True
+        try:
+            yield self.lag_samples
+        finally:
+            self._sampling = False
+
+    def __enter__(self) -> "_Server":
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("Benchmark server failed to start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._server.should_exit = True
+        self._thread.join(timeout=30)
+
+
+async def _run_clients(clients: int, builds_per_client: int,
+                       one_build: Callable[[int], Any]) -> Dict[str, Any]:
+    latencies: List[float] = []
+    failures = 0
+
+    async def client(c: int):
+        nonlocal failures
+        for b in range(builds_per_client):
+            started = time.perf_counter()
+            try:
+                ok = await one_build(c * builds_per_client + b)
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(clients)))
+    elapsed = time.perf_counter() - started
+    return {
+        "clients": clients,
+        "builds": clients * builds_per_client,
+        "failures": failures,
+        "wall_seconds": elapsed,
+        "builds_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": summarize(latencies),
+    }
+
+
+def bench_http(server: _Server, clients: int, builds_per_client: int) -> Dict[str, Any]:
+    import httpx
+
+    async def run():
+        limits = httpx.Limits(max_connections=clients)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{server.port}",
+                                     timeout=600, limits=limits) as http:
+            async def one_build(index: int) -> bool:
+                response = await http.post("/api/build", json={
+                    "prompt": _prompt(index), "use_cache": False
+                })
+                return response.status_code == 200
+
+            return await _run_clients(clients, builds_per_client, one_build)
+
+    with server.measure_lag() as lag:
+        report = asyncio.run(run())
+    report["event_loop_lag"] = summarize(lag)
+    return report
+
+
+def bench_ws(server: _Server, clients: int, builds_per_client: int) -> Dict[str, Any]:
+    import websockets
+
+    first_file: List[float] = []
+
+    async def one_build(index: int) -> bool:
+        async with websockets.connect(f"ws://127.0.0.1:{server.port}/ws/build",
+                                      max_size=None) as ws:
+            started = time.perf_counter()
+            await ws.send(json.dumps({"prompt": _prompt(index), "use_cache": False}))
+            seen_file = False
+            while True:
+                event = json.loads(await ws.recv())
+                if event.get("type") == "file_written" and not seen_file:
+                    seen_file = True
+                    first_file.append(time.perf_counter() - started)
+                if event.get("type") == "complete":
+                    return True
+                if event.get("type") in ("error", "cancelled"):
+                    return False
+
+    with server.measure_lag() as lag:
+        report = asyncio.run(_run_clients(clients, builds_per_client, one_build))
+    report["time_to_first_file"] = summarize(first_file)
+    report["event_loop_lag"] = summarize(lag)
+    return report
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(http: Any, url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    """Poll `url` until it returns 200."""
+    import httpx
+
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if http.get(url).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def bench_startup(runs: int) -> Dict[str, Any]:
+    """Cold starts in fresh interpreters, on the offline backend."""
+    import httpx
+
+    env = {**os.environ, "LLM_BACKEND": "local",
+           "PYTHONPATH": os.pathsep.join(filter(None, [str(ROOT), os.getenv("PYTHONPATH")]))}
+    import_code = ("import time; started = time.perf_counter(); import app; "
+                   "print(time.perf_counter() - started)")
+    imports: List[float] = []
+    first_request: List[float] = []
+    ready: List[float] = []
+    failures = 0
+    http = httpx.Client(timeout=1.0)
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", import_code], env=env,
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            imports.append(float(result.stdout.strip().splitlines()[-1]))
+
+        port = _free_port()
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+             "--port", str(port), "--log-level", "warning"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            _wait_for(http, f"http://127.0.0.1:{port}/health", process)
+            first_request.append(time.perf_counter() - started)
+            _wait_for(http, f"http://127.0.0.1:{port}/ready", process)
+            ready.append(time.perf_counter() - started)
+        except (RuntimeError, TimeoutError):
+            failures += 1
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    http.close()
+
+    return {
+        "runs": runs,
+        "failures": failures,
+        "import": summarize(imports),
+        "latency": summarize(first_request),  # process start until /health answers
+        "ready": summarize(ready),
+    }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    model_options = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "distribution": args.distribution,
+        "failure_rate": args.failure_rate,
+        "seed": args.seed,
+        "files_per_build": args.files,
+    }
+    report: Dict[str, Any] = {
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {**model_options, "runs": args.runs, "clients": args.clients,
+                   "builds_per_client": args.builds_per_client, "startup_runs": args.startup_runs},
+        "scenarios": {},
+    }
+    scenarios = report["scenarios"]
+
+    if "overhead" in args.scenarios:
+        scenarios["overhead"] = bench_build({**model_options, "latency": 0.0, "failure_rate": 0.0},
+                                            args.runs)
+    if "build" in args.scenarios:
+        scenarios["build"] = bench_build(model_options, args.runs)
+    if {"http", "ws"} & set(args.scenarios):
+        model = FakeGenerativeModel(**model_options)
+        with _Server(model) as server:
+            if "http" in args.scenarios:
+                scenarios["http"] = bench_http(server, args.clients, args.builds_per_client)
+            if "ws" in args.scenarios:
+                scenarios["ws"] = bench_ws(server, args.clients, args.builds_per_client)
+    if "startup" in args.scenarios:
+        scenarios["startup"] = bench_startup(args.startup_runs)
+    return report
+
+
+def check_thresholds(report: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    """Threshold violations, for failing CI on regressions."""
+    problems = []
+    overhead = report["scenarios"].get("overhead", {}).get("latency", {})
+    if args.max_overhead_ms is not None and overhead.get("p95") is not None:
+        if overhead["p95"] * 1000 > args.max_overhead_ms:
+            problems.append(f"overhead p95 {overhead['p95'] * 1000:.1f}ms > {args.max_overhead_ms}ms")
+    if args.max_loop_lag_ms is not None:
+        for name in ("http", "ws"):
+            lag = report["scenarios"].get(name, {}).get("event_loop_lag", {})
+            if lag.get("p95") is not None and lag["p95"] * 1000 > args.max_loop_lag_ms:
+                problems.append(f"{name} event loop lag p95 {lag['p95'] * 1000:.1f}ms "
+                                f"> {args.max_loop_lag_ms}ms")
+    startup = report["scenarios"].get("startup", {}).get("latency", {})
+    if args.max_startup_ms is not None and startup.get("p95") is not None:
+        if startup["p95"] * 1000 > args.max_startup_ms:
+            problems.append(f"time to first request p95 {startup['p95'] * 1000:.1f}ms "
+                            f"> {args.max_startup_ms}ms")
+    return problems
+
+
+def _print_summary(report: Dict[str, Any]) -> None:
+    def ms(summary: Dict[str, float], key: str) -> str:
+        return f"{summary[key] * 1000:.1f}ms" if key in summary else "-"
+
+    for name, result in report["scenarios"].items():
+        latency = result["latency"]
+        line = f"{name:9} p50 {ms(latency, 'p50')}  p95 {ms(latency, 'p95')}  failures {result['failures']}"
+        if "builds_per_second" in result:
+            line += (f"  {result['builds_per_second']:.2f} builds/s"
+                     f"  loop lag p95 {ms(result['event_loop_lag'], 'p95')}")
+        print(line)
+        if name == "startup":
+            print(f"    import p50 {ms(result['import'], 'p50')}"
+                  f"  ready p50 {ms(result['ready'], 'p50')}  p95 {ms(result['ready'], 'p95')}")
+        if name == "overhead":
+            for stage, timing in sorted(result["stages"].items()):
+                print(f"    {stage:22} mean {timing['mean_seconds'] * 1000:.2f}ms  x{timing['count']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", default=["overhead", "build", "http", "ws", "startup"],
+                        choices=["overhead", "build", "http", "ws", "startup"])
+    parser.add_argument("--latency", type=float, default=0.5, help="mean seconds per model call")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--distribution", default="uniform", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--files", type=int, default=6, help="files per generated app")
+    parser.add_argument("--runs", type=int, default=10, help="build_app runs per scenario")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent API clients")
+    parser.add_argument("--builds-per-client", type=int, default=3)
+    parser.add_argument("--startup-runs", type=int, default=5, help="cold starts to measure")
+    parser.add_argument("--quick", action="store_true", help="small, fast preset for CI")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--max-overhead-ms", type=float, help="fail if overhead p95 exceeds this")
+    parser.add_argument("--max-loop-lag-ms", type=float, help="fail if event loop lag p95 exceeds this")
+    parser.add_argument("--max-startup-ms", type=float,
+                        help="fail if time to first request p95 exceeds this")
+    parser.add_argument("--verbose", action="store_true", help="keep the builder's console output")
+    args = parser.parse_args()
+    if args.quick:
+        args.latency, args.jitter = min(args.latency, 0.05), min(args.jitter, 0.02)
+        args.runs, args.clients, args.builds_per_client = 3, 4, 1
+        args.startup_runs = min(args.startup_runs, 2)
+
+    # Isolated outputs and in-memory state; must be set before app/test are imported
+    os.environ["RESPONSE_CACHE"] = "0"
+    os.environ["SESSION_STORE"] = "memory"
+    # Every simulated client shares one address
+    os.environ["BUILD_MAX_PER_CLIENT"] = "0"
+    output = Path(args.output).resolve() if args.output else None
+    workdir = tempfile.mkdtemp(prefix="toshokan-bench-")
+    previous_dir = os.getcwd()
+    # The API loads modules.json from its working directory
+    shutil.copy(MODULES_PATH, workdir)
+    os.chdir(workdir)
+    try:
+        with open(os.devnull, "w") as devnull:
+            quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+            with quiet:
+                report = run(args)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    problems = check_thresholds(report, args)
+    report["threshold_violations"] = problems
+    if output:
+        output.write_text(json.dumps(report, indent=2))
+    _print_summary(report)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
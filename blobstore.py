@@ -0,0 +1,361 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from artifacts import STAGING_PREFIX
+from jobs import PUBLISHED
+from sessions import SessionStore
+
+# Output directories of pinned builds, kept under the outputs directory
+PINS_FILE = ".pinned.json"
+
+
+class BlobStore:
+    """Content-addressed file store: each distinct content is kept once.
+
+    Build directories are made of hard links to the blobs, so identical
+    files (main.py, embedded module code) share disk space across builds.
+    A blob whose only link is the store's own is unreferenced and can be
+    reclaimed by `sweep`. Blobs are read-only; files are replaced, never
+    rewritten in place.
+    """
+
+    def __init__(self, root: str, grace_seconds: float = 3600.0):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.grace_seconds = grace_seconds
+        self._stats = {"writes": 0, "dedup_hits": 0, "copies": 0, "swept": 0, "swept_bytes": 0}
+        self._lock = threading.Lock()
+
+    def _path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += amount
+
+    def put(self, data: bytes, sha256: Optional[str] = None) -> Path:
+        """Store `data` (if not already stored) and return its blob path."""
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        path = self._path(sha256)
+        if path.exists():
+            # Refresh the grace period so a concurrent sweep leaves it alone
+            os.utime(path)
+            self._count("dedup_hits")
+            return path
+
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f".{sha256}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+        self._count("writes")
+        return path
+
+    def materialize(self, data: bytes, target: Path, sha256: Optional[str] = None) -> None:
+        """Make `target` a hard link to the blob for `data`.
+
+        Falls back to writing a plain copy where hard links aren't possible
+        (e.g. another filesystem).
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        if target.exists() or target.is_symlink():
+            target.unlink()
+        for _ in range(2):
+            blob = self.put(data, sha256)
+            try:
+                os.link(blob, target)
+                return
+            except FileNotFoundError:
+                continue  # swept between put and link; store it again
+            except OSError:
+                break
+        with open(target, "wb") as f:
+            f.write(data)
+        self._count("copies")
+
+    def release(self, sha256: str) -> int:
+        """Delete a blob nothing links to any more; returns the bytes freed."""
+        path = self._path(sha256)
+        try:
+            stat = path.stat()
+            if stat.st_nlink > 1:
+                return 0
+            path.unlink()
+        except FileNotFoundError:
+            return 0
+        self._count("swept")
+        self._count("swept_bytes", stat.st_size)
+        return stat.st_size
+
+    def _blobs(self) -> Iterator[Path]:
+        for shard in self.root.iterdir():
+            if shard.is_dir():
+                yield from shard.iterdir()
+
+    def sweep(self) -> int:
+        """Delete unreferenced blobs (and stale temp files) past the grace period."""
+        cutoff = time.time() - self.grace_seconds
+        freed = 0
+        for path in self._blobs():
+            try:
+                stat = path.stat()
+                if stat.st_mtime >= cutoff:
+                    continue
+                if path.name.endswith(".tmp") or stat.st_nlink <= 1:
+                    path.unlink()
+                    freed += stat.st_size
+                    self._count("swept")
+            except FileNotFoundError:
+                continue
+        self._count("swept_bytes", freed)
+        return freed
+
+    def total_bytes(self) -> int:
+        total = 0
+        for path in self._blobs():
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                continue
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        blobs = 0
+        total = 0
+        for path in self._blobs():
+            try:
+                total += path.stat().st_size
+                blobs += 1
+            except FileNotFoundError:
+                continue
+        with self._lock:
+            return {**self._stats, "blobs": blobs, "bytes": total}
+
+
+class OutputRetention:
+    """Retention policy for generated apps under the outputs directory.
+
+    Completed builds older than `max_age_seconds`, or the oldest ones while
+    the blob store holds more than `max_bytes`, are expired: their output
+    directory is removed and their session marked ``expired``. Pinned builds
+    (``pinned`` in the session, or listed in `pinned`) are kept. Sessions
+    sharing an output directory (coalesced builds) are expired together,
+    only once none of them is pinned or still within the max age. Output
+    directories no session refers to, and staging directories left by
+    crashed builds, are removed once past the max age.
+    0 disables a limit.
+
+    Pinned builds' output directories are also recorded in PINS_FILE, so
+    they are never removed as orphans, even if the session is lost (e.g.
+    the memory session store restarting).
+    """
+
+    def __init__(self, sessions: SessionStore, output_root: Path,
+                 store: Optional[BlobStore] = None, max_age_seconds: float = 0,
+                 max_bytes: int = 0, pinned: Optional[List[str]] = None):
+        self.sessions = sessions
+        self.output_root = Path(output_root)
+        self.store = store
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned or [])
+        self.last_run: Dict[str, Any] = {}
+        self._pins_path = self.output_root / PINS_FILE
+        self._pins_lock = threading.Lock()
+
+    def _load_pins(self) -> Dict[str, str]:
+        try:
+            with open(self._pins_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_pins(self, pins: Dict[str, str]) -> None:
+        self.output_root.mkdir(parents=True, exist_ok=True)
+        tmp = self._pins_path.with_name(f"{PINS_FILE}.{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps(pins, indent=2), encoding="utf-8")
+        os.replace(tmp, self._pins_path)
+
+    def pin(self, session_id: str, output_dir: Optional[str]) -> None:
+        """Record a pinned build's output directory (once it has one)."""
+        if not output_dir:
+            return
+        with self._pins_lock:
+            pins = self._load_pins()
+            pins[session_id] = str(Path(output_dir).resolve())
+            self._save_pins(pins)
+
+    def unpin(self, session_id: str) -> None:
+        with self._pins_lock:
+            pins = self._load_pins()
+            if pins.pop(session_id, None) is not None:
+                self._save_pins(pins)
+
+    def _completed_builds(self) -> List[Dict[str, Any]]:
+        builds: List[Dict[str, Any]] = []
+        for status in PUBLISHED:
+            offset = 0
+            while True:
+                batch = self.sessions.list(status=status, limit=500, offset=offset)
+                builds.extend(batch)
+                if len(batch) < 500:
+                    break
+                offset += len(batch)
+        return builds
+
+    @staticmethod
+    def _age(build: Dict[str, Any], now: datetime) -> float:
+        try:
+            return (now - datetime.fromisoformat(build["completed_at"])).total_seconds()
+        except (KeyError, TypeError, ValueError):
+            return 0.0
+
+    @staticmethod
+    def _by_output(builds: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Builds grouped by the output directory they share, oldest group first."""
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for build in builds:
+            key = str(Path(build["output_dir"]).resolve()) if build.get("output_dir") \
+                else build["session_id"]
+            groups.setdefault(key, []).append(build)
+        return sorted(groups.values(),
+                      key=lambda group: max(b.get("completed_at") or "" for b in group))
+
+    def _expire(self, group: List[Dict[str, Any]]) -> int:
+        """Remove the output shared by `group` and mark every session in it
+        expired; returns the blob bytes this freed."""
+        build = group[0]
+        if build.get("output_dir"):
+            shutil.rmtree(build["output_dir"], ignore_errors=True)
+        freed = 0
+        if self.store is not None:
+            for entry in build.get("files", []):
+                if entry.get("sha256"):
+                    freed += self.store.release(entry["sha256"])
+        expired_at = datetime.utcnow().isoformat()
+        for member in group:
+            self.sessions.update(member["session_id"], {
+                "status": "expired",
+                "expired_at": expired_at
+            })
+        return freed
+
+    def _remove_orphans(self, referenced: set) -> int:
+        referenced = referenced | set(self._load_pins().values())
+        cutoff = time.time() - self.max_age_seconds
+        removed = 0
+        for path in self.output_root.iterdir():
+            if not path.is_dir():
+                continue
+            if path.name.startswith(".") and not path.name.startswith(STAGING_PREFIX):
+                continue
+            if str(path.resolve()) in referenced or path.stat().st_mtime >= cutoff:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def run(self) -> Dict[str, Any]:
+        """Apply the policy once and sweep unreferenced blobs."""
+        now = datetime.utcnow()
+        expired = freed = 0
+        kept = []
+        pins = self._load_pins()
+        for group in self._by_output(self._completed_builds()):
+            pinned = any(b.get("pinned") or b["session_id"] in self.pinned
+                         or b["session_id"] in pins for b in group)
+            if pinned:
+                # Builds pinned before they finished (or by OUTPUT_PINNED) are
+                # recorded once they have an output directory
+                for b in group:
+                    if b.get("output_dir") and b["session_id"] not in pins \
+                            and (b.get("pinned") or b["session_id"] in self.pinned):
+                        self.pin(b["session_id"], b["output_dir"])
+            if not pinned and self.max_age_seconds \
+                    and all(self._age(b, now) > self.max_age_seconds for b in group):
+                freed += self._expire(group)
+                expired += len(group)
+            else:
+                kept.append((group, pinned))
+
+        if self.max_bytes and self.store is not None:
+            total = self.store.total_bytes()
+            for group, pinned in list(kept):
+                if total <= self.max_bytes:
+                    break
+                if pinned:
+                    continue
+                released = self._expire(group)
+                total -= released
+                freed += released
+                kept.remove((group, pinned))
+                expired += len(group)
+
+        orphans = 0
+        if self.max_age_seconds:
+            referenced = {str(Path(b["output_dir"]).resolve())
+                          for group, _ in kept for b in group if b.get("output_dir")}
+            orphans = self._remove_orphans(referenced)
+        freed += self.store.sweep() if self.store is not None else 0
+
+        self.last_run = {
+            "at": now.isoformat(),
+            "expired_builds": expired,
+            "removed_orphans": orphans,
+            "freed_bytes": freed,
+        }
+        return self.last_run
+
+    def start(self, interval: float = 3600.0) -> None:
+        """Run the policy periodically on a daemon thread."""
+        def _loop():
+            while True:
+                try:
+                    self.run()
+                except Exception as e:
+                    print(f"Output retention failed: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=_loop, name="output-retention", daemon=True).start()
+
+
+_shared_store: Optional[BlobStore] = None
+_shared_store_lock = threading.Lock()
+
+
+def get_blob_store() -> Optional[BlobStore]:
+    """Return the process-wide blob store, or None when disabled.
+
+    Configured with BLOB_STORE (set to 0 to disable) and BLOB_STORE_PATH,
+    which must be on the same filesystem as outputs/ for hard links.
+    """
+    global _shared_store
+    if os.getenv("BLOB_STORE", "1") == "0":
+        return None
+
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = BlobStore(os.getenv("BLOB_STORE_PATH", "outputs/.blobs"))
+        return _shared_store
+
+
+def create_output_retention(sessions: SessionStore, output_root: Path) -> OutputRetention:
+    """Retention policy from OUTPUT_MAX_AGE (seconds), OUTPUT_MAX_BYTES and
+    OUTPUT_PINNED (comma-separated session ids)."""
+    return OutputRetention(
+        sessions,
+        output_root,
+        store=get_blob_store(),
+        max_age_seconds=float(os.getenv("OUTPUT_MAX_AGE", str(30 * 24 * 3600))),
+        max_bytes=int(os.getenv("OUTPUT_MAX_BYTES", "0")),
+        pinned=[s.strip() for s in os.getenv("OUTPUT_PINNED", "").split(",") if s.strip()],
+    )
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+def normalize_prompt(text: str) -> str:
+    """Collapse whitespace and case so near-identical prompts share a key."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class ResponseCache:
+    """Two-tier cache for LLM responses: in-process LRU backed by SQLite.
+
+    Entries expire after ``ttl_seconds``. The disk tier evicts least recently
+    used rows once the stored text exceeds ``max_disk_bytes``.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        memory_entries: int = 256,
+        ttl_seconds: float = 7 * 24 * 3600,
+        max_disk_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_bytes = 0
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed_at)")
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - ttl_seconds,))
+            self._db.commit()
+            row = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            self._disk_bytes = row[0]
+
+    @staticmethod
+    def make_key(prompt: str, model: str, generation_config: Optional[Dict[str, Any]],
+                 catalog_hash: str, user_prompt: Optional[str] = None) -> str:
+        """Build a cache key from the prompt, model settings and module catalog.
+
+        The prompt is hashed verbatim, since it can embed code and earlier
+        plans where case and indentation matter. Only `user_prompt`, the
+        user's own text within it, is matched ignoring case and whitespace.
+        """
+        if user_prompt:
+            prompt = prompt.replace(user_prompt, "\0user_prompt\0")
+        payload = json.dumps(
+            {
+                "prompt": prompt,
+                "user_prompt": normalize_prompt(user_prompt) if user_prompt else None,
+                "model": model,
+                "generation_config": generation_config or {},
+                "catalog": catalog_hash,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return entry[0]
+            if entry:
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[1] < self.ttl_seconds:
+                    self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self._stats["disk_hits"] += 1
+                    return row[0]
+
+            self._stats["misses"] += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self._stats["writes"] += 1
+
+            if self._db is None:
+                return
+            size = len(value.encode("utf-8"))
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._disk_bytes += size - (old[0] if old else 0)
+            self._evict_disk()
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at LIMIT 32"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                return
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._disk_bytes -= size
+                self._stats["evictions"] += 1
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+
+
+_shared_cache: Optional[ResponseCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return the process-wide response cache, or None when disabled.
+
+    Configured with RESPONSE_CACHE (set to 0 to disable), RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES and RESPONSE_CACHE_MEMORY_ENTRIES.
+    """
+    global _shared_cache
+    if os.getenv("RESPONSE_CACHE", "1") == "0":
+        return None
+
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache(
+                path=os.getenv("RESPONSE_CACHE_PATH", ".cache/llm_responses.sqlite3") or None,
+                memory_entries=int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "256")),
+                ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600))),
+                max_disk_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            )
+        return _shared_cache
@@ -0,0 +1,56 @@
+import threading
+import time
+from typing import Optional
+
+
+class BuildCancelled(Exception):
+    """Raised inside a build that was cancelled or ran past its deadline."""
+
+    def __init__(self, reason: str = "cancelled"):
+        self.reason = reason  # "cancelled" or "timed_out"
+        super().__init__("Build timed out" if reason == "timed_out" else "Build cancelled")
+
+
+class CancelToken:
+    """Thread-safe cancellation flag with an optional overall deadline.
+
+    A token made with `child()` is also cancelled by its parent, but can be
+    cancelled on its own to stop one piece of work.
+    """
+
+    def __init__(self, parent: Optional["CancelToken"] = None):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+        self.deadline: Optional[float] = None
+        self.parent = parent
+
+    def child(self) -> "CancelToken":
+        return CancelToken(parent=self)
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def set_timeout(self, seconds: Optional[float]) -> None:
+        self.deadline = time.monotonic() + seconds if seconds else None
+
+    def check(self) -> None:
+        """Raise BuildCancelled if the build should stop."""
+        if self.parent is not None:
+            self.parent.check()
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("timed_out")
+        if self._event.is_set():
+            raise BuildCancelled(self.reason)
+
+    def budget(self, timeout: Optional[float] = None) -> Optional[float]:
+        """Seconds a step may take: its own timeout capped by the build deadline."""
+        self.check()
+        deadlines = [t.deadline for t in (self, self.parent) if t is not None and t.deadline]
+        limits = [t for t in (timeout, deadlines and min(deadlines) - time.monotonic()) if t]
+        return min(limits) if limits else None
@@ -0,0 +1,195 @@
+"""Sharded module catalog: a small index plus one file per module body.
+
+    catalog/
+        index.json                  format, content hash, module metadata
+        bodies/ab/ab12....json      full module (code, docs, setup), by content hash
+
+The index holds what every process needs up front (id, name, language,
+inputs, outputs, setup flag and a documentation preview), so loading a
+catalog costs the same however much code it contains. Bodies are read on
+demand. They are named by their content hash and never rewritten, so a
+process still using an older index keeps reading the bodies it refers to
+until `compact` removes them.
+
+    python catalog.py import modules.json catalog/
+    python catalog.py export catalog/ modules.json
+    python catalog.py compact catalog/
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List
+
+FORMAT_VERSION = 1
+INDEX_FILE = "index.json"
+BODIES_DIR = "bodies"
+
+# Fields kept in memory for every module; the full module is loaded on demand
+METADATA_FIELDS = ("module_id", "module_name", "language", "inputs", "outputs",
+                   "setup_required", "documentation")
+# Longer documentation is cut to this many characters in the metadata
+DOC_PREVIEW_CHARS = 500
+
+
+def module_metadata(module: Dict[str, Any], preview: bool = True) -> Dict[str, Any]:
+    """The in-memory part of a module; with `preview`, longer documentation
+    is cut to DOC_PREVIEW_CHARS."""
+    metadata = {k: module[k] for k in METADATA_FIELDS if k in module}
+    doc = metadata.get("documentation", "")
+    if preview and len(doc) > DOC_PREVIEW_CHARS:
+        metadata["documentation"] = doc[:DOC_PREVIEW_CHARS].rstrip() + "..."
+    return metadata
+
+
+def may_be_preview(documentation: str) -> bool:
+    """Whether `module_metadata` may have cut this documentation short."""
+    return documentation.endswith("...") and len(documentation) <= DOC_PREVIEW_CHARS + 3
+
+
+def body_path(root: Path, sha256: str) -> Path:
+    return root / BODIES_DIR / sha256[:2] / f"{sha256}.json"
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class CatalogDirectory:
+    """Read access to a sharded catalog, as of the index read at construction."""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        with open(self.root / INDEX_FILE, "rb") as f:
+            index = json.load(f)
+        if index.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported catalog format: {index.get('format')}")
+        self.content_hash: str = index["content_hash"]
+        # Module id -> content hash of its body
+        self.bodies: Dict[str, str] = {}
+        self.metadata: List[Dict[str, Any]] = []
+        for entry in index["modules"]:
+            self.bodies[entry["module_id"]] = entry.pop("body")
+            self.metadata.append(entry)
+
+    def load(self, module_id: str) -> Dict[str, Any]:
+        """The full module. Raises KeyError for unknown modules."""
+        with open(body_path(self.root, self.bodies[module_id]), "rb") as f:
+            return json.load(f)
+
+
+def write_catalog(modules: List[Dict[str, Any]], root: str) -> str:
+    """Write `modules` as a sharded catalog at `root`; returns its content hash.
+
+    Bodies are written first and the index replaced last, so readers
+    (and hot reload) only ever see a complete catalog. Bodies the previous
+    index used and this one drops are touched just before the swap, so
+    `compact`'s grace period starts when they stop being referenced.
+    """
+    root_path = Path(root)
+    root_path.mkdir(parents=True, exist_ok=True)
+
+    entries = []
+    digest = hashlib.sha256()
+    seen = set()
+    for module in modules:
+        if module["module_id"] in seen:
+            raise ValueError(f"Duplicate module id: {module['module_id']}")
+        seen.add(module["module_id"])
+        body = json.dumps(module, ensure_ascii=False).encode("utf-8")
+        sha256 = hashlib.sha256(body).hexdigest()
+        path = body_path(root_path, sha256)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _write_atomic(path, body)
+        digest.update(sha256.encode("ascii"))
+        entries.append({**module_metadata(module), "body": sha256})
+
+    content_hash = digest.hexdigest()
+    index = {"format": FORMAT_VERSION, "content_hash": content_hash, "modules": entries}
+    try:
+        dropped = set(CatalogDirectory(root).bodies.values()) - {e["body"] for e in entries}
+    except (OSError, ValueError, KeyError):
+        dropped = set()  # no previous catalog (or an unreadable one)
+    for sha256 in dropped:
+        try:
+            os.utime(body_path(root_path, sha256))
+        except FileNotFoundError:
+            pass
+    _write_atomic(root_path / INDEX_FILE, json.dumps(index, ensure_ascii=False).encode("utf-8"))
+    return content_hash
+
+
+def read_modules(root: str) -> List[Dict[str, Any]]:
+    """Every module of a sharded catalog, in catalog order."""
+    catalog = CatalogDirectory(root)
+    return [catalog.load(m["module_id"]) for m in catalog.metadata]
+
+
+def compact(root: str, grace_seconds: float = 3600.0) -> Dict[str, int]:
+    """Delete bodies the index no longer refers to (and stale temp files).
+
+    Files touched less than `grace_seconds` ago are kept, so processes still
+    on an older snapshot of the catalog can finish reading them: new bodies
+    are written, and dropped ones touched, when an import swaps the index.
+    """
+    catalog = CatalogDirectory(root)
+    referenced = {f"{sha}.json" for sha in catalog.bodies.values()}
+    cutoff = time.time() - grace_seconds
+    removed = freed = 0
+    for shard in (catalog.root / BODIES_DIR).iterdir():
+        if not shard.is_dir():
+            continue
+        for path in shard.iterdir():
+            if path.name in referenced:
+                continue
+            try:
+                stat = path.stat()
+                if stat.st_mtime >= cutoff:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += stat.st_size
+    return {"modules": len(referenced), "removed": removed, "freed_bytes": freed}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Manage sharded module catalogs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("import", help="convert a modules.json array to a catalog")
+    convert.add_argument("source")
+    convert.add_argument("catalog")
+    export = commands.add_parser("export", help="write a catalog back out as a modules.json array")
+    export.add_argument("catalog")
+    export.add_argument("target")
+    clean = commands.add_parser("compact", help="remove bodies the index no longer uses")
+    clean.add_argument("catalog")
+    clean.add_argument("--grace", type=float, default=3600.0,
+                       help="keep bodies dropped from the index less than this many seconds ago")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        with open(args.source, "rb") as f:
+            modules = json.load(f)
+        content_hash = write_catalog(modules, args.catalog)
+        print(f"Imported {len(modules)} modules into {args.catalog} ({content_hash[:12]})")
+    elif args.command == "export":
+        modules = read_modules(args.catalog)
+        _write_atomic(Path(args.target), json.dumps(modules, indent=2, ensure_ascii=False).encode("utf-8"))
+        print(f"Exported {len(modules)} modules to {args.target}")
+    else:
+        stats = compact(args.catalog, args.grace)
+        print(f"{stats['modules']} modules; removed {stats['removed']} unused bodies "
+              f"({stats['freed_bytes']} bytes)")
+
+
+if __name__ == "__main__":
+    main()
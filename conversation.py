@@ -0,0 +1,150 @@
+"""Conversation memory for chat-driven builds.
+
+A chat session keeps every message, but a build only sees a bounded
+context: the latest turns verbatim, older turns folded into a running
+summary of one-line points, and the state of the app built so far (its
+modules and files). Turns are folded as they are recorded, so the context
+sent with turn 20 costs about as much as the one sent with turn 2.
+"""
+import os
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from jobs import PUBLISHED
+from retrieval import estimate_tokens
+from sessions import SessionStore
+
+# Shares of the token budget for the summary of older turns and for the app
+# state; recent turns get the rest
+SUMMARY_SHARE = 0.3
+STATE_SHARE = 0.2
+# A folded turn is cut to this many characters
+SUMMARY_POINT_CHARS = 160
+# Builds remembered per conversation
+MAX_BUILDS = 20
+
+
+def new_chat_id() -> str:
+    timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    return f"chat-{timestamp}-{uuid.uuid4().hex[:6]}"
+
+
+def _clip(text: str, max_chars: int) -> str:
+    """`text` with whitespace collapsed, cut at a word boundary to `max_chars`."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "..."
+
+
+def _turn(message: Dict[str, Any]) -> str:
+    return f"{message['role']}: {message['content']}"
+
+
+class ConversationMemory:
+    """Chat sessions in `chats`, with bounded context for the builds they start.
+
+    `builds` is the build session store, read for the state of the app a
+    conversation has built. The context is kept within `token_budget`
+    (CHAT_CONTEXT_TOKEN_BUDGET) estimated tokens.
+    """
+
+    def __init__(self, chats: SessionStore, builds: SessionStore,
+                 token_budget: Optional[int] = None):
+        self.chats = chats
+        self.builds = builds
+        self.token_budget = token_budget or int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "1000"))
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        return self.chats.get(chat_id)
+
+    def add_message(self, chat_id: str, role: str, content: str,
+                    timestamp: Optional[str] = None,
+                    build_session_id: Optional[str] = None) -> Dict[str, Any]:
+        """Append a message (creating the conversation) and return the conversation.
+
+        `build_session_id` is the build the message started.
+        """
+        message = {"role": role, "content": content,
+                   "timestamp": timestamp or datetime.utcnow().isoformat()}
+        with self._lock:
+            chat = self.chats.get(chat_id) or {"messages": []}
+            if build_session_id:
+                message["build_session_id"] = build_session_id
+                chat["builds"] = (chat.get("builds", []) + [build_session_id])[-MAX_BUILDS:]
+            chat["messages"].append(message)
+            self._compact(chat)
+            self.chats.put(chat_id, chat)
+        return chat
+
+    def last_build(self, chat_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """The conversation's most recent published build, as (session id, session)."""
+        chat = self.chats.get(chat_id) or {}
+        for session_id in reversed(chat.get("builds", [])):
+            session = self.builds.get(session_id)
+            if session and session.get("status") in PUBLISHED and session.get("analysis"):
+                return session_id, session
+        return None
+
+    def context(self, chat_id: str, base_session_id: Optional[str] = None) -> Optional[str]:
+        """Prompt text for a build continuing the conversation, or None for a new one.
+
+        The app state is left out when it is that of `base_session_id`,
+        whose whole plan the builder already sends.
+        """
+        chat = self.chats.get(chat_id)
+        if not chat or not chat.get("messages"):
+            return None
+
+        sections = []
+        summary = chat.get("summary", [])
+        if summary:
+            points = [f"- {point}" for point in summary]
+            if chat.get("omitted"):
+                points.insert(1, f"- ({chat['omitted']} more points omitted)")
+            sections.append("Earlier in the conversation:\n" + "\n".join(points))
+
+        recent_budget = self.token_budget * (1 - SUMMARY_SHARE - STATE_SHARE)
+        recent = "\n".join(_turn(m) for m in chat["messages"][chat.get("summarized", 0):])
+        if estimate_tokens(recent) > recent_budget:
+            recent = _clip(recent, int(recent_budget * 4))  # one very long message
+        sections.append("Latest messages:\n" + recent)
+
+        last = self.last_build(chat_id)
+        if last and last[0] != base_session_id:
+            sections.append(self._app_state(last[1]["analysis"]))
+        return "\n\n".join(sections)
+
+    def _app_state(self, analysis: Dict[str, Any]) -> str:
+        modules = ", ".join(m["module_id"] for m in analysis.get("required_modules", []))
+        files = ", ".join(f["filename"] for f in analysis.get("file_structure", []))
+        max_chars = int(self.token_budget * STATE_SHARE * 4)
+        return "App built so far:\n" + _clip(f"Modules: {modules}", max_chars // 2) \
+            + "\n" + _clip(f"Files: {files}", max_chars // 2)
+
+    def _compact(self, chat: Dict[str, Any]) -> None:
+        """Fold the oldest turns into the summary until the rest fit the budget.
+
+        The latest message is never folded. When the summary outgrows
+        its share, the oldest points after the first (usually what the app
+        is) are dropped.
+        """
+        messages: List[Dict[str, Any]] = chat["messages"]
+        summary: List[str] = chat.setdefault("summary", [])
+        folded = chat.get("summarized", 0)
+        recent_budget = self.token_budget * (1 - SUMMARY_SHARE - STATE_SHARE)
+        recent_tokens = sum(estimate_tokens(_turn(m)) for m in messages[folded:])
+        while len(messages) - folded > 1 and recent_tokens > recent_budget:
+            oldest = messages[folded]
+            recent_tokens -= estimate_tokens(_turn(oldest))
+            summary.append(_clip(_turn(oldest), SUMMARY_POINT_CHARS))
+            folded += 1
+        chat["summarized"] = folded
+
+        summary_budget = self.token_budget * SUMMARY_SHARE
+        while len(summary) > 2 and estimate_tokens("\n".join(summary)) > summary_budget:
+            del summary[1]
+            chat["omitted"] = chat.get("omitted", 0) + 1
@@ -0,0 +1,112 @@
+"""Offline evaluation of the analysis-prompt module pre-filter.
+
+Measures how often modules the analysis actually needs fall outside the
+retrieved candidates, and how many prompt tokens the filter saves.
+
+    python eval_retrieval.py --k 3 5 8
+    python eval_retrieval.py --dataset cases.jsonl --json
+
+Dataset lines look like {"prompt": "...", "expected_modules": ["module_id", ...]}.
+No API key or network access is needed.
+"""
+import argparse
+import json
+from typing import Any, Dict, List
+
+from registry import ModuleRegistry
+from retrieval import ModuleRetriever, estimate_tokens
+
+DEFAULT_CASES = [
+    {"prompt": "build a basic user account management app: register/login users, persist profiles, edit profile details, and sync to Firebase.",
+     "expected_modules": ["react_signup_screen", "react_login_screen", "react_profile_screen",
+                          "firebase_email_auth", "firebase_realtime_db"]},
+    {"prompt": "landing page with hero section and image gallery",
+     "expected_modules": ["react_hero_section", "react_image_gallery"]},
+    {"prompt": "user authentication app with Firebase and profile editing",
+     "expected_modules": ["firebase_email_auth", "react_login_screen", "react_profile_screen"]},
+    {"prompt": "marketing site with a headline, feature highlights and a call to action",
+     "expected_modules": ["react_hero_section", "react_feature_grid", "react_cta_section"]},
+    {"prompt": "photo sharing app where users upload pictures to cloud storage and browse them in a gallery",
+     "expected_modules": ["react_image_uploader", "firebase_storage", "react_image_gallery"]},
+    {"prompt": "sign up and sign in screens backed by email/password auth",
+     "expected_modules": ["react_signup_screen", "react_login_screen", "firebase_email_auth"]},
+    {"prompt": "let users change their avatar and bio and save it to the realtime database",
+     "expected_modules": ["react_profile_screen", "firebase_realtime_db"]},
+    {"prompt": "drag and drop image upload with progress bar",
+     "expected_modules": ["react_image_uploader"]},
+]
+
+
+def load_cases(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(retriever: ModuleRetriever, registry: ModuleRegistry,
+             cases: List[Dict[str, Any]], top_k: int) -> Dict[str, Any]:
+    full_tokens = estimate_tokens("".join(registry.context_fragment(m['module_id'])
+                                          for m in registry.modules))
+    expected_total = missed_total = prompts_with_miss = fallbacks = 0
+    candidates_total = tokens_saved_total = 0
+    misses = []
+
+    for case in cases:
+        selection = retriever.select(case["prompt"], top_k)
+        chosen = set(selection.module_ids)
+        missed = [m for m in case["expected_modules"] if m not in chosen]
+
+        expected_total += len(case["expected_modules"])
+        missed_total += len(missed)
+        candidates_total += len(chosen)
+        fallbacks += selection.fallback is not None
+        tokens_saved_total += full_tokens - estimate_tokens(
+            "".join(registry.context_fragment(m) for m in selection.module_ids)
+        )
+        if missed:
+            prompts_with_miss += 1
+            misses.append({"prompt": case["prompt"], "missed": missed})
+
+    n = len(cases) or 1
+    return {
+        "top_k": top_k,
+        "cases": len(cases),
+        "module_miss_rate": missed_total / expected_total if expected_total else 0.0,
+        "prompt_miss_rate": prompts_with_miss / n,
+        "fallback_rate": fallbacks / n,
+        "avg_candidates": candidates_total / n,
+        "avg_tokens_saved": tokens_saved_total / n,
+        "full_context_tokens": full_tokens,
+        "misses": misses,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", default="modules.json")
+    parser.add_argument("--dataset", help="JSONL file of evaluation cases")
+    parser.add_argument("--k", type=int, nargs="+", default=[3, 5, 8])
+    parser.add_argument("--json", action="store_true", help="print a machine-readable report")
+    args = parser.parse_args()
+
+    registry = ModuleRegistry.from_file(args.modules)
+    retriever = ModuleRetriever(registry)
+    cases = load_cases(args.dataset) if args.dataset else DEFAULT_CASES
+    reports = [evaluate(retriever, registry, cases, k) for k in args.k]
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+
+    print(f"{len(cases)} cases, {len(registry)} modules\n")
+    for report in reports:
+        print(f"k={report['top_k']}: module miss rate {report['module_miss_rate']:.1%}, "
+              f"prompts with a miss {report['prompt_miss_rate']:.1%}, "
+              f"fallbacks {report['fallback_rate']:.1%}, "
+              f"avg {report['avg_candidates']:.1f} candidates, "
+              f"~{report['avg_tokens_saved']:.0f}/{report['full_context_tokens']} tokens saved")
+        for miss in report["misses"]:
+            print(f"    missed {', '.join(miss['missed'])} for: {miss['prompt']}")
+
+
+if __name__ == "__main__":
+    main()
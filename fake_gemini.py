@@ -0,0 +1,181 @@
+"""Deterministic, offline stand-in for a Gemini GenerativeModel.
+
+Returns canned analysis JSON (built from the modules listed in the prompt)
+and canned glue code, after a simulated latency. Outcomes depend only on
+the seed and the prompt text, so concurrent runs are reproducible.
+
+    builder = ModuleBasedAppBuilder(backend=LocalBackend(FakeGenerativeModel(latency=0.8, jitter=0.2)))
+"""
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Optional
+
+_MODULE_ID_RE = re.compile(r"^Module ID: (\S+)$", re.MULTILINE)
+_GLUE_FILE_RE = re.compile(r"Generate Python code for (\S+) that integrates")
+_PREVIOUS_PLAN_RE = re.compile(r"^Previous plan \(JSON\): (.+)$", re.MULTILINE)
+
+# Field order the analysis prompt asks for
+_FIELD_ORDER = ("data_flow", "additional_requirements", "file_structure", "required_modules")
+
+_EXTENSIONS = {"tsx": ".tsx", "jsx": ".jsx", "ts": ".ts", "typescript": ".ts", "javascript": ".js"}
+
+
+class FakeUpstreamError(RuntimeError):
+    """Simulated Gemini failure (e.g. quota or 5xx)."""
+
+
+@dataclass
+class FakeUsage:
+    prompt_token_count: int
+    candidates_token_count: int
+
+
+@dataclass
+class FakeResponse:
+    text: str
+    usage_metadata: Optional[FakeUsage] = None
+
+
+class FakeGenerativeModel:
+    """Drop-in for `genai.GenerativeModel` with configurable latency and failures.
+
+    `latency` is the mean seconds per call. `distribution` is "fixed",
+    "uniform" (latency +/- jitter) or "lognormal" (jitter is the sigma).
+    `failure_rate` is the probability a call raises FakeUpstreamError.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, distribution: str = "uniform",
+                 failure_rate: float = 0.0, seed: int = 0, files_per_build: int = 6,
+                 glue_lines: int = 40, stream_chunks: int = 8, language_hint: Optional[str] = None):
+        if distribution not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.files_per_build = files_per_build
+        self.glue_lines = glue_lines
+        self.stream_chunks = max(1, stream_chunks)
+        self.language_hint = language_hint
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.total_latency = 0.0
+
+    def generate_content(self, prompt: str, generation_config: Optional[Dict[str, Any]] = None,
+                         stream: bool = False, request_options: Optional[Dict[str, Any]] = None,
+                         **kwargs: Any):
+        rng = random.Random(f"{self.seed}:{hashlib.sha256(prompt.encode('utf-8')).hexdigest()}")
+        delay = self._sample_latency(rng)
+        timeout = (request_options or {}).get("timeout")
+        fails = rng.random() < self.failure_rate
+
+        is_json = (generation_config or {}).get("response_mime_type") == "application/json"
+        text = self._analysis(prompt, rng) if is_json else self._glue(prompt)
+        usage = FakeUsage((len(prompt) + 3) // 4, (len(text) + 3) // 4)
+
+        with self._lock:
+            self.calls += 1
+            self.total_latency += delay
+            self.failures += fails
+
+        if stream:
+            return self._stream(text, usage, delay, fails, timeout)
+
+        self._sleep(delay, timeout)
+        if fails:
+            raise FakeUpstreamError("Simulated upstream failure")
+        return FakeResponse(text, usage)
+
+    def _sample_latency(self, rng: random.Random) -> float:
+        if self.latency <= 0:
+            return 0.0
+        if self.distribution == "fixed":
+            return self.latency
+        if self.distribution == "uniform":
+            return max(0.0, rng.uniform(self.latency - self.jitter, self.latency + self.jitter))
+        # lognormal with the given mean
+        sigma = self.jitter
+        return rng.lognormvariate(0, sigma) * self.latency / math.exp(sigma * sigma / 2)
+
+    @staticmethod
+    def _sleep(delay: float, timeout: Optional[float]) -> None:
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Simulated request timeout")
+        if delay:
+            time.sleep(delay)
+
+    def _stream(self, text: str, usage: FakeUsage, delay: float, fails: bool,
+                timeout: Optional[float]) -> Iterator[FakeResponse]:
+        # Half the latency before the first chunk, the rest spread over the stream
+        self._sleep(delay / 2, timeout)
+        if fails:
+            raise FakeUpstreamError("Simulated upstream failure")
+        size = max(1, -(-len(text) // self.stream_chunks))
+        chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(delay / 2 / max(1, len(chunks) - 1))
+            yield FakeResponse(chunk, usage if index == len(chunks) - 1 else None)
+
+    def _analysis(self, prompt: str, rng: random.Random) -> str:
+        module_ids = _MODULE_ID_RE.findall(prompt)
+        rng.shuffle(module_ids)
+
+        # A refinement keeps the previous plan and adds one module
+        previous = _PREVIOUS_PLAN_RE.search(prompt)
+        if previous:
+            plan = json.loads(previous.group(1))
+            used = {m['module_id'] for m in plan.get('required_modules', [])}
+            for module_id in [m for m in module_ids if m not in used][:1]:
+                file_info = self._file_for(module_id)
+                plan['file_structure'].append(file_info)
+                plan['required_modules'].append({
+                    "module_id": module_id, "purpose": f"Provides {module_id}",
+                    "file_placement": file_info["filename"]
+                })
+            return json.dumps({key: plan[key] for key in _FIELD_ORDER if key in plan})
+
+        file_structure = [self._file_for(m) for m in module_ids[:self.files_per_build]]
+        return json.dumps({
+            "data_flow": "User input flows through the UI components into the service helpers.",
+            "additional_requirements": ["Routing between screens", "Environment configuration"],
+            "file_structure": file_structure,
+            "required_modules": [
+                {"module_id": f["modules_used"][0], "purpose": f"Provides {f['modules_used'][0]}",
+                 "file_placement": f["filename"]}
+                for f in file_structure
+            ],
+        })
+
+    def _file_for(self, module_id: str) -> Dict[str, Any]:
+        extension = _EXTENSIONS.get(self.language_hint or "tsx", ".py")
+        return {
+            "filename": "src/" + "".join(p.capitalize() for p in module_id.split("_")) + extension,
+            "purpose": f"Wires up {module_id}",
+            "modules_used": [module_id],
+        }
+
+    def _glue(self, prompt: str) -> str:
+        match = _GLUE_FILE_RE.search(prompt)
+        filename = match.group(1) if match else "module"
+        body = "\n".join(f"  // step {i}: connect inputs and outputs" for i in range(self.glue_lines))
+        return (
+            "```tsx\n"
+            "import React from 'react';\n\n"
+            f"// Glue code for {filename}\n"
+            "export default function Screen() {\n"
+            f"{body}\n"
+            "  return null;\n"
+            "}\n"
+            "```"
+        )
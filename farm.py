@@ -0,0 +1,571 @@
+"""Multi-process build farm: API processes queue builds, worker processes run them.
+
+Builds go into a durable SQLite queue shared by every process on the box.
+Workers lease jobs, renew their leases with heartbeats while the build
+runs, and write progress events back to the database; each API process
+relays the events of the builds it queued to their listeners (WebSocket
+clients, waiting requests, batches). A job whose worker dies is leased
+again once its lease expires. Scale by starting more workers:
+
+    BUILD_EXECUTION=farm uvicorn app:app --workers 2
+    python farm.py --concurrency 4      # as many as the box can take
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cancellation import BuildCancelled, CancelToken
+from jobs import INTERRUPTED_ERROR, BuildJobManager
+import metrics
+from sessions import MemorySessionStore, SessionStore, create_session_store
+
+FINAL_EVENTS = ("complete", "error", "cancelled")
+# Events the relay reads per query
+EVENT_PAGE = 1000
+# Seconds between a worker's metrics snapshots, and before a silent worker's are dropped
+METRICS_INTERVAL = 10.0
+METRICS_MAX_AGE = 60.0
+
+# Session fields owned by the job's requester, not copied to coalesced sessions
+_REQUEST_FIELDS = ("prompt", "options", "base_session_id", "coalesced_with", "queued_at",
+                   "worker_instance")
+
+
+class SQLiteJobQueue:
+    """Durable build queue with leases, in a SQLite database (WAL mode).
+
+    A job is ``queued``, ``leased`` by a worker until ``lease_expires``,
+    then ``done`` or ``cancelled``. A lease that isn't renewed by
+    `heartbeat` expires and the job can be leased again. Jobs are leased
+    oldest first, preferring clients with the fewest jobs running.
+    Progress events are appended to a table the API processes poll.
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS build_queue (
+                    job_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    client_id TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    finished_at REAL
+                )"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS build_queue_status ON build_queue(status, enqueued_at)"
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS worker_metrics (
+                    worker_id TEXT PRIMARY KEY,
+                    snapshot TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS build_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+
+    def _transaction(self, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return result
+
+    def enqueue(self, job_id: str, payload: Dict[str, Any], client_id: str = "") -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO build_queue (job_id, payload, client_id, status, enqueued_at) "
+                "VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, json.dumps(payload), client_id, time.time()),
+            )
+
+    def lease(self, owner: str, lease_seconds: float) -> Optional[Tuple[str, Dict[str, Any], int]]:
+        """Take the next job (or one whose lease expired): (job_id, payload, attempts)."""
+        def _lease():
+            now = time.time()
+            row = self._db.execute(
+                """SELECT job_id, payload, attempts FROM build_queue AS q
+                   WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?)
+                   ORDER BY (SELECT COUNT(*) FROM build_queue AS r
+                             WHERE r.status = 'leased' AND r.lease_expires >= ?
+                             AND r.client_id = q.client_id),
+                            enqueued_at
+                   LIMIT 1""",
+                (now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE build_queue SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE job_id = ?",
+                (owner, now + lease_seconds, row[0]),
+            )
+            return row[0], json.loads(row[1]), row[2] + 1
+
+        return self._transaction(_lease)
+
+    def heartbeat(self, job_id: str, owner: str, lease_seconds: float) -> str:
+        """Renew a lease. Returns "ok", "cancel" (cancellation was requested)
+        or "lost" (the lease expired and the job moved on)."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE build_queue SET lease_expires = ? "
+                "WHERE job_id = ? AND lease_owner = ? AND status = 'leased'",
+                (time.time() + lease_seconds, job_id, owner),
+            )
+            if cursor.rowcount == 0:
+                return "lost"
+            row = self._db.execute(
+                "SELECT cancel_requested FROM build_queue WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return "cancel" if row and row[0] else "ok"
+
+    def finish(self, job_id: str, owner: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE build_queue SET status = 'done', finished_at = ? "
+                "WHERE job_id = ? AND lease_owner = ?",
+                (time.time(), job_id, owner),
+            )
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job. True if it was still queued (so no worker will report
+        it); otherwise the worker running it is asked to stop."""
+        def _cancel():
+            now = time.time()
+            cursor = self._db.execute(
+                "UPDATE build_queue SET status = 'cancelled', finished_at = ? "
+                "WHERE job_id = ? AND status = 'queued'",
+                (now, job_id),
+            )
+            if cursor.rowcount:
+                return True
+            self._db.execute(
+                "UPDATE build_queue SET cancel_requested = 1 WHERE job_id = ?", (job_id,)
+            )
+            return False
+
+        return self._transaction(_cancel)
+
+    def depth(self) -> int:
+        """Jobs queued or running, across every process."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM build_queue WHERE status IN ('queued', 'leased')"
+            ).fetchone()
+        return row[0]
+
+    def running(self) -> int:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM build_queue WHERE status = 'leased' AND lease_expires >= ?",
+                (time.time(),),
+            ).fetchone()
+        return row[0]
+
+    def push_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO build_events (job_id, event, created_at) VALUES (?, ?, ?)",
+                (job_id, json.dumps(event), time.time()),
+            )
+
+    def last_event_id(self) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM build_events").fetchone()
+        return row[0]
+
+    def events_after(self, after_id: int, limit: int = EVENT_PAGE) -> List[Tuple[int, str, Dict[str, Any]]]:
+        """Up to `limit` events newer than `after_id` (of every job), oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, job_id, event FROM build_events WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit),
+            ).fetchall()
+        return [(row[0], row[1], json.loads(row[2])) for row in rows]
+
+    def publish_metrics(self, worker_id: str, snapshot: Dict[str, Any]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO worker_metrics (worker_id, snapshot, updated_at) "
+                "VALUES (?, ?, ?)",
+                (worker_id, json.dumps(snapshot), time.time()),
+            )
+
+    def worker_metrics(self, max_age: float) -> List[Tuple[str, Dict[str, Any]]]:
+        """Metrics snapshots of workers that published within `max_age` seconds;
+        older ones (stopped workers) are deleted."""
+        with self._lock:
+            self._db.execute("DELETE FROM worker_metrics WHERE updated_at < ?",
+                             (time.time() - max_age,))
+            rows = self._db.execute(
+                "SELECT worker_id, snapshot FROM worker_metrics ORDER BY worker_id"
+            ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def purge(self, older_than: float) -> None:
+        """Drop events and finished jobs older than `older_than` seconds."""
+        cutoff = time.time() - older_than
+        with self._lock:
+            self._db.execute("DELETE FROM build_events WHERE created_at < ?", (cutoff,))
+            self._db.execute(
+                "DELETE FROM build_queue WHERE status IN ('done', 'cancelled') AND finished_at < ?",
+                (cutoff,),
+            )
+
+
+class FarmJobManager(BuildJobManager):
+    """BuildJobManager for API processes whose builds run in worker processes.
+
+    Submissions (with coalescing, per-client limits and session bookkeeping)
+    work as in BuildJobManager, but jobs go to the shared queue. A relay
+    thread polls the events of this process's jobs and hands them to the
+    listeners; a job's future resolves on its final event. `max_workers`
+    is the expected number of build slots across all workers.
+    """
+
+    def __init__(self, sessions: SessionStore, queue: SQLiteJobQueue,
+                 poll_interval: float = 0.1, **kwargs: Any):
+        if isinstance(sessions, MemorySessionStore):
+            raise ValueError("BUILD_EXECUTION=farm needs SESSION_STORE=sqlite")
+        super().__init__(sessions, builder_factory=None, **kwargs)
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self._cursor = queue.last_event_id()
+        self._stop = threading.Event()
+        threading.Thread(target=self._relay, name="farm-relay", daemon=True).start()
+
+    @property
+    def running(self) -> int:
+        return self.queue.running()
+
+    def _queue_depth(self) -> int:
+        return self.queue.depth()
+
+    def _dispatch(self, future, session_id, prompt, use_cache, options, base_session_id, client,
+                  conversation=None):
+        self.queue.enqueue(session_id, {
+            "prompt": prompt,
+            "use_cache": use_cache,
+            "options": options,
+            "base_session_id": base_session_id,
+            "conversation": conversation,
+        }, client)
+
+    def _cancel_job(self, job_id: str, token: CancelToken, future: Future) -> None:
+        if self.queue.cancel(job_id) and future.cancel():
+            self._finish_cancelled(job_id, BuildCancelled())
+            self._forget(job_id)
+        # Otherwise the worker stops the build and reports it as cancelled
+
+    def recover_interrupted(self) -> int:
+        # Workers take over jobs whose lease has expired
+        return 0
+
+    def worker_metrics(self) -> List[Tuple[str, Dict[str, Any]]]:
+        return self.queue.worker_metrics(max_age=METRICS_MAX_AGE)
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._stop.set()
+        super().shutdown(wait)
+
+    def _relay(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._relay_events()
+            except Exception as e:
+                print(f"Build event relay failed: {e}")
+
+    def _relay_events(self) -> None:
+        """Pass on every new event of this process's jobs.
+
+        The cursor moves over all events, so this process's jobs are only
+        picked out after reading: a job is registered before it is
+        enqueued, so any event of it that was read is recognised, however
+        late it was submitted. Events of other processes' jobs are skipped.
+        """
+        while True:
+            events = self.queue.events_after(self._cursor)
+            with self._lock:
+                job_ids = set(self._futures)
+            for event_id, job_id, event in events:
+                self._cursor = event_id
+                if job_id not in job_ids:
+                    continue
+                if event.get("type") in FINAL_EVENTS:
+                    self._complete(job_id, event)
+                else:
+                    self._emit(job_id, event)
+            if len(events) < EVENT_PAGE:
+                return
+
+    def _complete(self, job_id: str, event: Dict[str, Any]) -> None:
+        # The worker updated the job's own session; copy the result to sessions coalesced into it
+        job = self.sessions.get(job_id) or {}
+        self._update(job_id, {k: v for k, v in job.items() if k not in _REQUEST_FIELDS}, final=True)
+        try:
+            started = datetime.fromisoformat(job["started_at"])
+            seconds = (datetime.fromisoformat(job["completed_at"]) - started).total_seconds()
+            with self._lock:
+                self._avg_build_seconds += 0.2 * (seconds - self._avg_build_seconds)
+        except (KeyError, TypeError, ValueError):
+            pass
+        self._finish(job_id, event)
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_result(None)
+
+
+class LeasedSessions(SessionStore):
+    """A worker's view of the session store: a job's session is only written
+    while the worker holds the job's lease.
+
+    `claim` stamps the session with the lease (worker and attempt) unless a
+    later attempt has already claimed it. Writes to a claimed session are
+    then compare-and-set on that stamp, so a worker whose lease lapsed can't
+    overwrite the worker that took the job over, and are discarded
+    altogether once the job is `drop`ped.
+    """
+
+    def __init__(self, sessions: SessionStore):
+        self.sessions = sessions
+        self._leases: Dict[str, Optional[str]] = {}  # job id -> lease stamp (None: dropped)
+        self._lock = threading.Lock()
+
+    def claim(self, job_id: str, owner: str, attempt: int) -> bool:
+        lease = f"{owner}#{attempt}"
+        claimed = self.sessions.update_if(
+            job_id, {"lease": lease, "lease_attempt": attempt},
+            lambda data: data.get("lease_attempt", 0) < attempt
+        ) is not None
+        with self._lock:
+            self._leases[job_id] = lease if claimed else None
+        return claimed
+
+    def drop(self, job_id: str) -> None:
+        with self._lock:
+            if job_id in self._leases:
+                self._leases[job_id] = None
+
+    def release(self, job_id: str) -> None:
+        with self._lock:
+            self._leases.pop(job_id, None)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.sessions.get(session_id)
+
+    def put(self, session_id: str, data: Dict[str, Any]) -> None:
+        with self._lock:
+            leased = session_id in self._leases
+        if leased:
+            self.update(session_id, data)
+        else:
+            self.sessions.put(session_id, data)
+
+    def update(self, session_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            if session_id not in self._leases:
+                return self.sessions.update(session_id, fields)
+            lease = self._leases[session_id]
+        if lease is not None:
+            data = self.sessions.update_if(session_id, fields,
+                                           lambda data: data.get("lease") == lease)
+            if data is not None:
+                return data
+        return dict(fields)
+
+    def delete(self, session_id: str) -> None:
+        self.sessions.delete(session_id)
+
+    def list(self, *args: Any, **kwargs: Any) -> List[Dict[str, Any]]:
+        return self.sessions.list(*args, **kwargs)
+
+    def expire(self) -> int:
+        return self.sessions.expire()
+
+
+class BuildWorker:
+    """Worker process loop: lease jobs and run them on a local BuildJobManager."""
+
+    def __init__(self, queue: SQLiteJobQueue, sessions: SessionStore,
+                 builder_factory: Callable[..., Any], concurrency: int = 2,
+                 lease_seconds: float = 30.0, max_attempts: int = 3,
+                 poll_interval: float = 0.2):
+        self.queue = queue
+        self.sessions = LeasedSessions(sessions)
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.jobs = BuildJobManager(
+            self.sessions, builder_factory, max_workers=concurrency, coalesce=False, max_per_client=0
+        )
+        self._active: Dict[str, None] = {}
+        self._lost: Dict[str, None] = {}  # jobs whose lease lapsed and moved to another worker
+        self._active_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self) -> None:
+        threading.Thread(target=self._heartbeat, name="farm-heartbeat", daemon=True).start()
+        last_purge = last_metrics = 0.0
+        while not self._stop.is_set():
+            if time.monotonic() - last_purge > 600:
+                self.queue.purge(older_than=3600)
+                last_purge = time.monotonic()
+            if time.monotonic() - last_metrics > METRICS_INTERVAL:
+                # Served by the API processes' /metrics with a worker label
+                self.queue.publish_metrics(self.worker_id, metrics.REGISTRY.snapshot())
+                last_metrics = time.monotonic()
+            with self._active_lock:
+                busy = len(self._active) >= self.concurrency
+            job = None if busy else self.queue.lease(self.worker_id, self.lease_seconds)
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self._start(*job)
+
+        # Let running builds finish; their leases are still renewed meanwhile
+        self.jobs.shutdown(wait=True)
+
+    def _start(self, job_id: str, payload: Dict[str, Any], attempts: int) -> None:
+        if not self.sessions.claim(job_id, self.worker_id, attempts):
+            # A later attempt has already claimed the session; leave the job to it
+            self.sessions.release(job_id)
+            return
+        if attempts > self.max_attempts:
+            self.sessions.update(job_id, {
+                "status": "failed",
+                "error": INTERRUPTED_ERROR,
+                "completed_at": datetime.utcnow().isoformat()
+            })
+            self.queue.push_event(job_id, {"type": "error", "message": INTERRUPTED_ERROR,
+                                           "session_id": job_id})
+            self.queue.finish(job_id, self.worker_id)
+            self.sessions.release(job_id)
+            return
+
+        def relay(event: Dict[str, Any]) -> None:
+            if job_id not in self._lost:
+                self.queue.push_event(job_id, event)
+
+        with self._active_lock:
+            self._active[job_id] = None
+        try:
+            self.jobs.submit(
+                payload["prompt"], session_id=job_id, use_cache=payload.get("use_cache", True),
+                listener=relay, options=payload.get("options"),
+                base_session_id=payload.get("base_session_id"),
+                conversation=payload.get("conversation"),
+            )
+        except Exception as e:
+            self.queue.push_event(job_id, {"type": "error", "message": str(e), "session_id": job_id})
+            self._done(job_id)
+            return
+        self.jobs.get_future(job_id).add_done_callback(lambda _: self._done(job_id))
+
+    def _done(self, job_id: str) -> None:
+        self.queue.finish(job_id, self.worker_id)
+        self.sessions.release(job_id)
+        with self._active_lock:
+            self._active.pop(job_id, None)
+            self._lost.pop(job_id, None)
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._active_lock:
+                active = list(self._active)
+            for job_id in active:
+                try:
+                    state = self.queue.heartbeat(job_id, self.worker_id, self.lease_seconds)
+                except sqlite3.Error as e:
+                    print(f"Heartbeat for {job_id} failed: {e}")
+                    continue
+                if state == "lost":
+                    # Taken over after our lease lapsed; the new worker reports it.
+                    # Stop the build here without writing its session or events.
+                    with self._active_lock:
+                        self._lost[job_id] = None
+                    self.sessions.drop(job_id)
+                if state != "ok":
+                    self.jobs.cancel(job_id)
+
+
+def create_build_jobs(sessions: SessionStore, builder_factory: Callable[..., Any],
+                      **kwargs: Any) -> BuildJobManager:
+    """Job manager selected by BUILD_EXECUTION: "local" (default) runs builds
+    in this process, "farm" queues them for `python farm.py` workers at
+    BUILD_QUEUE_PATH."""
+    if os.getenv("BUILD_EXECUTION", "local").lower() == "farm":
+        queue = SQLiteJobQueue(os.getenv("BUILD_QUEUE_PATH", ".data/build_queue.sqlite3"))
+        return FarmJobManager(sessions, queue, **kwargs)
+    return BuildJobManager(sessions, builder_factory, **kwargs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a build worker for BUILD_EXECUTION=farm.")
+    parser.add_argument("--concurrency", type=int,
+                        default=int(os.getenv("BUILD_MAX_WORKERS", "2")),
+                        help="builds this worker runs at once")
+    parser.add_argument("--lease", type=float, default=float(os.getenv("BUILD_LEASE_SECONDS", "30")),
+                        help="seconds a job stays leased without a heartbeat")
+    args = parser.parse_args()
+
+    from test import ModuleBasedAppBuilder, _load_env_file
+
+    _load_env_file()
+    # Workers share the LLM rate limit through the queue database (see ratelimit.py)
+    os.environ["BUILD_EXECUTION"] = "farm"
+    worker = BuildWorker(
+        SQLiteJobQueue(os.getenv("BUILD_QUEUE_PATH", ".data/build_queue.sqlite3")),
+        create_session_store("build"),
+        ModuleBasedAppBuilder,
+        concurrency=args.concurrency,
+        lease_seconds=args.lease,
+    )
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    print(f"Build worker {worker.worker_id} running {args.concurrency} builds at a time")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
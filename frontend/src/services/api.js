@@ -11,7 +11,7 @@ const api = axios.create({
 
 export const getModules = async () => {
   try {
-    const response = await api.get('/api/modules')
+    const response = await api.get('/api/modules', { params: { include_code: false } })
     return response.data.modules
   } catch (error) {
     console.error('Error fetching modules:', error)
@@ -31,8 +31,12 @@ export const buildApp = async (prompt) => {
 
 export const getFileContent = async (sessionId, filePath) => {
   try {
-    const response = await api.get(`/api/file/${sessionId}/${filePath}`)
-    return response.data.content
+    // Raw endpoint streams the file and lets the browser revalidate with ETags
+    const response = await api.get(`/api/raw/${sessionId}/${filePath}`, {
+      responseType: 'text',
+      transformResponse: (data) => data,
+    })
+    return response.data
   } catch (error) {
     console.error('Error fetching file content:', error)
     throw error
@@ -0,0 +1,171 @@
+"""Interface summaries of catalog modules for the glue code prompt.
+
+`insert_module_code` splices each module's code into the generated file
+verbatim, so the model writing the glue only needs what it calls: imports,
+props and types, exported names and function signatures. Summaries are
+extracted on demand, the first time a glue prompt needs a module, and the
+registry keeps the rendered fragment in its LRU (CATALOG_CACHE_SIZE).
+"""
+import ast
+import copy
+import re
+from typing import Iterator, List, Tuple
+
+SCRIPT_LANGUAGES = {"javascript", "typescript", "tsx", "jsx", "react", "ts", "js"}
+
+_OPEN = "([{"
+_CLOSE = ")]}"
+# A line starting with one of these continues the previous statement
+_CONTINUATION = tuple("|&.?:)]}=+-*/,")
+
+_IMPORT_RE = re.compile(r"^import\b")
+_TYPE_RE = re.compile(r"^(export\s+)?(declare\s+)?(interface|type|enum)\s")
+_FUNCTION_RE = re.compile(r"^export\s+(default\s+)?(async\s+)?function\b")
+_CLASS_RE = re.compile(r"^export\s+(default\s+)?(abstract\s+)?class\b")
+_VARIABLE_RE = re.compile(r"^export\s+(const|let|var)\s")
+
+
+def _code_chars(text: str) -> Iterator[Tuple[int, str, int]]:
+    """Yield (index, char, bracket depth) for script characters outside
+    strings and comments. Newlines inside comments are yielded too, so
+    line boundaries stay visible.
+
+    Quotes don't span lines, which keeps an apostrophe in JSX text from
+    swallowing the rest of the file.
+    """
+    depth = 0
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if c in "'\"`":
+            end = i + 1
+            while end < n and text[end] != c and (c == "`" or text[end] != "\n"):
+                end += 2 if text[end] == "\\" else 1
+            i = end + 1 if end < n and text[end] == c else end
+            continue
+        if text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            end = n if end < 0 else end + 2
+            for j in range(i, end):
+                if text[j] == "\n":
+                    yield j, "\n", depth
+            i = end
+            continue
+        if c in _CLOSE:
+            depth = max(0, depth - 1)
+        yield i, c, depth
+        if c in _OPEN:
+            depth += 1
+        i += 1
+
+
+def _statements(code: str) -> List[str]:
+    """Split script source into its top-level statements."""
+    boundaries = {0}
+    for i, c, depth in _code_chars(code):
+        if c == "\n" and depth == 0:
+            boundaries.add(i + 1)
+
+    statements: List[List[str]] = []
+    offset = 0
+    for line in code.splitlines(keepends=True):
+        starts_new = (
+            offset in boundaries
+            and line.strip()
+            and not line[0].isspace()
+            and not line.startswith(_CONTINUATION)
+        )
+        if starts_new or not statements:
+            statements.append([])
+        statements[-1].append(line)
+        offset += len(line)
+    return ["".join(lines).strip() for lines in statements]
+
+
+def _cut(statement: str, marker: str, after_params: bool = False) -> str:
+    """`statement` up to the first top-level `marker`, or the whole thing."""
+    params_closed = not after_params
+    for i, c, depth in _code_chars(statement):
+        if depth:
+            continue
+        if c == ")":
+            params_closed = True
+        elif params_closed and statement.startswith(marker, i):
+            head = statement[:i].rstrip()
+            return f"{head} => ..." if marker == "=>" else f"{head} {{ ... }}"
+    return statement
+
+
+def _first_line(statement: str) -> str:
+    first, _, rest = statement.partition("\n")
+    return f"{first} ..." if rest.strip() else first
+
+
+def summarize_script(code: str) -> str:
+    """Imports, types, and exported signatures of TypeScript/JavaScript code."""
+    parts = []
+    for statement in _statements(code):
+        if _IMPORT_RE.match(statement) or _TYPE_RE.match(statement):
+            parts.append(statement)
+        elif _FUNCTION_RE.match(statement):
+            parts.append(_cut(statement, "{", after_params=True))
+        elif _CLASS_RE.match(statement):
+            parts.append(_cut(statement, "{"))
+        elif _VARIABLE_RE.match(statement):
+            signature = _cut(statement, "=>")
+            if signature is statement and len(statement) > 200:
+                signature = _first_line(statement)
+            parts.append(signature)
+        elif statement.startswith("export"):
+            parts.append(_first_line(statement))
+    return "\n".join(parts)
+
+
+def _python_stub(node: ast.AST) -> ast.AST:
+    """Copy of a def with its body reduced to the docstring's first line."""
+    stub = copy.copy(node)
+    doc = ast.get_docstring(node)
+    summary = doc.strip().splitlines()[0] if doc else ...
+    stub.body = [ast.Expr(ast.Constant(summary))]
+    return stub
+
+
+def _public(name: str) -> bool:
+    return not name.startswith("_") or name == "__init__"
+
+
+def summarize_python(code: str) -> str:
+    """Imports, public classes (fields and method signatures) and public
+    function signatures of Python code."""
+    tree = ast.parse(code)
+    parts = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            parts.append(ast.unparse(node))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and _public(node.name):
+            parts.append(ast.unparse(_python_stub(node)))
+        elif isinstance(node, ast.ClassDef) and _public(node.name):
+            stub = copy.copy(node)
+            stub.body = [
+                _python_stub(child) if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))
+                else child
+                for child in node.body
+                if isinstance(child, (ast.AnnAssign, ast.Assign))
+                or (isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) and _public(child.name))
+            ] or [ast.Expr(ast.Constant(...))]
+            parts.append(ast.unparse(stub))
+    return "\n\n".join(parts)
+
+
+def summarize(code: str, language: str = "python") -> str:
+    """Interface summary of module `code`; empty if nothing could be extracted."""
+    try:
+        if language.lower() in SCRIPT_LANGUAGES:
+            return summarize_script(code)
+        return summarize_python(code)
+    except (SyntaxError, ValueError):
+        return ""
@@ -0,0 +1,576 @@
+import hashlib
+import json
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from artifacts import describe_file
+from cache import normalize_prompt
+import metrics
+from cancellation import BuildCancelled, CancelToken
+from sessions import SessionStore
+
+
+INTERRUPTED_ERROR = "Build interrupted by a server restart"
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the build queue (or a client's share of it) cannot accept
+    another job. `retry_after` estimates when to try again, in seconds."""
+
+    def __init__(self, message: str, retry_after: int = 1, reason: str = "queue_full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason  # "queue_full" or "client_limit"
+
+
+# Statuses of builds that published an output
+PUBLISHED = ("completed", "partial")
+
+
+def build_message(files: List[Dict[str, Any]], failed_files: List[Dict[str, str]]) -> str:
+    """Summary of a published build for clients."""
+    if not failed_files:
+        return f"Successfully generated {len(files)} files"
+    missing = ", ".join(f["filename"] for f in failed_files)
+    return f"Generated {len(files)} files; {len(failed_files)} could not be generated: {missing}"
+
+
+def new_session_id() -> str:
+    """Create a unique, time-ordered build session id."""
+    timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    return f"{timestamp}-{uuid.uuid4().hex[:6]}"
+
+
+def collect_files(output_dir: str) -> List[Dict[str, Any]]:
+    """Scan an output directory for its file manifest (when none was recorded)."""
+    files = []
+    for file_path in sorted(Path(output_dir).rglob("*")):
+        if file_path.is_file():
+            files.append(describe_file(file_path, str(file_path.relative_to(output_dir))))
+    return files
+
+
+def _process_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _boot_id() -> str:
+    try:
+        return Path("/proc/sys/kernel/random/boot_id").read_text().strip()
+    except OSError:
+        return socket.gethostname()
+
+
+def _start_time(pid: int) -> str:
+    """A process's start time in clock ticks since boot ("" where unknown)."""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except OSError:
+        return ""
+    # Fields after the parenthesized command name start at field 3 (state)
+    return stat.rsplit(")", 1)[1].split()[19]
+
+
+def instance_id() -> str:
+    """Identifies this process: boot id, pid and start time.
+
+    Unlike a bare pid, it doesn't match a later process that was given the
+    same pid (e.g. after a container restart).
+    """
+    pid = os.getpid()
+    return f"{_boot_id()}:{pid}:{_start_time(pid)}"
+
+
+def _instance_alive(record: Dict[str, Any], field: str = "worker_instance") -> bool:
+    """Whether the process that owns `record` (by its instance id) still runs."""
+    instance = record.get(field)
+    if not instance:
+        # Written before instance ids were recorded
+        return _process_alive(record.get("worker_pid"))
+    boot_id, pid, started = instance.rsplit(":", 2)
+    if boot_id != _boot_id() or not _process_alive(int(pid)):
+        return False
+    return _start_time(int(pid)) == started
+
+
+Listener = Callable[[Dict[str, Any]], None]
+
+
+class BuildJobManager:
+    """Run builds on a bounded worker pool so the event loop never blocks.
+
+    Job state lives in the shared session store and moves through
+    ``queued`` -> ``building`` -> ``completed`` / ``partial`` / ``failed`` /
+    ``cancelled`` / ``timed_out``; a ``partial`` build was published without
+    the files in its ``failed_files``. Listeners get the builder's progress events, then a
+    final ``complete``, ``error`` or ``cancelled`` event; they are called
+    from worker threads.
+
+    Identical builds submitted while one is in flight (same normalized
+    prompt, catalog, settings and base build) are coalesced: the request
+    gets its own session id, but subscribes to the running build's events
+    and result instead of starting another. A build is only cancelled once
+    every subscriber has cancelled.
+
+    Queued builds are dispatched to workers round-robin across clients, and
+    each client may have at most `max_per_client` builds in flight, so one
+    busy client can't hold every worker. Rejections carry a Retry-After
+    estimate from the queue depth and recent build durations.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionStore,
+        builder_factory: Callable[..., Any],
+        max_workers: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        catalog_hash: Optional[Callable[[], str]] = None,
+        coalesce: Optional[bool] = None,
+        max_per_client: Optional[int] = None,
+    ):
+        self.sessions = sessions
+        self.builder_factory = builder_factory
+        self.catalog_hash = catalog_hash
+        self.coalesce = (
+            coalesce if coalesce is not None else os.getenv("BUILD_COALESCE", "1") != "0"
+        )
+        self.max_workers = max_workers or int(os.getenv("BUILD_MAX_WORKERS", "8"))
+        self.max_queue = max_queue or int(os.getenv("BUILD_MAX_QUEUE", "64"))
+        self.max_per_client = (
+            max_per_client if max_per_client is not None
+            else int(os.getenv("BUILD_MAX_PER_CLIENT", "4"))
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="build"
+        )
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}
+        metrics.BUILDS_IN_FLIGHT.set_function(lambda: self.in_flight)
+        metrics.BUILDS_RUNNING.set_function(lambda: self.running)
+        self._listeners: Dict[str, List[Listener]] = {}
+        self._tokens: Dict[str, CancelToken] = {}
+        self._running = 0
+        self._queued_at: Dict[str, float] = {}
+        # Coalescing: job id (the first session's id) -> subscribed session ids,
+        # each session id -> its job, and flight key -> job
+        self._subscribers: Dict[str, List[str]] = {}
+        self._job_of: Dict[str, str] = {}
+        self._flights: Dict[str, str] = {}
+        self._flight_keys: Dict[str, str] = {}
+        # Events each job has emitted so far, replayed to sessions that attach late
+        self._history: Dict[str, List[Dict[str, Any]]] = {}
+        # Fair dispatch: client -> its queued jobs, served in turn; each job's
+        # client and the number of jobs each client has in flight
+        self._queues: "OrderedDict[str, Deque[Tuple[Any, ...]]]" = OrderedDict()
+        self._client_of: Dict[str, str] = {}
+        self._client_jobs: Dict[str, int] = {}
+        # Moving average of build durations, for Retry-After estimates
+        self._avg_build_seconds = 30.0
+
+    @property
+    def in_flight(self) -> int:
+        """Number of jobs queued or running."""
+        with self._lock:
+            return len(self._futures)
+
+    @property
+    def running(self) -> int:
+        with self._lock:
+            return self._running
+
+    def submit(self, prompt: str, session_id: Optional[str] = None,
+               use_cache: bool = True, listener: Optional[Listener] = None,
+               options: Optional[Dict[str, Any]] = None,
+               base_session_id: Optional[str] = None,
+               client_id: Optional[str] = None,
+               conversation: Optional[str] = None) -> str:
+        """Queue a build and return its session id immediately.
+
+        `options` are passed to the builder factory as keyword arguments
+        (e.g. model_name, step_models, generation_config). With
+        `base_session_id` the build incrementally refines that completed build.
+        `conversation` is earlier chat context for the analysis prompt.
+        `client_id` identifies the requester for fair scheduling and the
+        per-client limit. Raises QueueFullError when the build can't be queued.
+        """
+        session_id = session_id or new_session_id()
+        options = options or {}
+        key = self._flight_key(prompt, use_cache, options, base_session_id, conversation) \
+            if self.coalesce else None
+
+        with self._lock:
+            if session_id in self._job_of:
+                raise ValueError(f"Build {session_id} is already in progress")
+            
+            job_id = self._flights.get(key) if key else None
+            if job_id is not None:
+                # Identical build in flight: subscribe to it instead of starting another
+                job = self.sessions.get(job_id) or {}
+                self.sessions.put(session_id, {
+                    "prompt": prompt,
+                    "status": job.get("status", "queued"),
+                    "options": options,
+                    "base_session_id": base_session_id,
+                    "coalesced_with": job_id,
+                    "queued_at": datetime.utcnow().isoformat(),
+                    "worker_instance": instance_id()
+                })
+                self._subscribers[job_id].append(session_id)
+                self._job_of[session_id] = job_id
+                self._listeners[session_id] = [listener] if listener else []
+                if listener:
+                    # Catch up while holding the lock, so later events follow in order
+                    for event in self._history.get(job_id, ()):
+                        self._call(listener, {**event, "session_id": session_id})
+                metrics.BUILDS_COALESCED.inc()
+                return session_id
+            
+            if self._queue_depth() >= self.max_workers + self.max_queue:
+                metrics.BUILDS_REJECTED.inc(reason="queue_full")
+                raise QueueFullError("Build queue is full, try again later",
+                                     self._retry_after())
+            client = client_id or ""
+            if client_id and self.max_per_client \
+                    and self._client_jobs.get(client, 0) >= self.max_per_client:
+                metrics.BUILDS_REJECTED.inc(reason="client_limit")
+                raise QueueFullError(
+                    f"Too many builds in progress for this client (limit {self.max_per_client})",
+                    max(1, math.ceil(self._avg_build_seconds)), reason="client_limit"
+                )
+
+            self.sessions.put(session_id, {
+                "prompt": prompt,
+                "status": "queued",
+                "options": options,
+                "base_session_id": base_session_id,
+                "queued_at": datetime.utcnow().isoformat(),
+                "worker_instance": instance_id()
+            })
+            self._listeners[session_id] = [listener] if listener else []
+            self._tokens[session_id] = CancelToken()
+            self._queued_at[session_id] = time.monotonic()
+            self._subscribers[session_id] = [session_id]
+            self._job_of[session_id] = session_id
+            if key:
+                self._flights[key] = session_id
+                self._flight_keys[session_id] = key
+            future: Future = Future()
+            self._futures[session_id] = future
+            self._client_of[session_id] = client
+            self._client_jobs[client] = self._client_jobs.get(client, 0) + 1
+            self._dispatch(future, session_id, prompt, use_cache, options, base_session_id, client,
+                           conversation)
+
+        # A job cancelled before it started is forgotten by `cancel`
+        future.add_done_callback(lambda f: f.cancelled() or self._forget(session_id))
+        return session_id
+
+    def _queue_depth(self) -> int:
+        """Jobs queued or running (called with the lock held)."""
+        return len(self._futures)
+
+    def _dispatch(self, future: Future, session_id: str, prompt: str, use_cache: bool,
+                  options: Dict[str, Any], base_session_id: Optional[str], client: str,
+                  conversation: Optional[str] = None) -> None:
+        """Hand a new job to the workers (called with the lock held)."""
+        self._queues.setdefault(client, deque()).append(
+            (future, session_id, prompt, use_cache, options, base_session_id, conversation)
+        )
+        # Each worker task runs whichever job is next in turn
+        self._executor.submit(self._run_next)
+
+    def _cancel_job(self, job_id: str, token: CancelToken, future: Future) -> None:
+        """Stop a job that no session is waiting for any more."""
+        token.cancel()
+        if future.cancel():
+            # Never started, so _run won't report it
+            self._finish_cancelled(job_id, BuildCancelled())
+            self._forget(job_id)
+
+    def _run_next(self) -> None:
+        """Run the next queued job, taking clients in turn."""
+        with self._lock:
+            client, queue = next(iter(self._queues.items()))
+            future, *job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+        if not future.set_running_or_notify_cancel():
+            return  # cancelled while queued
+        try:
+            self._run(*job)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+    def _retry_after(self) -> int:
+        """Seconds until the queue likely has room (called with the lock held).
+
+        With every worker busy, one frees up about every average build
+        duration / max_workers seconds.
+        """
+        needed = self._queue_depth() - (self.max_workers + self.max_queue) + 1
+        return max(1, math.ceil(max(1, needed) * self._avg_build_seconds / self.max_workers))
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return self._retry_after()
+
+    def _flight_key(self, prompt: str, use_cache: bool, options: Dict[str, Any],
+                    base_session_id: Optional[str], conversation: Optional[str] = None) -> str:
+        payload = json.dumps({
+            "prompt": normalize_prompt(prompt),
+            "use_cache": use_cache,
+            "catalog": self.catalog_hash() if self.catalog_hash else None,
+            "options": options,
+            "base_session_id": base_session_id,
+            "conversation": conversation,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_future(self, session_id: str) -> Optional[Future]:
+        """Return the pending future for a session's job, or None once it has
+        finished or the session was detached from it."""
+        with self._lock:
+            job_id = self._job_of.get(session_id)
+            return self._futures.get(job_id) if job_id else None
+
+    def cancel(self, session_id: str) -> bool:
+        """Cancel a queued or running job. Returns False if it isn't in flight.
+
+        A session subscribed to a shared build is detached from it; the build
+        itself is cancelled when its last subscriber is.
+        """
+        with self._lock:
+            job_id = self._job_of.get(session_id)
+            future = self._futures.get(job_id) if job_id else None
+            token = self._tokens.get(job_id) if job_id else None
+            if future is None or token is None:
+                return False
+            subscribers = self._subscribers[job_id]
+            if len(subscribers) > 1:
+                subscribers.remove(session_id)
+                self._job_of.pop(session_id, None)
+            else:
+                session_id = None
+        
+        if session_id is not None:
+            error = BuildCancelled()
+            metrics.BUILDS.inc(status=error.reason)
+            self.sessions.update(session_id, {
+                "status": error.reason,
+                "error": str(error),
+                "completed_at": datetime.utcnow().isoformat()
+            })
+            self._emit_to(session_id, {"type": "cancelled", "status": error.reason,
+                                       "message": str(error)})
+            with self._lock:
+                self._listeners.pop(session_id, None)
+            return True
+
+        self._cancel_job(job_id, token, future)
+        return True
+
+    def add_listener(self, session_id: str, listener: Listener) -> bool:
+        """Follow a running job's events. Returns False if it has already finished."""
+        with self._lock:
+            job_id = self._job_of.get(session_id)
+            if job_id not in self._futures or session_id not in self._listeners:
+                return False
+            self._listeners[session_id].append(listener)
+            return True
+
+    def remove_listener(self, session_id: str, listener: Listener) -> None:
+        with self._lock:
+            listeners = self._listeners.get(session_id)
+            if listeners and listener in listeners:
+                listeners.remove(listener)
+
+    def _emit(self, job_id: str, event: Dict[str, Any]) -> None:
+        """Send a job's event to the listeners of every subscribed session."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(job_id, ()))
+            # Streamed chunks are left out; file_written carries the whole file
+            if self.coalesce and subscribers and event.get("type") != "file_chunk":
+                self._history.setdefault(job_id, []).append(event)
+        for session_id in subscribers:
+            self._emit_to(session_id, event)
+
+    def _emit_to(self, session_id: str, event: Dict[str, Any]) -> None:
+        with self._lock:
+            listeners = list(self._listeners.get(session_id, ()))
+        event = {**event, "session_id": session_id}
+        for listener in listeners:
+            self._call(listener, event)
+
+    @staticmethod
+    def _call(listener: Listener, event: Dict[str, Any]) -> None:
+        try:
+            listener(event)
+        except Exception as e:
+            print(f"Build event listener failed: {e}")
+
+    def _update(self, job_id: str, fields: Dict[str, Any], final: bool = False) -> None:
+        """Write fields to every session subscribed to a job.
+
+        A final update first closes the job to new subscribers, so nobody
+        attaches to a build whose result has already been handed out.
+        """
+        with self._lock:
+            if final:
+                key = self._flight_keys.pop(job_id, None)
+                if key and self._flights.get(key) == job_id:
+                    del self._flights[key]
+            subscribers = list(self._subscribers.get(job_id, ()))
+        for session_id in subscribers:
+            self.sessions.update(session_id, fields)
+
+    def shutdown(self, wait: bool = False) -> None:
+        with self._lock:
+            queued = [job[0] for queue in self._queues.values() for job in queue]
+        for future in queued:
+            future.cancel()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def worker_metrics(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Metrics snapshots of the worker processes running builds (none here)."""
+        return []
+
+    def recover_interrupted(self) -> int:
+        """Mark builds whose owning process died (e.g. a restart) as failed."""
+        recovered = 0
+        for status in ("queued", "building"):
+            offset = 0
+            while True:
+                batch = self.sessions.list(status=status, limit=100, offset=offset)
+                if not batch:
+                    break
+                for session in batch:
+                    if _instance_alive(session):
+                        offset += 1
+                        continue
+                    self.sessions.update(session["session_id"], {
+                        "status": "failed",
+                        "error": INTERRUPTED_ERROR,
+                        "completed_at": datetime.utcnow().isoformat()
+                    })
+                    recovered += 1
+        return recovered
+
+    def _forget(self, job_id: str) -> None:
+        with self._lock:
+            self._futures.pop(job_id, None)
+            self._tokens.pop(job_id, None)
+            self._queued_at.pop(job_id, None)
+            client = self._client_of.pop(job_id, None)
+            if client is not None:
+                self._client_jobs[client] -= 1
+                if not self._client_jobs[client]:
+                    del self._client_jobs[client]
+            for session_id in self._subscribers.pop(job_id, ()):
+                self._job_of.pop(session_id, None)
+            self._history.pop(job_id, None)
+            key = self._flight_keys.pop(job_id, None)
+            if key and self._flights.get(key) == job_id:
+                del self._flights[key]
+
+    def _finish(self, job_id: str, event: Dict[str, Any]) -> None:
+        """Send a job's final event and drop its subscribers' listeners."""
+        self._emit(job_id, event)
+        with self._lock:
+            self._history.pop(job_id, None)
+            for session_id in self._subscribers.get(job_id, ()):
+                self._listeners.pop(session_id, None)
+
+    def _finish_cancelled(self, job_id: str, error: BuildCancelled) -> None:
+        metrics.BUILDS.inc(status=error.reason)
+        self._update(job_id, {
+            "status": error.reason,
+            "error": str(error),
+            "completed_at": datetime.utcnow().isoformat()
+        }, final=True)
+        self._finish(job_id, {"type": "cancelled", "status": error.reason, "message": str(error)})
+
+    def _run(self, session_id: str, prompt: str, use_cache: bool, options: Dict[str, Any],
+             base_session_id: Optional[str] = None, conversation: Optional[str] = None) -> None:
+        with self._lock:
+            self._running += 1
+            token = self._tokens[session_id]
+            metrics.BUILD_QUEUE_WAIT_SECONDS.observe(time.monotonic() - self._queued_at[session_id])
+        builder = None
+
+        try:
+            token.check()
+            self._update(session_id, {
+                "status": "building",
+                "started_at": datetime.utcnow().isoformat()
+            })
+            builder = self.builder_factory(**options)
+            builder.on_event = lambda event: self._emit(session_id, event)
+            builder.cancel_token = token
+            previous = self.sessions.get(base_session_id) if base_session_id else None
+            started = time.monotonic()
+            builder.build_app(prompt, use_cache=use_cache, previous=previous,
+                              conversation=conversation)
+            with self._lock:
+                self._avg_build_seconds += 0.2 * (time.monotonic() - started - self._avg_build_seconds)
+
+            output_dir = str(builder.output_dir)
+            files = builder.manifest_files() or collect_files(output_dir)
+            status = "partial" if builder.failed_files else "completed"
+
+            self._update(session_id, {
+                "status": status,
+                "output_dir": output_dir,
+                "files": files,
+                "failed_files": builder.failed_files,
+                "retrieval": builder.retrieval_stats,
+                "timings": builder.timings,
+                "analysis": builder.analysis,
+                "fingerprints": builder.file_fingerprints,
+                "reused_files": builder.reused_files,
+                "completed_at": datetime.utcnow().isoformat()
+            }, final=True)
+            metrics.BUILDS.inc(status=status)
+            self._finish(session_id, {
+                "type": "complete",
+                "status": status,
+                "output_dir": output_dir,
+                "files": files,
+                "failed_files": builder.failed_files,
+                "reused_files": builder.reused_files,
+                "message": build_message(files, builder.failed_files)
+            })
+        except BuildCancelled as e:
+            self._finish_cancelled(session_id, e)
+        except Exception as e:
+            metrics.BUILDS.inc(status="failed")
+            self._update(session_id, {
+                "status": "failed",
+                "error": str(e),
+                "timings": builder.timings if builder else {},
+                "completed_at": datetime.utcnow().isoformat()
+            }, final=True)
+            self._finish(session_id, {"type": "error", "message": str(e)})
+        finally:
+            with self._lock:
+                self._running -= 1
@@ -0,0 +1,108 @@
+"""Incremental parsing of a JSON object that arrives in pieces.
+
+The analysis response is streamed; `ObjectStreamParser` picks complete
+top-level fields, and complete elements of top-level arrays, out of the
+text as it arrives, so work that depends on them can start before the
+rest of the document has been generated.
+"""
+import json
+from typing import Any, Callable, Optional
+
+_WHITESPACE = " \t\r\n"
+
+
+class ObjectStreamParser:
+    """Feed the text of a JSON object piece by piece.
+
+    `on_item(key, value)` is called for each element of a top-level array
+    as soon as the element is complete, and `on_field(key, value)` for each
+    top-level field once its whole value is. Raises ValueError as soon as
+    the text can't be a JSON object; the caller should then stop feeding
+    and wait for the full document.
+    """
+
+    def __init__(self, on_field: Optional[Callable[[str, Any], None]] = None,
+                 on_item: Optional[Callable[[str, Any], None]] = None):
+        self.on_field = on_field
+        self.on_item = on_item
+        self.done = False
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._expect_key = True
+        self._key: Optional[str] = None
+        self._value_start = 0
+        self._in_array = False  # the current field's value is an array
+        self._item_start = 0
+
+    def feed(self, text: str) -> None:
+        self._text += text
+        text = self._text
+        while self._pos < len(text) and not self.done:
+            i = self._pos
+            c = text[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._expect_key:
+                        self._key = json.loads(text[self._string_start:i + 1])
+                continue
+
+            if self._depth == 0:
+                if c == "{":
+                    self._depth = 1
+                elif c not in _WHITESPACE:
+                    raise ValueError(f"Expected a JSON object, got {c!r}")
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "[{":
+                if self._depth == 1 and c == "[":
+                    self._in_array = True
+                    self._item_start = i + 1
+                self._depth += 1
+            elif c in "]}":
+                if self._depth == 2 and self._in_array:
+                    self._item(i)
+                    self._in_array = False
+                self._depth -= 1
+                if self._depth == 0:
+                    if not self._expect_key:
+                        self._field(i)
+                    self.done = True
+            elif c == ":" and self._depth == 1:
+                if self._key is None:
+                    raise ValueError("Expected a field name")
+                self._expect_key = False
+                self._value_start = i + 1
+            elif c == ",":
+                if self._depth == 1:
+                    self._field(i)
+                elif self._depth == 2 and self._in_array:
+                    self._item(i)
+                    self._item_start = i + 1
+
+    def _item(self, end: int) -> None:
+        piece = self._text[self._item_start:end].strip()
+        if piece and self.on_item:
+            self.on_item(self._key, json.loads(piece))
+
+    def _field(self, end: int) -> None:
+        if self._expect_key:
+            raise ValueError("Expected a field name")
+        value = json.loads(self._text[self._value_start:end])
+        if self.on_field:
+            self.on_field(self._key, value)
+        self._expect_key = True
+        self._key = None
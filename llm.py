@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+JSON_CONFIG = {"response_mime_type": "application/json"}
+
+
+@dataclass
+class LLMResponse:
+    """Text from a model call (or one streamed chunk) with token usage if reported."""
+    text: str
+    prompt_tokens: Optional[int] = None
+    response_tokens: Optional[int] = None
+
+
+def _from_response(response: Any) -> LLMResponse:
+    usage = getattr(response, "usage_metadata", None)
+    return LLMResponse(
+        response.text or "",  # chunks without text (e.g. usage only) have None
+        getattr(usage, "prompt_token_count", None) or None,
+        getattr(usage, "candidates_token_count", None) or None,
+    )
+
+
+class LLMBackend:
+    """Interface the builder uses to reach a language model.
+
+    Backends are shared by every build in the process, so they must be
+    thread-safe and keep no per-build state. The model and generation
+    config are chosen per call; `timeout` is in seconds.
+    """
+
+    default_model = DEFAULT_MODEL
+
+    def generate(self, prompt: str, model: Optional[str] = None,
+                 generation_config: Optional[Dict[str, Any]] = None,
+                 timeout: Optional[float] = None) -> LLMResponse:
+        raise NotImplementedError
+
+    def stream(self, prompt: str, model: Optional[str] = None,
+               generation_config: Optional[Dict[str, Any]] = None,
+               timeout: Optional[float] = None) -> Iterator[LLMResponse]:
+        """Yield the response in pieces; usage is reported on the last piece."""
+        yield self.generate(prompt, model, generation_config, timeout)
+
+    def generate_json(self, prompt: str, model: Optional[str] = None,
+                      generation_config: Optional[Dict[str, Any]] = None,
+                      timeout: Optional[float] = None) -> LLMResponse:
+        """Like `generate`, asking the model for a JSON document."""
+        return self.generate(prompt, model, {**(generation_config or {}), **JSON_CONFIG}, timeout)
+
+    async def agenerate(self, prompt: str, model: Optional[str] = None,
+                        generation_config: Optional[Dict[str, Any]] = None,
+                        timeout: Optional[float] = None) -> LLMResponse:
+        return await asyncio.to_thread(self.generate, prompt, model, generation_config, timeout)
+
+    async def agenerate_json(self, prompt: str, model: Optional[str] = None,
+                             generation_config: Optional[Dict[str, Any]] = None,
+                             timeout: Optional[float] = None) -> LLMResponse:
+        return await self.agenerate(
+            prompt, model, {**(generation_config or {}), **JSON_CONFIG}, timeout
+        )
+
+    async def astream(self, prompt: str, model: Optional[str] = None,
+                      generation_config: Optional[Dict[str, Any]] = None,
+                      timeout: Optional[float] = None) -> AsyncIterator[LLMResponse]:
+        yield await self.agenerate(prompt, model, generation_config, timeout)
+
+
+class GeminiBackend(LLMBackend):
+    """Gemini through the google-genai SDK, with one client per API key.
+
+    Each backend owns a `genai.Client` for its key, so backends for
+    different keys never share credentials, and every build using a key
+    shares its client's connections. The async methods use the client's
+    native async calls (`client.aio`).
+    """
+
+    def __init__(self, api_key: str, default_model: Optional[str] = None):
+        try:
+            from google import genai
+        except ImportError as e:
+            raise RuntimeError(
+                "LLM_BACKEND=gemini needs the google-genai package "
+                "(pip install -r requirements-api.txt)"
+            ) from e
+
+        self._client = genai.Client(api_key=api_key)
+        self.default_model = default_model or DEFAULT_MODEL
+
+    @staticmethod
+    def _config(generation_config: Optional[Dict[str, Any]],
+                timeout: Optional[float]) -> Dict[str, Any]:
+        config = dict(generation_config or {})
+        if timeout is not None:
+            config["http_options"] = {"timeout": int(timeout * 1000)}  # milliseconds
+        return config
+
+    def generate(self, prompt, model=None, generation_config=None, timeout=None):
+        response = self._client.models.generate_content(
+            model=model or self.default_model, contents=prompt,
+            config=self._config(generation_config, timeout)
+        )
+        return _from_response(response)
+
+    def stream(self, prompt, model=None, generation_config=None, timeout=None):
+        for chunk in self._client.models.generate_content_stream(
+            model=model or self.default_model, contents=prompt,
+            config=self._config(generation_config, timeout)
+        ):
+            yield _from_response(chunk)
+
+    async def agenerate(self, prompt, model=None, generation_config=None, timeout=None):
+        response = await self._client.aio.models.generate_content(
+            model=model or self.default_model, contents=prompt,
+            config=self._config(generation_config, timeout)
+        )
+        return _from_response(response)
+
+    async def astream(self, prompt, model=None, generation_config=None, timeout=None):
+        response = await self._client.aio.models.generate_content_stream(
+            model=model or self.default_model, contents=prompt,
+            config=self._config(generation_config, timeout)
+        )
+        async for chunk in response:
+            yield _from_response(chunk)
+
+
+class LocalBackend(LLMBackend):
+    """Offline backend serving canned responses from fake_gemini.
+
+    Needs no API key or network; used for development, benchmarks and CI.
+    The model name is ignored.
+    """
+
+    def __init__(self, model: Optional[Any] = None, **fake_options: Any):
+        from fake_gemini import FakeGenerativeModel
+
+        self.model = model or FakeGenerativeModel(**fake_options)
+
+    @staticmethod
+    def _options(timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+        return {"timeout": timeout} if timeout is not None else None
+
+    def generate(self, prompt, model=None, generation_config=None, timeout=None):
+        return _from_response(self.model.generate_content(
+            prompt, generation_config=generation_config, request_options=self._options(timeout)
+        ))
+
+    def stream(self, prompt, model=None, generation_config=None, timeout=None):
+        for chunk in self.model.generate_content(
+            prompt, generation_config=generation_config, stream=True,
+            request_options=self._options(timeout)
+        ):
+            yield _from_response(chunk)
+
+
+_backends: Dict[Tuple[str, Optional[str]], LLMBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(api_key: Optional[str] = None) -> LLMBackend:
+    """Process-wide backend selected by the environment.
+
+    LLM_BACKEND is "gemini" (default) or "local"; LLM_MODEL sets the
+    default model. Gemini reads the key from `api_key`, GEMINI_API_KEY or
+    GOOGLE_API_KEY.
+    """
+    kind = os.getenv("LLM_BACKEND", "gemini").lower()
+    if kind == "gemini":
+        api_key = api_key or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    elif kind != "local":
+        raise ValueError(f"Unknown LLM_BACKEND: {kind}")
+
+    key = (kind, api_key)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            if kind == "local":
+                backend = LocalBackend(latency=float(os.getenv("LOCAL_LLM_LATENCY", "0")))
+            else:
+                if not api_key:
+                    raise ValueError(
+                        "Missing Gemini API key. Provide it via constructor or set GEMINI_API_KEY/GOOGLE_API_KEY environment variable."
+                    )
+                backend = GeminiBackend(api_key, os.getenv("LLM_MODEL"))
+            _backends[key] = backend
+        return backend
@@ -0,0 +1,246 @@
+import bisect
+import math
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], *extra: str) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(e for e in extra if e)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _state(self) -> Dict[Tuple[str, ...], Any]:
+        with self._lock:
+            return dict(self._values)
+
+    def _lines(self, state: Dict[Tuple[str, ...], Any], extra: str = "") -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"
+                for key, value in state.items()]
+
+    def snapshot(self) -> List[List[Any]]:
+        """Current values as JSON-friendly ``[label values, value]`` pairs."""
+        return [[list(key), value] for key, value in self._state().items()]
+
+    def render(self, others: Sequence[Tuple[str, List[List[Any]]]] = ()) -> List[str]:
+        """Exposition lines, plus those of `others` ((worker, snapshot) pairs
+        from other processes) labelled with their worker."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._lines(self._state()))
+        for worker, snapshot in others:
+            state = {tuple(key): value for key, value in snapshot}
+            lines.extend(self._lines(state, f'worker="{_escape(worker)}"'))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge set directly or computed at scrape time by `set_function`."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def _state(self) -> Dict[Tuple[str, ...], Any]:
+        if self._function is not None:
+            return {(): self._function()}
+        return super()._state()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple[str, ...], list] = {}  # key -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _state(self) -> Dict[Tuple[str, ...], Any]:
+        with self._lock:
+            return {key: [list(s[0]), s[1], s[2]] for key, s in self._values.items()}
+
+    def _lines(self, state: Dict[Tuple[str, ...], Any], extra: str = "") -> List[str]:
+        lines = []
+        for key, (counts, total, count) in state.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, extra, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key, extra)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> Dict[str, List[List[Any]]]:
+        """Every metric's values, for another process to render (see `render`)."""
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def render(self, others: Sequence[Tuple[str, Dict[str, List[List[Any]]]]] = ()) -> str:
+        """All metrics in the Prometheus text exposition format.
+
+        `others` are (worker, `snapshot`) pairs from worker processes; their
+        series are added with a ``worker`` label.
+        """
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render(
+                [(worker, snapshot[metric.name]) for worker, snapshot in others
+                 if metric.name in snapshot]
+            ))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "toshokan_build_stage_seconds", "Time spent in each build stage.", ["stage"]
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "toshokan_build_stage_errors_total", "Build stage failures.", ["stage"]
+))
+LLM_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "toshokan_llm_request_seconds", "Latency of LLM calls that reached the model.", ["step"]
+))
+LLM_REQUESTS = REGISTRY.register(Counter(
+    "toshokan_llm_requests_total", "LLM calls by step and result (ok, error, cache_hit).",
+    ["step", "result"]
+))
+LLM_PROMPT_CHARS = REGISTRY.register(Counter(
+    "toshokan_llm_prompt_chars_total", "Characters sent to the LLM.", ["step"]
+))
+LLM_RESPONSE_CHARS = REGISTRY.register(Counter(
+    "toshokan_llm_response_chars_total", "Characters received from the LLM.", ["step"]
+))
+LLM_PROMPT_TOKENS = REGISTRY.register(Counter(
+    "toshokan_llm_prompt_tokens_total", "Prompt tokens (reported by the model, else estimated).",
+    ["step"]
+))
+LLM_RESPONSE_TOKENS = REGISTRY.register(Counter(
+    "toshokan_llm_response_tokens_total", "Response tokens (reported by the model, else estimated).",
+    ["step"]
+))
+LLM_RATE_LIMIT_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "toshokan_llm_rate_limit_wait_seconds", "Time LLM calls waited for the rate limiter.", ["step"]
+))
+LLM_RATE_LIMIT_WAITING = REGISTRY.register(Gauge(
+    "toshokan_llm_rate_limit_waiting", "LLM calls currently waiting for the rate limiter."
+))
+BUILDS = REGISTRY.register(Counter(
+    "toshokan_builds_total", "Finished builds by final status.", ["status"]
+))
+BUILD_QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "toshokan_build_queue_wait_seconds", "Time builds spend queued before a worker starts them."
+))
+BUILDS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "toshokan_builds_in_flight", "Builds queued or running."
+))
+BUILDS_RUNNING = REGISTRY.register(Gauge(
+    "toshokan_builds_running", "Builds currently running on a worker."
+))
+BUILDS_REJECTED = REGISTRY.register(Counter(
+    "toshokan_builds_rejected_total", "Build requests turned away (queue_full, client_limit).",
+    ["reason"]
+))
+BUILDS_COALESCED = REGISTRY.register(Counter(
+    "toshokan_builds_coalesced_total", "Build requests served by an identical build already in flight."
+))
+GLUE_MODULE_CONTEXT = REGISTRY.register(Counter(
+    "toshokan_glue_module_context_total",
+    "Modules shown in glue prompts, by form (full code or interface summary).", ["form"]
+))
+GLUE_IN_FLIGHT = REGISTRY.register(Gauge(
+    "toshokan_glue_generations_in_flight", "Files whose glue code is being generated."
+))
+GLUE_DISPATCH = REGISTRY.register(Counter(
+    "toshokan_glue_dispatch_total",
+    "Files whose glue code started while the analysis streamed (early) or after it (late), "
+    "and early starts the final plan didn't match (discarded).", ["when"]
+))
+ANALYSIS_STREAM_FALLBACKS = REGISTRY.register(Counter(
+    "toshokan_analysis_stream_fallbacks_total",
+    "Streamed analyses that could not be parsed incrementally."
+))
+CATALOG_RELOADS = REGISTRY.register(Counter(
+    "toshokan_catalog_reloads_total", "Module catalog reloads after the file changed, by result.",
+    ["result"]
+))
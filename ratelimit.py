@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from cancellation import CancelToken
+import metrics
+
+# Longest single sleep while waiting, so cancellation is noticed promptly
+_POLL_SECONDS = 0.25
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate_per_minute`.
+
+    The bucket holds at most one minute's worth of tokens. `charge` may take
+    it below zero (e.g. for response tokens only known after a call), which
+    delays later callers until the debt is refilled.
+    """
+
+    def __init__(self, rate_per_minute: float, now: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self._refill(now)
+        # A request larger than the bucket is let through once it is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def charge(self, amount: float) -> None:
+        self.tokens -= amount
+
+
+class LLMRateLimiter:
+    """Process-wide limit on LLM requests and tokens per minute.
+
+    Every build shares it, so a burst of builds queues for upstream
+    capacity instead of running into quota errors together. Prompt tokens
+    are reserved before a call; response tokens are charged afterwards.
+    A limit of 0 disables it.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+        self.waiting = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    def acquire(self, tokens: int, cancel_token: Optional[CancelToken] = None) -> float:
+        """Block until a call of `tokens` prompt tokens may go out.
+
+        Returns the seconds spent waiting. Raises BuildCancelled if
+        `cancel_token` is cancelled (or its deadline passes) meanwhile.
+        """
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                if cancel_token is not None:
+                    cancel_token.check()
+                wait = self._reserve(tokens)
+                if wait <= 0:
+                    return time.monotonic() - started
+                time.sleep(min(wait, _POLL_SECONDS))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def _reserve(self, tokens: int) -> float:
+        """Take one request and `tokens` if available (returns 0), else
+        return the seconds until they will be."""
+        with self._lock:
+            return self._take(self.requests, self.tokens, tokens, time.monotonic())
+
+    @staticmethod
+    def _take(requests: Optional[TokenBucket], token_bucket: Optional[TokenBucket],
+              tokens: int, now: float) -> float:
+        wait = max(
+            requests.wait_time(1, now) if requests else 0.0,
+            token_bucket.wait_time(tokens, now) if token_bucket else 0.0,
+        )
+        if wait <= 0:
+            if requests:
+                requests.charge(1)
+            if token_bucket:
+                token_bucket.charge(tokens)
+        return wait
+
+    def charge(self, tokens: int) -> None:
+        """Account for tokens used beyond what `acquire` reserved."""
+        if self.tokens is not None and tokens > 0:
+            with self._lock:
+                self.tokens.charge(tokens)
+
+
+class SharedLLMRateLimiter(LLMRateLimiter):
+    """LLMRateLimiter whose buckets live in a SQLite database, so every
+    process using `path` (API and farm workers) shares one limit."""
+
+    def __init__(self, path: str, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        super().__init__(requests_per_minute, tokens_per_minute)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS rate_limits (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+
+    def _transaction(self, update: Callable[[float], Any]) -> Any:
+        # Wall-clock time, comparable across processes
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                buckets = {"requests": self.requests, "tokens": self.tokens}
+                for name, bucket in buckets.items():
+                    if bucket is None:
+                        continue
+                    row = self._db.execute(
+                        "SELECT tokens, updated FROM rate_limits WHERE name = ?", (name,)
+                    ).fetchone()
+                    bucket.tokens, bucket.updated = row if row else (bucket.capacity, now)
+                result = update(now)
+                for name, bucket in buckets.items():
+                    if bucket is not None:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO rate_limits (name, tokens, updated) "
+                            "VALUES (?, ?, ?)", (name, bucket.tokens, bucket.updated)
+                        )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return result
+
+    def _reserve(self, tokens: int) -> float:
+        return self._transaction(lambda now: self._take(self.requests, self.tokens, tokens, now))
+
+    def charge(self, tokens: int) -> None:
+        if self.tokens is not None and tokens > 0:
+            self._transaction(lambda now: self.tokens.charge(tokens))
+
+
+_shared_limiter: Optional[LLMRateLimiter] = None
+_shared_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> LLMRateLimiter:
+    """Return the process-wide limiter, configured by LLM_RPM and LLM_TPM.
+
+    With BUILD_EXECUTION=farm the limit is shared by the API and every
+    worker process through the build queue database (BUILD_QUEUE_PATH).
+    """
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            rpm, tpm = float(os.getenv("LLM_RPM", "0")), float(os.getenv("LLM_TPM", "0"))
+            if (rpm or tpm) and os.getenv("BUILD_EXECUTION", "local").lower() == "farm":
+                _shared_limiter = SharedLLMRateLimiter(
+                    os.getenv("BUILD_QUEUE_PATH", ".data/build_queue.sqlite3"), rpm, tpm
+                )
+            else:
+                _shared_limiter = LLMRateLimiter(rpm, tpm)
+            limiter = _shared_limiter
+            metrics.LLM_RATE_LIMIT_WAITING.set_function(lambda: limiter.waiting)
+        return _shared_limiter
@@ -0,0 +1,370 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from catalog import INDEX_FILE, CatalogDirectory, may_be_preview, module_metadata
+from interfaces import summarize
+import metrics
+
+
+def _freeze(value: Any) -> Any:
+    """Recursively turn dicts and lists into read-only equivalents."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """Inverse of `_freeze`, for serializing."""
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+@dataclass(frozen=True)
+class EncodedBody:
+    """A JSON response body, serialized and gzipped once."""
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+
+class _LRUCache:
+    """Small thread-safe LRU of values loaded on demand."""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._items: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, load: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        value = load()
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return value
+
+
+class ModuleRegistry:
+    """Immutable, indexed view of the module catalog.
+
+    `modules` holds each module's metadata (see catalog.METADATA_FIELDS)
+    as read-only mappings; lookups by id, language and setup requirement
+    are O(1). Full modules (with code) and the prompt fragments rendered
+    from them are loaded on demand through a small LRU, so a large sharded
+    catalog only keeps its metadata in memory. A sharded catalog's metadata
+    holds documentation previews; `documentation` loads the full text. A
+    registry is a snapshot:
+    `get_registry` swaps in a new one when the catalog file changes, and
+    builds keep the one they started with.
+    """
+
+    def __init__(self, modules: List[Dict[str, Any]], content_hash: str,
+                 load_module: Optional[Callable[[str], Dict[str, Any]]] = None,
+                 cache_size: Optional[int] = None):
+        """`modules` are full modules, or only their metadata when
+        `load_module` (module id -> full module) is given."""
+        self.content_hash = content_hash
+        # Modules whose documentation in `modules` may be a preview
+        self._previews: frozenset = frozenset()
+        if load_module is None:
+            bodies = {m['module_id']: m for m in modules}
+            load_module = bodies.__getitem__
+            modules = [module_metadata(m, preview=False) for m in modules]
+        else:
+            self._previews = frozenset(
+                m['module_id'] for m in modules if may_be_preview(m.get('documentation', ''))
+            )
+        self._load_module = load_module
+        self._cache = _LRUCache(cache_size or int(os.getenv("CATALOG_CACHE_SIZE", "256")))
+        self.modules: Tuple[Mapping[str, Any], ...] = tuple(_freeze(m) for m in modules)
+
+        by_id: Dict[str, Mapping[str, Any]] = {}
+        by_language: Dict[str, List[Mapping[str, Any]]] = {}
+        for module in self.modules:
+            by_id[module['module_id']] = module
+            language = module.get('language', 'python').lower()
+            by_language.setdefault(language, []).append(module)
+        self._by_id = MappingProxyType(by_id)
+        self._by_language = MappingProxyType({k: tuple(v) for k, v in by_language.items()})
+        self.setup_required: Tuple[Mapping[str, Any], ...] = tuple(
+            m for m in self.modules if m.get('setup_required')
+        )
+
+        # Analysis prompts only need metadata, for any part of the catalog;
+        # modules with a documentation preview are rendered on demand
+        self._context_fragments = MappingProxyType({
+            m['module_id']: self._render_context_fragment(m)
+            for m in modules if m['module_id'] not in self._previews
+        })
+        self._context_chars: Optional[int] = None
+        self._encoded: Dict[str, EncodedBody] = {}
+        self._encoded_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str = "modules.json") -> "ModuleRegistry":
+        """Load a modules.json array, or a sharded catalog directory (see catalog.py)."""
+        if Path(path).is_dir():
+            catalog = CatalogDirectory(path)
+            return cls(catalog.metadata, catalog.content_hash, load_module=catalog.load)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        return cls(json.loads(raw), hashlib.sha256(raw).hexdigest())
+
+    def _full(self, module_id: str) -> Tuple[Dict[str, Any], Mapping[str, Any]]:
+        """The full module, as loaded and frozen."""
+        def _load():
+            module = self._load_module(module_id)
+            return module, _freeze(module)
+        return self._cache.get(("module", module_id), _load)
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+    def __contains__(self, module_id: str) -> bool:
+        return module_id in self._by_id
+
+    def metadata(self, module_id: str) -> Optional[Mapping[str, Any]]:
+        """A module's metadata, without loading the module."""
+        return self._by_id.get(module_id)
+
+    def get(self, module_id: str) -> Optional[Mapping[str, Any]]:
+        """The full module (with code), loaded on demand."""
+        if module_id not in self._by_id:
+            return None
+        return self._full(module_id)[1]
+
+    def get_many(self, module_ids: Iterable[str]) -> List[Mapping[str, Any]]:
+        """Return the known modules for `module_ids`, in the given order."""
+        return [self._full(i)[1] for i in module_ids if i in self._by_id]
+
+    def by_language(self, language: str) -> Tuple[Mapping[str, Any], ...]:
+        return self._by_language.get(language.lower(), ())
+
+    def documentation(self, module_id: str) -> str:
+        """A module's full documentation (loading the module if the metadata
+        only has a preview). Raises KeyError for unknown modules."""
+        if module_id in self._previews:
+            return self._full(module_id)[0].get('documentation', '')
+        return self._by_id[module_id].get('documentation', '')
+
+    def context_fragment(self, module_id: str) -> str:
+        """Module summary used in the analysis prompt."""
+        fragment = self._context_fragments.get(module_id)
+        if fragment is not None:
+            return fragment
+        if module_id not in self._previews:
+            raise KeyError(module_id)
+        return self._cache.get(
+            ("context", module_id),
+            lambda: self._render_context_fragment(self._full(module_id)[0])
+        )
+
+    def context_chars(self) -> int:
+        """Length of every module's analysis fragment together (computed once)."""
+        if self._context_chars is None:
+            self._context_chars = sum(len(self.context_fragment(m['module_id']))
+                                      for m in self.modules)
+        return self._context_chars
+
+    def glue_fragment(self, module_id: str) -> str:
+        """Module details (including code) used in the glue code prompt."""
+        if module_id not in self._by_id:
+            raise KeyError(module_id)
+        return self._cache.get(
+            ("glue", module_id), lambda: self._render_glue_fragment(self._full(module_id)[0])
+        )
+
+    def summary_fragment(self, module_id: str) -> str:
+        """Module details with an interface summary instead of the code.
+
+        Same as `glue_fragment` when no summary could be extracted.
+        """
+        if module_id not in self._by_id:
+            raise KeyError(module_id)
+        return self._cache.get(
+            ("summary", module_id), lambda: self._render_summary_fragment(self._full(module_id)[0])
+        )
+
+    def to_json(self) -> str:
+        """The catalog serialized as a JSON array (loads every module)."""
+        return "[" + ", ".join(json.dumps(self._load_module(m['module_id'])) for m in self.modules) + "]"
+
+    def _encode(self, key: str, etag: str, render) -> EncodedBody:
+        with self._encoded_lock:
+            encoded = self._encoded.get(key)
+            if encoded is None:
+                body = render().encode("utf-8")
+                encoded = self._encoded[key] = EncodedBody(
+                    body, gzip.compress(body, mtime=0), etag
+                )
+            return encoded
+
+    def catalog_body(self, include_code: bool = True) -> EncodedBody:
+        """`{"modules": [...], "count": n}` with full modules, or with metadata
+        only (documentation cut to a preview)."""
+        if include_code:
+            return self._encode(
+                "full", f'"{self.content_hash[:32]}-full"',
+                lambda: f'{{"modules": {self.to_json()}, "count": {len(self)}}}'
+            )
+        return self._encode(
+            "listing", f'"{self.content_hash[:32]}-listing"',
+            lambda: json.dumps({"modules": [module_metadata(_thaw(m)) for m in self.modules],
+                                "count": len(self)})
+        )
+
+    def module_body(self, module_id: str) -> Optional[EncodedBody]:
+        """One module as JSON, or None if it isn't in the catalog."""
+        if module_id not in self._by_id:
+            return None
+
+        def _render() -> EncodedBody:
+            body = json.dumps(self._full(module_id)[0]).encode("utf-8")
+            etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            return EncodedBody(body, gzip.compress(body, mtime=0), etag)
+        return self._cache.get(("body", module_id), _render)
+
+    @staticmethod
+    def _render_context_fragment(module: Dict[str, Any]) -> str:
+        return f"""
+Module ID: {module['module_id']}
+Name: {module['module_name']}
+Inputs: {', '.join(module['inputs'])}
+Outputs: {', '.join(module['outputs'])}
+Documentation: {module['documentation']}
+---
+"""
+
+    @staticmethod
+    def _render_glue_fragment(module: Dict[str, Any]) -> str:
+        return f"""
+Module: {module['module_name']}
+Inputs: {module['inputs']}
+Outputs: {module['outputs']}
+Code:
+{module['code']}
+"""
+
+    @classmethod
+    def _render_summary_fragment(cls, module: Dict[str, Any]) -> str:
+        summary = summarize(module['code'], module.get('language', 'python'))
+        if not summary:
+            return cls._render_glue_fragment(module)
+        return f"""
+Module: {module['module_name']}
+Inputs: {module['inputs']}
+Outputs: {module['outputs']}
+Interface (imports, types and signatures; the full code is added to the file as-is):
+{summary}
+"""
+
+
+# Path -> [current snapshot, (mtime_ns, size) it was loaded from, last check]
+_registries: Dict[str, List[Any]] = {}
+_registries_lock = threading.Lock()
+# Paths with a background reload check in progress (see `current_content_hash`)
+_refreshing: set = set()
+
+
+def _file_stamp(path: str) -> Tuple[int, int]:
+    # A sharded catalog changes when its index is replaced
+    stat = os.stat(Path(path) / INDEX_FILE if os.path.isdir(path) else path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_registry(path: Optional[str] = None) -> ModuleRegistry:
+    """Return the current registry snapshot for `path`, loading it on first use.
+
+    `path` defaults to MODULE_CATALOG: a modules.json file (the default) or
+    a sharded catalog directory.
+
+    At most every CATALOG_RELOAD_INTERVAL seconds (0 disables reloading)
+    the file's mtime and size are checked; if they changed, the catalog is
+    loaded again and swapped in. A catalog that fails to load is reported
+    and the previous snapshot stays in use.
+    """
+    path = path or os.getenv("MODULE_CATALOG", "modules.json")
+    key = str(Path(path).resolve())
+    now = time.monotonic()
+    with _registries_lock:
+        entry = _registries.get(key)
+        if entry is None:
+            stamp = _file_stamp(path)
+            registry = ModuleRegistry.from_file(path)
+            _registries[key] = [registry, stamp, now]
+            return registry
+
+        registry, stamp, checked = entry
+        interval = float(os.getenv("CATALOG_RELOAD_INTERVAL", "2"))
+        if not interval or now - checked < interval:
+            return registry
+        entry[2] = now
+        try:
+            current = _file_stamp(path)
+        except OSError:
+            return registry
+        if current == stamp:
+            return registry
+
+        entry[1] = current
+        try:
+            reloaded = ModuleRegistry.from_file(path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            metrics.CATALOG_RELOADS.inc(result="error")
+            print(f"Module catalog {path} could not be reloaded, keeping the previous one: {e}")
+            return registry
+        if reloaded.content_hash != registry.content_hash:
+            entry[0] = reloaded
+            metrics.CATALOG_RELOADS.inc(result="ok")
+            print(f"Module catalog reloaded from {path}: {len(reloaded)} modules")
+        return entry[0]
+
+
+def current_content_hash(path: Optional[str] = None) -> Optional[str]:
+    """Content hash of the current snapshot for `path`, without blocking on disk.
+
+    Safe to call from the event loop: when a reload check is due (see
+    `get_registry`), it runs on a background thread and the hash it swaps
+    in is returned from then on. None until the catalog is first loaded.
+    """
+    path = path or os.getenv("MODULE_CATALOG", "modules.json")
+    key = str(Path(path).resolve())
+    interval = float(os.getenv("CATALOG_RELOAD_INTERVAL", "2"))
+    with _registries_lock:
+        entry = _registries.get(key)
+        due = entry is None or (interval and time.monotonic() - entry[2] >= interval)
+        start = due and key not in _refreshing
+        if start:
+            _refreshing.add(key)
+        content_hash = entry[0].content_hash if entry else None
+
+    if start:
+        def _refresh() -> None:
+            try:
+                get_registry(path)
+            except Exception as e:
+                print(f"Module catalog {path} could not be loaded: {e}")
+            finally:
+                with _registries_lock:
+                    _refreshing.discard(key)
+
+        threading.Thread(target=_refresh, name="catalog-refresh", daemon=True).start()
+    return content_hash
@@ -0,0 +1,129 @@
+import math
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from registry import ModuleRegistry
+
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+_CAMEL_RE = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens, splitting camelCase/snake_case and adding joined
+    neighbours so "sign up" and "signup" match each other."""
+    words = []
+    for word in _WORD_RE.findall(_CAMEL_RE.sub(" ", text)):
+        word = word.lower()
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return words + [a + b for a, b in zip(words, words[1:])]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for prompt budgeting."""
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class RetrievalResult:
+    module_ids: List[str]
+    scores: Dict[str, float] = field(default_factory=dict)
+    fallback: Optional[str] = None  # why the full catalog was used, if it was
+
+
+class ModuleRetriever:
+    """BM25 ranking of catalog modules against a user prompt.
+
+    The index covers each module's id, name (weighted double), full
+    documentation, inputs and outputs, and is built once per registry.
+    """
+
+    def __init__(self, registry: ModuleRegistry, k1: float = 1.5, b: float = 0.75):
+        self.registry = registry
+        self.k1 = k1
+        self.b = b
+
+        self._ids: List[str] = []
+        self._tfs: List[Counter] = []
+        self._lengths: List[int] = []
+        df: Counter = Counter()
+        for module in registry.modules:
+            tokens = tokenize(" ".join([
+                module['module_id'].replace("_", " "),
+                module['module_name'],
+                module['module_name'],
+                registry.documentation(module['module_id']),
+                " ".join(module.get('inputs', ())),
+                " ".join(module.get('outputs', ())),
+            ]))
+            tf = Counter(tokens)
+            self._ids.append(module['module_id'])
+            self._tfs.append(tf)
+            self._lengths.append(len(tokens))
+            df.update(tf.keys())
+
+        n = len(self._ids)
+        self._avg_length = (sum(self._lengths) / n) if n else 0.0
+        self._idf = {
+            term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()
+        }
+
+    def rank(self, query: str) -> List[Tuple[str, float]]:
+        """Score every module against `query`, best first."""
+        terms = [t for t in set(tokenize(query)) if t in self._idf]
+        scored = []
+        for module_id, tf, length in zip(self._ids, self._tfs, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_length) if self._avg_length else self.k1
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self._idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            scored.append((module_id, score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored
+
+    def select(self, query: str, top_k: int, margin: float = 0.9) -> RetrievalResult:
+        """Pick candidate modules for `query`.
+
+        Modules scoring within `margin` of the k-th best are kept as well, and
+        the whole catalog is returned when ranking can't be trusted.
+        """
+        all_ids = list(self._ids)
+        if top_k <= 0:
+            return RetrievalResult(all_ids, fallback="disabled")
+        if len(all_ids) <= top_k:
+            return RetrievalResult(all_ids, fallback="catalog_small")
+
+        ranked = self.rank(query)
+        scores = dict(ranked)
+        if ranked[0][1] <= 0:
+            return RetrievalResult(all_ids, scores, fallback="no_match")
+
+        cutoff = ranked[top_k - 1][1] * margin
+        chosen = {module_id for i, (module_id, score) in enumerate(ranked)
+                  if score > 0 and (i < top_k or score >= cutoff)}
+        # Keep catalog order so prompts (and cache keys) are stable
+        return RetrievalResult([i for i in all_ids if i in chosen], scores)
+
+
+# Indexes of the most recent catalog snapshots (older ones are rebuilt on demand)
+_MAX_RETRIEVERS = 2
+_retrievers: Dict[str, ModuleRetriever] = {}
+_retrievers_lock = threading.Lock()
+
+
+def get_retriever(registry: ModuleRegistry) -> ModuleRetriever:
+    """Return the shared retriever for a registry, building its index once."""
+    with _retrievers_lock:
+        retriever = _retrievers.pop(registry.content_hash, None)
+        if retriever is None:
+            retriever = ModuleRetriever(registry)
+        _retrievers[registry.content_hash] = retriever
+        while len(_retrievers) > _MAX_RETRIEVERS:
+            del _retrievers[next(iter(_retrievers))]
+        return retriever
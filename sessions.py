@@ -0,0 +1,298 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+
+class SessionStore:
+    """Key/value store for session dicts with status and time-ordered listing.
+
+    Stored dicts are copied in and out, so callers must write changes back
+    with `put` or `update` rather than mutating what `get` returns. Sessions
+    with a true ``pinned`` field are never expired or evicted.
+    """
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def put(self, session_id: str, data: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def update(self, session_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Merge `fields` into a session (creating it if needed) and return it."""
+        data = self.get(session_id) or {}
+        data.update(fields)
+        self.put(session_id, data)
+        return data
+
+    def update_if(self, session_id: str, fields: Dict[str, Any],
+                  condition: Callable[[Dict[str, Any]], bool]) -> Optional[Dict[str, Any]]:
+        """Merge `fields` only if `condition` holds for the current session
+        (``{}`` when there is none); returns the session, or None if it didn't."""
+        data = self.get(session_id) or {}
+        if not condition(data):
+            return None
+        data.update(fields)
+        self.put(session_id, data)
+        return data
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def list(self, status: Optional[str] = None, limit: int = 50, offset: int = 0,
+             since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Sessions newest first, each with its ``session_id``, optionally filtered
+        by status and by creation time (epoch seconds)."""
+        raise NotImplementedError
+
+    def expire(self) -> int:
+        """Drop unpinned sessions idle for longer than the TTL; returns how many."""
+        raise NotImplementedError
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def start_expiry(self, interval: float = 300.0) -> None:
+        """Run `expire` periodically on a daemon thread."""
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire()
+                except Exception as e:
+                    print(f"Session expiry failed: {e}")
+
+        threading.Thread(target=_loop, name="session-expiry", daemon=True).start()
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store bounded by entry count (LRU) and idle TTL."""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # id -> (data, created, updated)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > self.ttl_seconds and not entry[0].get("pinned"):
+                del self._data[session_id]
+                return None
+            self._data.move_to_end(session_id)
+            return dict(entry[0])
+
+    def put(self, session_id: str, data: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(session_id)
+            created = entry[1] if entry else now
+            self._data[session_id] = (dict(data), created, now)
+            self._data.move_to_end(session_id)
+            self._evict()
+
+    def update(self, session_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return self.update_if(session_id, fields, lambda data: True)
+
+    def update_if(self, session_id: str, fields: Dict[str, Any],
+                  condition: Callable[[Dict[str, Any]], bool]) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(session_id)
+            data = dict(entry[0]) if entry else {}
+            if not condition(data):
+                return None
+            data.update(fields)
+            self._data[session_id] = (data, entry[1] if entry else now, now)
+            self._data.move_to_end(session_id)
+            self._evict()
+            return dict(data)
+
+    def _evict(self) -> None:
+        """Drop the least recently used unpinned sessions beyond `max_entries`."""
+        excess = len(self._data) - self.max_entries
+        if excess <= 0:
+            return
+        for key in [k for k, (data, _, _) in self._data.items() if not data.get("pinned")][:excess]:
+            del self._data[key]
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._data.pop(session_id, None)
+
+    def list(self, status: Optional[str] = None, limit: int = 50, offset: int = 0,
+             since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = list(self._data.items())
+        matches = [
+            (created, {"session_id": session_id, **data})
+            for session_id, (data, created, _) in entries
+            if (status is None or data.get("status") == status)
+            and (since is None or created >= since)
+            and (until is None or created < until)
+        ]
+        matches.sort(key=lambda item: item[0], reverse=True)
+        return [data for _, data in matches[offset:offset + limit]]
+
+    def expire(self) -> int:
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            stale = [k for k, (data, _, updated) in self._data.items()
+                     if updated < cutoff and not data.get("pinned")]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Durable store in a SQLite database (WAL mode), shareable across processes.
+
+    Several namespaces (e.g. "build" and "chat") can share one database file.
+    """
+
+    def __init__(self, path: str, namespace: str, ttl_seconds: float = 30 * 24 * 3600):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS sessions (
+                    namespace TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    status TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (namespace, session_id)
+                )"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_status "
+                "ON sessions(namespace, status, created_at)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_created ON sessions(namespace, created_at)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(namespace, updated_at)"
+            )
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM sessions WHERE namespace = ? AND session_id = ?",
+                (self.namespace, session_id),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, session_id: str, data: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                """INSERT INTO sessions (namespace, session_id, status, created_at, updated_at, data)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (namespace, session_id) DO UPDATE SET
+                       status = excluded.status,
+                       updated_at = excluded.updated_at,
+                       data = excluded.data""",
+                (self.namespace, session_id, data.get("status"), now, now, json.dumps(data)),
+            )
+
+    def update(self, session_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return self.update_if(session_id, fields, lambda data: True)
+
+    def update_if(self, session_id: str, fields: Dict[str, Any],
+                  condition: Callable[[Dict[str, Any]], bool]) -> Optional[Dict[str, Any]]:
+        # Read-modify-write in one transaction so concurrent updates don't interleave
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT data FROM sessions WHERE namespace = ? AND session_id = ?",
+                    (self.namespace, session_id),
+                ).fetchone()
+                data = json.loads(row[0]) if row else {}
+                if not condition(data):
+                    self._db.execute("ROLLBACK")
+                    return None
+                data.update(fields)
+                now = time.time()
+                self._db.execute(
+                    """INSERT INTO sessions (namespace, session_id, status, created_at, updated_at, data)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (namespace, session_id) DO UPDATE SET
+                           status = excluded.status,
+                           updated_at = excluded.updated_at,
+                           data = excluded.data""",
+                    (self.namespace, session_id, data.get("status"), now, now, json.dumps(data)),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return data
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM sessions WHERE namespace = ? AND session_id = ?",
+                (self.namespace, session_id),
+            )
+
+    def list(self, status: Optional[str] = None, limit: int = 50, offset: int = 0,
+             since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        query = "SELECT session_id, data FROM sessions WHERE namespace = ?"
+        params: List[Any] = [self.namespace]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        if since is not None:
+            query += " AND created_at >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND created_at < ?"
+            params.append(until)
+        query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [{"session_id": session_id, **json.loads(data)} for session_id, data in rows]
+
+    def expire(self) -> int:
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM sessions WHERE namespace = ? AND updated_at < ? "
+                "AND NOT coalesce(json_extract(data, '$.pinned'), 0)",
+                (self.namespace, time.time() - self.ttl_seconds),
+            )
+        return cursor.rowcount
+
+
+def create_session_store(namespace: str) -> SessionStore:
+    """Build the session store selected by the environment.
+
+    SESSION_STORE is "sqlite" (default, at SESSION_DB_PATH) or "memory";
+    SESSION_TTL and SESSION_MAX_ENTRIES bound how much is kept.
+    """
+    kind = os.getenv("SESSION_STORE", "sqlite").lower()
+    ttl = float(os.getenv("SESSION_TTL", str(30 * 24 * 3600)))
+    if kind == "memory":
+        return MemorySessionStore(
+            max_entries=int(os.getenv("SESSION_MAX_ENTRIES", "10000")), ttl_seconds=ttl
+        )
+    if kind == "sqlite":
+        return SQLiteSessionStore(
+            os.getenv("SESSION_DB_PATH", ".data/sessions.sqlite3"), namespace, ttl_seconds=ttl
+        )
+    raise ValueError(f"Unknown SESSION_STORE: {kind}")
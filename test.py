@@ -1,18 +1,45 @@
+import hashlib
 import json
 import os
 import re
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import Callable, List, Dict, Any, Optional, Tuple
 
 try:
     from dotenv import load_dotenv
 except ImportError:  # pragma: no cover - optional dependency
     load_dotenv = None
-import google.generativeai as genai
+
+from artifacts import ArtifactWriter, resolve_path
+from blobstore import BlobStore, get_blob_store
+from cache import ResponseCache, get_response_cache
+from cancellation import BuildCancelled, CancelToken
+from jsonstream import ObjectStreamParser
+from llm import JSON_CONFIG, LLMBackend, get_backend
+import metrics
+from ratelimit import LLMRateLimiter, get_rate_limiter
+from registry import ModuleRegistry, get_registry
+from retrieval import estimate_tokens, get_retriever
+
+# Written from templates by the builder; a planned file with one of these
+# names is not generated, so the template wins as it always has
+SUPPORTING_FILES = ("requirements.txt", "main.py", "README.md")
+
+_env_loaded = False
+
 
 def _load_env_file() -> None:
-    """Load environment variables from .env when possible."""
+    """Load environment variables from .env when possible (once per process)."""
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
     env_path = Path(".env")
 
     if load_dotenv:
@@ -33,55 +60,307 @@ def _load_env_file() -> None:
 
 
 class ModuleBasedAppBuilder:
-    def __init__(self, api_key: Optional[str] = None, modules_path: str = "modules.json"):
-        """Initialize the app builder with Gemini API and load modules."""
-        _load_env_file()
+    def __init__(self, api_key: Optional[str] = None, modules_path: Optional[str] = None,
+                 max_concurrent_files: Optional[int] = None,
+                 cache: Optional[ResponseCache] = None,
+                 registry: Optional[ModuleRegistry] = None,
+                 retrieval_top_k: Optional[int] = None,
+                 backend: Optional[LLMBackend] = None,
+                 model_name: Optional[str] = None,
+                 step_models: Optional[Dict[str, str]] = None,
+                 generation_config: Optional[Dict[str, Any]] = None,
+                 blob_store: Optional[BlobStore] = None,
+                 glue_context: Optional[str] = None,
+                 glue_context_budget: Optional[int] = None,
+                 rate_limiter: Optional[LLMRateLimiter] = None,
+                 pipeline: Optional[bool] = None):
+        """Initialize the app builder with an LLM backend and load modules.
 
-        resolved_api_key = api_key or os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-        if not resolved_api_key:
-            raise ValueError(
-                "Missing Gemini API key. Provide it via constructor or set GEMINI_API_KEY/GOOGLE_API_KEY environment variable."
-            )
+        The backend defaults to the shared process-wide one (see llm.get_backend),
+        so constructing a builder per request is cheap. `step_models` routes
+        individual steps ("analysis", "glue") to other models than `model_name`,
+        and `generation_config` overrides the default sampling settings.
+        `glue_context` is how module code appears in glue prompts (see
+        `glue_module_details`). With `pipeline` the analysis is streamed and
+        files start generating while it is still arriving.
+        """
+        _load_env_file()
 
-        genai.configure(api_key=resolved_api_key)
-        
-        # Configure Gemini 2.0 Flash
-        self.model = genai.GenerativeModel(
-            'gemini-2.0-flash',
-            generation_config={
-                "temperature": 0.2,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-        )
+        self.backend = backend or get_backend(api_key)
+        # Requests/tokens per minute, shared by every build in the process
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.model_name = model_name or os.getenv("LLM_MODEL") or self.backend.default_model
+        # Cheap steps (analysis) and expensive ones (glue code) can use different models
+        self.step_models = {
+            step: name for step, name in (
+                ("analysis", os.getenv("LLM_ANALYSIS_MODEL")),
+                ("glue", os.getenv("LLM_GLUE_MODEL")),
+            ) if name
+        }
+        self.step_models.update(step_models or {})
+        self.generation_config = {
+            "temperature": 0.2,
+            "top_p": 0.95,
+            "top_k": 40,
+            "max_output_tokens": 8192,
+            **(generation_config or {}),
+        }
         
-        # Load modules from JSON
-        with open(modules_path, 'r') as f:
-            self.modules = json.load(f)
+        # Shared, indexed module catalog (loaded once per process)
+        self.registry = registry or get_registry(modules_path)
+        self.modules = self.registry.modules
+        self.catalog_hash = self.registry.content_hash
+
+        # Shared LLM response cache; disabled per build with use_cache=False
+        self.cache = cache if cache is not None else get_response_cache()
+        self.use_cache = True
+        self.conversation: Optional[str] = None
         
         self.output_root = Path("outputs")
         self.output_root.mkdir(exist_ok=True)
+        # Identical file contents are stored once and hard-linked into builds
+        self.blob_store = blob_store if blob_store is not None else get_blob_store()
         self.output_dir: Optional[Path] = None
+        # Stages the build's files and publishes output_dir once all are written
+        self.writer: Optional[ArtifactWriter] = None
+        # Size/mtime/hash of each written file, keyed by relative path
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+
+        # How many files may have glue code generated at the same time
+        self.max_concurrent_files = max(
+            1, max_concurrent_files or int(os.getenv("GLUE_MAX_CONCURRENCY", "4"))
+        )
+        self.failed_files: List[Dict[str, str]] = []
+        # Start each file's glue code as soon as the streamed analysis describes it
+        self.pipeline = (
+            pipeline if pipeline is not None else os.getenv("BUILD_PIPELINE", "1") != "0"
+        )
+
+        # Plan of the last build, with a fingerprint of each file's glue inputs
+        # so a later rebuild can reuse files whose inputs did not change
+        self.analysis: Optional[Dict[str, Any]] = None
+        self.file_fingerprints: Dict[str, str] = {}
+        self.reused_files: List[str] = []
+
+        # Only the top-k most relevant modules go into the analysis prompt (0 = all)
+        self.retrieval_top_k = (
+            retrieval_top_k if retrieval_top_k is not None
+            else int(os.getenv("RETRIEVAL_TOP_K", "8"))
+        )
+        self.retrieval_stats: Dict[str, Any] = {}
+
+        # Glue prompts show module code in full or as an interface summary;
+        # "auto" uses full code for the smallest modules that fit the budget (tokens)
+        self.glue_context = (glue_context or os.getenv("GLUE_MODULE_CONTEXT", "auto")).lower()
+        if self.glue_context not in ("auto", "summary", "full"):
+            raise ValueError(f"Unknown glue module context: {self.glue_context}")
+        self.glue_context_budget = (
+            glue_context_budget if glue_context_budget is not None
+            else int(os.getenv("GLUE_CONTEXT_TOKEN_BUDGET", "600"))
+        )
+
+        # Receives progress events (dicts with a "type") from any build thread
+        self.on_event: Optional[Callable[[Dict[str, Any]], None]] = None
+
+        # Cancellation and deadlines (seconds; 0 disables a limit)
+        self.cancel_token = CancelToken()
+        self.build_timeout = float(os.getenv("BUILD_TIMEOUT", "600"))
+        self.analysis_timeout = float(os.getenv("ANALYSIS_TIMEOUT", "120"))
+        self.file_timeout = float(os.getenv("FILE_TIMEOUT", "180"))
+
+        # Per-stage timing breakdown of the last build
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self._timings_lock = threading.Lock()
     
-    def get_modules_context(self) -> str:
-        """Create a context string with all available modules."""
-        context = "Available Modules:\n\n"
-        for module in self.modules:
-            context += f"""
-Module ID: {module['module_id']}
-Name: {module['module_name']}
-Inputs: {', '.join(module['inputs'])}
-Outputs: {', '.join(module['outputs'])}
-Documentation: {module['documentation']}
----
-"""
-        return context
+    @contextmanager
+    def _stage(self, stage: str):
+        """Time a build stage into the metrics and this build's breakdown."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BuildCancelled:
+            raise
+        except Exception:
+            metrics.STAGE_ERRORS.inc(stage=stage)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.STAGE_SECONDS.observe(elapsed, stage=stage)
+            with self._timings_lock:
+                timing = self.timings.setdefault(
+                    stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+                )
+                timing["count"] += 1
+                timing["total_seconds"] += elapsed
+                timing["max_seconds"] = max(timing["max_seconds"], elapsed)
+    
+    def _emit(self, event_type: str, **data: Any) -> None:
+        """Send a progress event to the listener, if there is one."""
+        if self.on_event:
+            self.on_event({"type": event_type, **data})
+    
+    def _generate_text(self, prompt: str, json_output: bool = False,
+                       validate=None, on_chunk: Optional[Callable[[str], None]] = None,
+                       timeout: Optional[float] = None, step: str = "llm",
+                       cancel_token: Optional[CancelToken] = None,
+                       user_prompt: Optional[str] = None) -> str:
+        """Call the LLM, serving repeated prompts from the response cache.
+
+        The model is picked per step (see `step_models`). `validate` is called
+        on fresh responses before they are cached, so unusable output (e.g.
+        malformed JSON) is never stored. When `on_chunk` is given the response
+        is streamed and passed along piece by piece. The call is limited to
+        `timeout` seconds and the build's deadline; time spent waiting for
+        the rate limiter only counts against the deadline. `cancel_token`
+        (default: the build's) stops the call. `user_prompt` is the user's
+        text within `prompt`, which the cache key matches loosely (see
+        `ResponseCache.make_key`).
+        """
+        cancel_token = cancel_token or self.cancel_token
+        model = self.step_models.get(step, self.model_name)
+        key = None
+        if self.cache is not None and self.use_cache:
+            key = ResponseCache.make_key(
+                prompt,
+                model=model,
+                generation_config={
+                    **self.generation_config,
+                    **({"response_mime_type": "application/json"} if json_output else {})
+                },
+                catalog_hash=self.catalog_hash,
+                user_prompt=user_prompt
+            )
+            cached = self.cache.get(key)
+            if cached is not None:
+                metrics.LLM_REQUESTS.inc(step=step, result="cache_hit")
+                if on_chunk:
+                    on_chunk(cached)
+                return cached
+        
+        prompt_tokens = estimate_tokens(prompt)
+        waited = self.rate_limiter.acquire(prompt_tokens, cancel_token)
+        if waited:
+            metrics.LLM_RATE_LIMIT_WAIT_SECONDS.observe(waited, step=step)
+        
+        budget = cancel_token.budget(timeout)
+        started = time.monotonic()
+        usage = None
+        try:
+            if on_chunk:
+                parts = []
+                config = {**self.generation_config, **(JSON_CONFIG if json_output else {})}
+                for chunk in self.backend.stream(prompt, model, config, budget):
+                    cancel_token.check()
+                    if timeout and time.monotonic() - started > timeout:
+                        raise TimeoutError(f"LLM call exceeded {timeout:.0f}s")
+                    parts.append(chunk.text)
+                    on_chunk(chunk.text)
+                    usage = chunk if chunk.response_tokens else usage
+                text = "".join(parts)
+            else:
+                generate = self.backend.generate_json if json_output else self.backend.generate
+                usage = generate(prompt, model, self.generation_config, budget)
+                text = usage.text
+        except Exception as e:
+            metrics.LLM_REQUESTS.inc(step=step, result="error")
+            if isinstance(e, (BuildCancelled, TimeoutError)):
+                raise
+            # A request cut short by the deadline is reported as a timeout
+            cancel_token.check()
+            if timeout and time.monotonic() - started >= timeout:
+                raise TimeoutError(f"LLM call exceeded {timeout:.0f}s")
+            raise
+        finally:
+            metrics.LLM_REQUEST_SECONDS.observe(time.monotonic() - started, step=step)
+        
+        metrics.LLM_REQUESTS.inc(step=step, result="ok")
+        metrics.LLM_PROMPT_CHARS.inc(len(prompt), step=step)
+        metrics.LLM_RESPONSE_CHARS.inc(len(text), step=step)
+        used_prompt_tokens = getattr(usage, "prompt_tokens", None) or prompt_tokens
+        response_tokens = getattr(usage, "response_tokens", None) or estimate_tokens(text)
+        metrics.LLM_PROMPT_TOKENS.inc(used_prompt_tokens, step=step)
+        metrics.LLM_RESPONSE_TOKENS.inc(response_tokens, step=step)
+        self.rate_limiter.charge(used_prompt_tokens - prompt_tokens + response_tokens)
+        
+        if validate:
+            validate(text)
+        if key:
+            self.cache.set(key, text)
+        return text
+    
+    def get_modules_context(self, module_ids: Optional[List[str]] = None) -> str:
+        """Create a context string with the given modules (default: all)."""
+        if module_ids is None:
+            module_ids = [m['module_id'] for m in self.modules]
+        return "Available Modules:\n\n" + "".join(
+            self.registry.context_fragment(m) for m in module_ids if m in self.registry
+        )
     
-    def analyze_prompt(self, user_prompt: str) -> Dict[str, Any]:
-        """Use Gemini to analyze user prompt and map to modules."""
+    def analyze_prompt(self, user_prompt: str,
+                       previous_analysis: Optional[Dict[str, Any]] = None,
+                       on_file: Optional[Callable[[Dict[str, Any], Dict[str, Any]], None]] = None,
+                       conversation: Optional[str] = None) -> Dict[str, Any]:
+        """Use Gemini to analyze user prompt and map to modules.
+
+        Only modules ranked relevant to the prompt are sent. If the model finds
+        nothing usable among them, the analysis is retried with the full catalog.
+        With `previous_analysis` the prompt refines that plan, and its modules
+        are always offered. With `on_file` the response is streamed (see
+        `_analysis_stream`); the returned analysis is still the final word.
+        `conversation` is the earlier chat, already condensed (see conversation.py).
+        """
+        selection = get_retriever(self.registry).select(user_prompt, self.retrieval_top_k)
+        candidates = selection.module_ids
+        if previous_analysis and selection.fallback is None:
+            candidates = list(dict.fromkeys(
+                candidates + [m['module_id'] for m in previous_analysis.get('required_modules', [])]
+            ))
+        modules_context = self.get_modules_context(candidates)
+        analysis = self._analyze_with_context(
+            user_prompt, modules_context, previous_analysis, on_file, conversation
+        )
         
-        modules_context = self.get_modules_context()
+        fallback = selection.fallback
+        if fallback is None and not analysis.get('required_modules'):
+            fallback = "empty_analysis"
+            modules_context = self.get_modules_context()
+            analysis = self._analyze_with_context(
+                user_prompt, modules_context, previous_analysis, on_file, conversation
+            )
+        
+        # The catalog's fragment length is computed once; estimate_tokens' ratio
+        full_chars = len(self.get_modules_context([])) + self.registry.context_chars()
+        full_tokens = (full_chars + 3) // 4
+        context_tokens = estimate_tokens(modules_context)
+        self.retrieval_stats = {
+            "catalog_size": len(self.registry),
+            "candidates": len(candidates) if fallback is None else len(self.registry),
+            "fallback": fallback,
+            "context_tokens": context_tokens,
+            "full_context_tokens": full_tokens,
+            "tokens_saved": full_tokens - context_tokens,
+        }
+        return analysis
+    
+    def _analyze_with_context(self, user_prompt: str, modules_context: str,
+                              previous_analysis: Optional[Dict[str, Any]] = None,
+                              on_file: Optional[Callable[[Dict[str, Any], Dict[str, Any]], None]] = None,
+                              conversation: Optional[str] = None) -> Dict[str, Any]:
+        history = ""
+        if conversation:
+            history = f"""
+The request continues this conversation with the user. Earlier requests still
+apply unless the new one changes them.
+{conversation}
+"""
+        previous_plan = ""
+        if previous_analysis:
+            previous_plan = f"""
+The user is refining an app that was already built from this plan.
+Previous plan (JSON): {json.dumps(previous_analysis)}
+Keep every file that does not need to change exactly as it is (same filename, purpose
+and modules_used), and only add, remove or change the files the new request affects.
+"""
         
         analysis_prompt = f"""
 You are an expert backend architect. Analyze the user's app requirements and map them to available modules.
@@ -89,21 +368,18 @@ You are an expert backend architect. Analyze the user's app requirements and map
 {modules_context}
 
 User Request: {user_prompt}
-
+{history}{previous_plan}
 Your task:
 1. Identify which modules are needed
 2. Determine the file structure (which files to create)
 3. Plan how modules connect (data flow between modules)
 4. Specify any additional glue code needed
 
-Return a JSON response with this exact structure:
+Return a JSON response with this exact structure, fields in this order:
 {{
-    "required_modules": [
-        {{
-            "module_id": "string",
-            "purpose": "why this module is needed",
-            "file_placement": "which file this goes in (e.g., auth.py, main.py)"
-        }}
+    "data_flow": "description of how data flows between modules",
+    "additional_requirements": [
+        "any glue code or setup needed"
     ],
     "file_structure": [
         {{
@@ -112,38 +388,82 @@ Return a JSON response with this exact structure:
             "modules_used": ["list of module_ids"]
         }}
     ],
-    "data_flow": "description of how data flows between modules",
-    "additional_requirements": [
-        "any glue code or setup needed"
+    "required_modules": [
+        {{
+            "module_id": "string",
+            "purpose": "why this module is needed",
+            "file_placement": "which file this goes in (e.g., auth.py, main.py)"
+        }}
     ]
 }}
 """
         
-        response = self.model.generate_content(
+        response_text = self._generate_text(
             analysis_prompt,
-            generation_config={
-                "response_mime_type": "application/json"
-            }
+            json_output=True,
+            validate=json.loads,
+            on_chunk=self._analysis_stream(on_file) if on_file else None,
+            timeout=self.analysis_timeout,
+            step="analysis",
+            user_prompt=user_prompt
         )
         
-        return json.loads(response.text)
+        return json.loads(response_text)
+    
+    def _analysis_stream(self, on_file: Callable[[Dict[str, Any], Dict[str, Any]], None]
+                         ) -> Callable[[str], None]:
+        """Chunk handler for a streamed analysis.
+
+        Calls `on_file(context, file_info)` for each `file_structure` entry
+        once it is complete and the `data_flow` and `additional_requirements`
+        it is generated with (`context`) have arrived. If the stream stops
+        parsing as JSON nothing more is passed on; the caller then works
+        from the full response.
+        """
+        context: Dict[str, Any] = {}
+        pending: List[Dict[str, Any]] = []
+        
+        def _dispatch() -> None:
+            if len(context) < 2:
+                return
+            while pending:
+                on_file(dict(context), pending.pop(0))
+        
+        def _field(key: str, value: Any) -> None:
+            if key in ("data_flow", "additional_requirements"):
+                context[key] = value
+                _dispatch()
+        
+        def _item(key: str, value: Any) -> None:
+            if key == "file_structure" and isinstance(value, dict) \
+                    and isinstance(value.get('filename'), str) \
+                    and isinstance(value.get('modules_used'), list):
+                pending.append(value)
+                _dispatch()
+        
+        parser = ObjectStreamParser(on_field=_field, on_item=_item)
+        broken = False
+        
+        def _chunk(text: str) -> None:
+            nonlocal broken
+            if broken or parser.done:
+                return
+            try:
+                parser.feed(text)
+            except ValueError as e:
+                broken = True
+                metrics.ANALYSIS_STREAM_FALLBACKS.inc()
+                print(f"⚠️  Streamed analysis is not parseable ({e}); waiting for the full response")
+        
+        return _chunk
     
     def generate_glue_code(self, analysis: Dict[str, Any], filename: str, 
-                          module_ids: List[str]) -> str:
+                          module_ids: List[str],
+                          on_chunk: Optional[Callable[[str], None]] = None,
+                          cancel_token: Optional[CancelToken] = None) -> str:
         """Generate glue code to connect modules in a file."""
         
-        modules_info = [m for m in self.modules if m['module_id'] in module_ids]
-        
-        modules_details = "\n\n".join([
-            f"""
-Module: {m['module_name']}
-Inputs: {m['inputs']}
-Outputs: {m['outputs']}
-Code:
-{m['code']}
-"""
-            for m in modules_info
-        ])
+        modules_details = self.glue_module_details(module_ids)
         
         glue_prompt = f"""
 Generate Python code for {filename} that integrates these modules:
@@ -164,6 +484,7 @@ Additional Requirements: {', '.join(analysis.get('additional_requirements', []))
 
 IMPORTANT: 
 - DO NOT rewrite the module code, use it as-is
+- Module code is inserted into the file for you; where only an interface is shown, rely on it
 - Only write the glue code to connect modules
 - Keep it production-ready
 - Use type hints
@@ -171,9 +492,42 @@ IMPORTANT:
 Return ONLY the Python code, no explanations.
 """
         
-        response = self.model.generate_content(glue_prompt)
-        return response.text.strip()
+        return self._generate_text(
+            glue_prompt, on_chunk=on_chunk, timeout=self.file_timeout, step="glue",
+            cancel_token=cancel_token
+        ).strip()
     
+    def glue_module_details(self, module_ids: List[str]) -> str:
+        """Module sections of a glue prompt.
+
+        `insert_module_code` adds every module's code to the file anyway,
+        so the prompt only needs enough to call the modules. With the
+        "auto" context each module starts as its interface summary, and
+        modules are switched to their full code, cheapest first, while
+        the sections stay within `glue_context_budget` tokens.
+        """
+        module_ids = [m for m in dict.fromkeys(module_ids) if m in self.registry]
+        if self.glue_context == "full":
+            sections = {m: self.registry.glue_fragment(m) for m in module_ids}
+        else:
+            sections = {m: self.registry.summary_fragment(m) for m in module_ids}
+        if self.glue_context == "auto":
+            used = sum(estimate_tokens(text) for text in sections.values())
+            upgrades = sorted(
+                (estimate_tokens(self.registry.glue_fragment(m)) - estimate_tokens(sections[m]), m)
+                for m in module_ids
+            )
+            for extra, module_id in upgrades:
+                if used + extra > self.glue_context_budget:
+                    break
+                sections[module_id] = self.registry.glue_fragment(module_id)
+                used += extra
+
+        for module_id, text in sections.items():
+            full = text == self.registry.glue_fragment(module_id)
+            metrics.GLUE_MODULE_CONTEXT.inc(form="full" if full else "summary")
+        return "\n\n".join(sections[m] for m in module_ids)
+
     def insert_module_code(self, glue_code: str, module_ids: List[str]) -> str:
         """Insert module code into the glue code at appropriate positions."""
         
@@ -183,11 +537,7 @@ Return ONLY the Python code, no explanations.
                 return "//"
             return "#"
 
-        modules_info = []
-        for module_id in module_ids:
-            module = next((m for m in self.modules if m['module_id'] == module_id), None)
-            if module:
-                modules_info.append(module)
+        modules_info = self.registry.get_many(module_ids)
 
         if not modules_info:
             return glue_code
@@ -218,18 +568,21 @@ Return ONLY the Python code, no explanations.
         return '\n'.join(lines)
     
     def create_file(self, filename: str, content: str):
-        """Create a file with the generated content."""
-        if not self.output_dir:
+        """Queue a file with the generated content on the artifact writer.
+
+        The file is written in the background (hard-linked to the shared
+        blob when the store is enabled) and only becomes visible when the
+        build is published.
+        """
+        if not self.writer:
             raise RuntimeError("Output directory not prepared. Call build_app() first.")
-        filepath = self.output_dir / filename
-        
-        # Create subdirectories if needed
-        filepath.parent.mkdir(parents=True, exist_ok=True)
         
-        with open(filepath, 'w') as f:
-            f.write(content)
+        def _written(entry: Dict[str, Any]) -> None:
+            self.manifest[filename] = entry
+            print(f"✓ Created: {self.output_dir / filename}")
+            self._emit("file_written", filename=filename, size=entry['size'], content=content)
         
-        print(f"✓ Created: {filepath}")
+        self.writer.write(filename, content.encode('utf-8'), on_written=_written)
     
     def generate_requirements_txt(self, analysis: Dict[str, Any]):
         """Generate requirements.txt based on modules used."""
@@ -244,7 +597,7 @@ Return ONLY the Python code, no explanations.
         # Add module-specific requirements
         for module_info in analysis['required_modules']:
             module_id = module_info['module_id']
-            module = next((m for m in self.modules if m['module_id'] == module_id), None)
+            module = self.registry.metadata(module_id)
             
             if module and module.get('language', 'python').lower() == 'python' and 'email' in module['module_name'].lower():
                 requirements.add("python-jose[cryptography]")
@@ -271,6 +624,99 @@ if __name__ == "__main__":
 """
         self.create_file("main.py", main_content)
     
+    def generate_file_content(self, analysis: Dict[str, Any], file_info: Dict[str, Any],
+                              cancel_token: Optional[CancelToken] = None) -> str:
+        """Generate the full content of one file from the analysis.
+
+        `cancel_token` (default: the build's) stops the file; once it is
+        cancelled the file sends no more events.
+        """
+        filename = file_info['filename']
+        module_ids = file_info['modules_used']
+        cancel_token = cancel_token or self.cancel_token
+        
+        def emit(event_type: str, **data: Any) -> None:
+            if not cancel_token.cancelled:
+                self._emit(event_type, **data)
+        
+        cancel_token.check()
+        print(f"📝 Generating {filename}...")
+        emit("file_started", filename=filename, modules=module_ids)
+        
+        # Generate glue code, streaming it to the listener as it arrives
+        on_chunk = None
+        if self.on_event:
+            on_chunk = lambda text: emit("file_chunk", filename=filename, content=text)
+        metrics.GLUE_IN_FLIGHT.inc()
+        try:
+            with self._stage("generate_glue_code"):
+                glue_code = self.generate_glue_code(
+                    analysis, filename, module_ids, on_chunk=on_chunk, cancel_token=cancel_token
+                )
+        finally:
+            metrics.GLUE_IN_FLIGHT.dec()
+        
+        # Insert actual module code
+        with self._stage("insert_module_code"):
+            full_code = self.insert_module_code(glue_code, module_ids)
+        
+        # Clean up code formatting
+        with self._stage("clean_code"):
+            return self.clean_code(full_code)
+    
+    def file_fingerprint(self, file_info: Dict[str, Any]) -> str:
+        """Hash of everything a file's generated content depends on.
+
+        Covers the file's name, purpose and modules (with their code, inputs
+        and outputs) plus the glue model and module context settings. The
+        app-wide data flow text is left out, since the model rewords it on
+        every analysis.
+        """
+        module_ids = file_info.get('modules_used', [])
+        payload = {
+            "filename": file_info['filename'],
+            "purpose": file_info.get('purpose', ''),
+            "modules": [
+                self.registry.glue_fragment(m) if m in self.registry else m for m in module_ids
+            ],
+            "model": self.step_models.get("glue", self.model_name),
+            "generation_config": self.generation_config,
+            "module_context": [self.glue_context, self.glue_context_budget],
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def _reuse_unchanged_files(self, file_structure: List[Dict[str, Any]],
+                               previous: Dict[str, Any]) -> List[str]:
+        """Link (or copy) files whose fingerprint matches the previous build."""
+        previous_fingerprints = previous.get('fingerprints') or {}
+        previous_files = {f['path']: f for f in previous.get('files', [])}
+        reused = []
+        for file_info in file_structure:
+            filename = file_info['filename']
+            if previous_fingerprints.get(filename) != self.file_fingerprints[filename]:
+                continue
+            source = resolve_path(previous.get('output_dir', ''), filename)
+            if source is None or not source.is_file():
+                continue
+            
+            def _linked(entry: Dict[str, Any], filename: str = filename) -> None:
+                self.manifest[filename] = entry
+                print(f"♻️  Reused: {self.output_dir / filename}")
+                self._emit("file_reused", filename=filename, size=entry['size'])
+
+            self.writer.link(
+                filename, source, sha256=previous_files.get(filename, {}).get('sha256'),
+                on_written=_linked
+            )
+            reused.append(filename)
+        # Reused files count as written only once they are in place
+        self.writer.flush()
+        return reused
+    
+    @staticmethod
+    def _is_supporting_file(filename: str) -> bool:
+        return os.path.normpath(filename) in SUPPORTING_FILES
+
     def _slugify_prompt(self, user_prompt: str) -> str:
         """Convert the user prompt to a filesystem-friendly slug."""
         slug = re.sub(r"[^a-z0-9]+", "-", user_prompt.lower()).strip('-')
@@ -279,37 +725,129 @@ if __name__ == "__main__":
         return slug[:40]
 
     def _prepare_output_dir(self, user_prompt: str) -> Path:
-        """Create a unique output directory for the generated app."""
+        """Reserve a unique (empty) output directory for the generated app."""
         timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
         slug = self._slugify_prompt(user_prompt)
         base_name = f"{timestamp}-{slug}" if slug != "app" else f"{timestamp}-app"
         candidate = self.output_root / base_name
         counter = 1
-        while candidate.exists():
-            counter += 1
-            candidate = self.output_root / f"{base_name}-{counter}"
-        candidate.mkdir(parents=True, exist_ok=False)
-        return candidate
+        while True:
+            try:
+                candidate.mkdir(parents=True, exist_ok=False)
+                return candidate
+            except FileExistsError:
+                # Another build (possibly concurrent) already took this name
+                counter += 1
+                candidate = self.output_root / f"{base_name}-{counter}"
+
+    def build_app(self, user_prompt: str, use_cache: bool = True,
+                  previous: Optional[Dict[str, Any]] = None,
+                  conversation: Optional[str] = None):
+        """Main method to build the app from user prompt.
 
-    def build_app(self, user_prompt: str):
-        """Main method to build the app from user prompt."""
+        `previous` is an earlier build of the same app (its session, with
+        `analysis`, `fingerprints`, `files` and `output_dir`). The prompt then
+        refines that plan and only files whose inputs changed are regenerated;
+        the rest are linked from the previous output. `conversation` is the
+        earlier chat the request continues, passed to the analysis.
+
+        Files are staged and `output_dir` appears, complete, only when the
+        build finishes. Raises BuildCancelled if `cancel_token` is cancelled
+        or the build runs past `build_timeout`; staged files are discarded.
+        """
         
+        self.use_cache = use_cache
+        self.conversation = conversation
+        self.manifest = {}
+        self.timings = {}
+        self.reused_files = []
+        self.cancel_token.set_timeout(self.build_timeout)
+        try:
+            with self._stage("build"):
+                self._build(user_prompt, previous)
+        except BuildCancelled as e:
+            print(f"\n🛑 {e}, discarding partial output")
+            self._discard_output()
+            raise
+        except Exception:
+            self._discard_output()
+            raise
+    
+    def _discard_output(self) -> None:
+        if self.writer:
+            self.writer.discard()
+        if self.output_dir:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+    
+    def _build(self, user_prompt: str, previous: Optional[Dict[str, Any]] = None):
         print(f"\n🚀 Building app from prompt: '{user_prompt}'\n")
         self.output_dir = self._prepare_output_dir(user_prompt)
+        self.writer = ArtifactWriter(self.output_dir, self.blob_store)
         print(f"📁 Output directory: {self.output_dir}")
         
+        # Glue code is generated on a pool; when pipelining, a file starts as soon
+        # as the streamed analysis has described it. Each file has its own cancel
+        # token, so a file can be dropped without stopping the build.
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrent_files)
+        started: Dict[str, Tuple[Dict[str, Any], Dict[str, Any], Future, CancelToken]] = {}
+        previous_fingerprints = (previous or {}).get('fingerprints') or {}
+        
+        def start_early(context: Dict[str, Any], file_info: Dict[str, Any]) -> None:
+            filename = file_info['filename']
+            if filename in started or self._is_supporting_file(filename):
+                return
+            if previous_fingerprints.get(filename) == self.file_fingerprint(file_info):
+                return  # probably reused; decided once the analysis is complete
+            token = self.cancel_token.child()
+            future = pool.submit(self.generate_file_content, context, file_info, token)
+            started[filename] = (context, file_info, future, token)
+            metrics.GLUE_DISPATCH.inc(when="early")
+        
+        try:
+            self._generate(user_prompt, previous, pool, started,
+                           start_early if self.pipeline else None)
+        except BaseException:
+            # Stop files still generating rather than wait out their LLM calls;
+            # a call that cannot be interrupted finishes in the background
+            for _, _, _, token in started.values():
+                token.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown(wait=True)
+    
+    def _generate(self, user_prompt: str, previous: Optional[Dict[str, Any]],
+                  pool: ThreadPoolExecutor,
+                  started: Dict[str, Tuple[Dict[str, Any], Dict[str, Any], Future, CancelToken]],
+                  on_file: Optional[Callable[[Dict[str, Any], Dict[str, Any]], None]]):
         # Step 1: Analyze prompt and map to modules
         print("📊 Analyzing requirements...")
-        analysis = self.analyze_prompt(user_prompt)
+        self._emit("status", message="Analyzing prompt...")
+        with self._stage("analyze_prompt"):
+            analysis = self.analyze_prompt(
+                user_prompt, previous_analysis=previous.get('analysis') if previous else None,
+                on_file=on_file, conversation=self.conversation
+            )
+        self.analysis = analysis
+        self._emit(
+            "analysis",
+            modules=[m['module_id'] for m in analysis['required_modules']],
+            files=[f['filename'] for f in analysis['file_structure']],
+            data_flow=analysis.get('data_flow', '')
+        )
         
         print(f"\n✓ Found {len(analysis['required_modules'])} required modules")
-        print(f"✓ Will create {len(analysis['file_structure'])} files\n")
+        print(f"✓ Will create {len(analysis['file_structure'])} files")
+        stats = self.retrieval_stats
+        if stats and stats['fallback'] is None:
+            print(f"✓ Sent {stats['candidates']}/{stats['catalog_size']} modules to the analyzer "
+                  f"(~{stats['tokens_saved']} prompt tokens saved)")
+        print()
         
         # Check for modules requiring setup
         setup_required_modules = []
         for module_info in analysis['required_modules']:
             module_id = module_info['module_id']
-            module = next((m for m in self.modules if m['module_id'] == module_id), None)
+            module = self.registry.metadata(module_id)
             if module and module.get('setup_required'):
                 setup_required_modules.append(module['module_name'])
         
@@ -320,34 +858,92 @@ if __name__ == "__main__":
                 print(f"   - {mod_name}")
             print("   Check the generated README.md for detailed setup instructions.\n")
         
-        # Step 2: Generate each file
+        # Step 2: Generate the remaining files concurrently. Files started while the
+        # analysis streamed are kept only if the final plan describes them the same way.
+        # On a rebuild, files whose inputs are unchanged are taken from the previous build.
+        file_structure = [
+            f for f in analysis['file_structure'] if not self._is_supporting_file(f['filename'])
+        ]
         for file_info in analysis['file_structure']:
+            if self._is_supporting_file(file_info['filename']):
+                print(f"⚠️  Skipping planned {file_info['filename']}: it is written from a template")
+        self.file_fingerprints = {f['filename']: self.file_fingerprint(f) for f in file_structure}
+        planned = {f['filename']: f for f in file_structure}
+        context = {k: analysis.get(k) for k in ("data_flow", "additional_requirements")}
+        for filename, (early_context, file_info, future, token) in list(started.items()):
+            if planned.get(filename) != file_info or early_context != context:
+                token.cancel()
+                future.cancel()
+                del started[filename]
+                metrics.GLUE_DISPATCH.inc(when="discarded")
+        if previous:
+            with self._stage("reuse_files"):
+                self.reused_files = self._reuse_unchanged_files(
+                    [f for f in file_structure if f['filename'] not in started], previous
+                )
+            print(f"✓ Reusing {len(self.reused_files)}/{len(file_structure)} files from the previous build")
+        for file_info in file_structure:
             filename = file_info['filename']
-            module_ids = file_info['modules_used']
-            
-            print(f"📝 Generating {filename}...")
-            
-            # Generate glue code
-            glue_code = self.generate_glue_code(analysis, filename, module_ids)
-            
-            # Insert actual module code
-            full_code = self.insert_module_code(glue_code, module_ids)
-            
-            # Clean up code formatting
-            full_code = self.clean_code(full_code)
+            if filename not in started and filename not in self.reused_files:
+                token = self.cancel_token.child()
+                future = pool.submit(self.generate_file_content, analysis, file_info, token)
+                started[filename] = (context, file_info, future, token)
+                metrics.GLUE_DISPATCH.inc(when="late")
+        
+        # Step 3: Supporting files and README only need the analysis; write them
+        # while the glue code is still being generated
+        print("\n📦 Generating supporting files...")
+        with self._stage("generate_requirements_txt"):
+            self.generate_requirements_txt(analysis)
+        with self._stage("generate_main_file"):
+            self.generate_main_file()
+        with self._stage("generate_readme"):
+            self.generate_readme(user_prompt, analysis)
+        
+        # Step 4: Write each file as soon as its glue code is ready
+        failures = {}
+        futures = {
+            started[f['filename']][2]: index
+            for index, f in enumerate(file_structure) if f['filename'] in started
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            filename = file_structure[index]['filename']
+            try:
+                full_code = future.result()
+            except BuildCancelled:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            except Exception as e:
+                print(f"✗ Failed to generate {filename}: {e}")
+                self._emit("file_failed", filename=filename, error=str(e))
+                failures[index] = {"filename": filename, "error": str(e)}
+                continue
             
             # Create the file
             self.create_file(filename, full_code)
+        self.failed_files = [failures[i] for i in sorted(failures)]
+        self.cancel_token.check()
+        if failures and len(failures) == len(futures) and not self.reused_files:
+            raise RuntimeError(
+                f"Every file failed to generate (first error: {self.failed_files[0]['error']})"
+            )
         
-        # Step 3: Generate supporting files
-        print("\n📦 Generating supporting files...")
-        self.generate_requirements_txt(analysis)
-        self.generate_main_file()
+        # Step 5: Make the build visible once every file is on disk
+        with self._stage("publish"):
+            self.writer.publish()
         
-        # Step 4: Generate README
-        self.generate_readme(user_prompt, analysis)
+        if self.failed_files:
+            print(f"\n⚠️  {len(self.failed_files)} file(s) could not be generated:")
+            for failure in self.failed_files:
+                print(f"   - {failure['filename']}: {failure['error']}")
         
-        print(f"\n✅ App generated successfully in '{self.output_dir}' directory!")
+        if self.failed_files:
+            print(f"\n⚠️  App generated in '{self.output_dir}' without "
+                  f"{len(self.failed_files)} of its {len(file_structure)} files")
+        else:
+            print(f"\n✅ App generated successfully in '{self.output_dir}' directory!")
         
         if setup_required_modules:
             print("\n⚠️  IMPORTANT: External setup required!")
@@ -358,6 +954,10 @@ if __name__ == "__main__":
         print("2. pip install -r requirements.txt")
         print("3. python main.py")
     
+    def manifest_files(self) -> List[Dict[str, Any]]:
+        """Manifest entries of the last build, sorted by path."""
+        return [self.manifest[path] for path in sorted(self.manifest)]
+    
     def clean_code(self, code: str) -> str:
         """Clean up generated code (remove markdown code blocks, etc)."""
         lines = code.split('\n')
@@ -385,7 +985,7 @@ if __name__ == "__main__":
         setup_sections = []
         for module_info in analysis['required_modules']:
             module_id = module_info['module_id']
-            module = next((m for m in self.modules if m['module_id'] == module_id), None)
+            module = self.registry.get(module_id)
             
             if module and module.get('setup_required'):
                 setup_sections.append(f"""
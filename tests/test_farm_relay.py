@@ -0,0 +1,40 @@
+"""The farm relay must not skip events of a job submitted while it polls."""
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from farm import FarmJobManager, SQLiteJobQueue  # noqa: E402
+from sessions import SQLiteSessionStore  # noqa: E402
+
+
+def test_events_of_a_job_registered_mid_poll_are_relayed(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "queue.sqlite3"))
+    sessions = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), "build")
+    # The relay thread never wakes up; polls are driven by the test
+    jobs = FarmJobManager(sessions, queue, poll_interval=3600, max_per_client=0)
+    try:
+        first = jobs.submit("first app", use_cache=False)
+        late = []
+        read_events = queue.events_after
+
+        def racing_read(after_id, *args):
+            # Another request is submitted and its worker reports, and then the
+            # first job reports, after the relay starts this poll
+            late.append(jobs.submit("second app", use_cache=False))
+            late.append(jobs.get_future(late[0]))
+            sessions.update(late[0], {"status": "completed", "completed_at": "2026-01-01T00:00:00"})
+            queue.push_event(late[0], {"type": "complete", "files": []})
+            queue.push_event(first, {"type": "status", "message": "working"})
+            queue.events_after = read_events
+            return read_events(after_id, *args)
+
+        queue.events_after = racing_read
+        jobs._relay_events()
+
+        assert late[1].done()
+        assert sessions.get(late[0])["status"] == "completed"
+        assert not jobs.get_future(first).done()
+    finally:
+        jobs.shutdown()
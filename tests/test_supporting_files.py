@@ -0,0 +1,57 @@
+"""A planned file named like a supporting file must not replace the template."""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from llm import LocalBackend  # noqa: E402
+from test import ModuleBasedAppBuilder  # noqa: E402
+
+PLAN = {
+    "required_modules": [],
+    "data_flow": "requests go through the api",
+    "additional_requirements": [],
+    "file_structure": [
+        {"filename": "main.py", "purpose": "entry point", "modules_used": []},
+        {"filename": "api.py", "purpose": "routes", "modules_used": []},
+    ],
+}
+
+
+@pytest.fixture
+def builder(tmp_path, monkeypatch):
+    monkeypatch.setenv("RESPONSE_CACHE", "0")
+    monkeypatch.setenv("BLOB_STORE", "0")
+    builder = ModuleBasedAppBuilder(
+        modules_path=str(ROOT / "modules.json"), backend=LocalBackend(), pipeline=True
+    )
+    builder.output_root = tmp_path
+    generated = []
+    original = builder.generate_file_content
+    builder.generate_file_content = lambda context, file_info, *args: (
+        generated.append(file_info["filename"]) or original(context, file_info, *args)
+    )
+    builder.generated = generated
+    return builder
+
+
+def _analysis(user_prompt, previous_analysis=None, on_file=None, conversation=None):
+    context = {k: PLAN[k] for k in ("data_flow", "additional_requirements")}
+    for file_info in PLAN["file_structure"]:
+        on_file(dict(context), dict(file_info))  # as if streamed
+    return PLAN
+
+
+def test_planned_main_py_keeps_the_template(builder):
+    builder.analyze_prompt = _analysis
+    builder.build_app("an api", use_cache=False)
+
+    assert builder.generated == ["api.py"]
+    main = (builder.output_dir / "main.py").read_text()
+    assert 'FastAPI(title="Generated App"' in main
+    assert set(builder.manifest) == {"api.py", "main.py", "requirements.txt", "README.md"}
+    assert builder.failed_files == []